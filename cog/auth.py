@@ -18,13 +18,19 @@
 
 import os
 import hashlib
+import hmac
+import time
 import collections
 import threading
-import datetime
 import stat
 import base64
 import json
 
+try: # version-proof
+    import xmlrpc.client as xmlrpc_lib
+except ImportError :
+    import xmlrpclib as xmlrpc_lib
+
 try:
     # Assume Linux, OSX:
     import pwd
@@ -73,7 +79,8 @@ def _make_method_permission_filename( confdict ):
 def read_method_permissions( confdict ):
     # @@ would be nice if permissions on the filename were proven to be restricted
     filename = _make_method_permission_filename( confdict )
-    return json.loads( open( filename, 'rt' ).read() )
+    with open( filename, 'rt' ) as f :
+        return json.loads( f.read() )
 
 def get_nonce():
     "returns a binary, frequently will want to use with base64.b64encode"
@@ -96,6 +103,59 @@ def make_user_credentials( username, confdict ):
             os.remove( filename )
         raise
 
+class _SecretCache( object ):
+    """User secrets read from disk, least recently used dropped beyond max_count.
+    A secret is read again when its file changes (inode, modification time or size),
+    which is checked at most every check_interval seconds."""
+    
+    def __init__( self, max_count, check_interval ):
+        self._max_count = max_count
+        self._check_interval = check_interval
+        self._entries = collections.OrderedDict() # filename -> (checked, stat key, secret)
+        self._lock = threading.Lock()
+        
+    def get( self, filename ):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop( filename, None )
+            if entry is not None and now - entry[0] < self._check_interval :
+                self._entries[ filename ] = entry
+                return entry[2]
+        finally:
+            self._lock.release()
+            
+        st = os.stat( filename )
+        key = ( st.st_ino, st.st_mtime, st.st_size )
+        if entry is not None and entry[1] == key :
+            secret = entry[2]
+        else:
+            with open( filename, 'rb' ) as f :
+                secret = f.read()
+            
+        self._lock.acquire()
+        try:
+            self._entries[ filename ] = ( now, key, secret )
+            while len( self._entries ) > self._max_count :
+                self._entries.popitem( last=False )
+        finally:
+            self._lock.release()
+        return secret
+        
+    def clear( self ):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+SECRET_CACHE_SIZE = 1024 # users
+SECRET_CHECK_INTERVAL = 1.0 # seconds
+_secrets = _SecretCache( SECRET_CACHE_SIZE, SECRET_CHECK_INTERVAL )
+
+def _read_secret( username, confdict ):
+    return _secrets.get( _make_userpass_filename( username, confdict ))
+
 def get_user_credentials( username, confdict, noncehex ):
     "returns UserAuthentication tuple"
     filename = _make_userpass_filename( username, confdict )
@@ -110,95 +170,247 @@ def get_user_credentials( username, confdict, noncehex ):
             make_user_credentials( username, confdict )
 
     clientnonce = get_nonce()
-    dochash = hashlib.sha256( base64.b64decode(noncehex) + clientnonce + open(filename,'rb').read() ).hexdigest()
-    return UserCredentials( username, noncehex, base64.b64encode(clientnonce), dochash )
+    dochash = hashlib.sha256( base64.b64decode(noncehex) + clientnonce + _read_secret( username, confdict ) ).hexdigest()
+    return UserCredentials( username, noncehex, _text( base64.b64encode(clientnonce) ), dochash )
 
 
 def verify_user_credentials( cred, confdict ):
     "This does NOT include the check to verify that the server nonce is valid"
-    filename = _make_userpass_filename( cred.username, confdict )
-    dochash = hashlib.sha256( base64.b64decode(cred.servernonce) + base64.b64decode(cred.clientnonce) + open(filename,'rb').read() ).hexdigest()
-    return dochash == cred.pwhash
+    dochash = hashlib.sha256( base64.b64decode(cred.servernonce) + base64.b64decode(cred.clientnonce) + _read_secret( cred.username, confdict ) ).hexdigest()
+    return compare_digest( dochash, cred.pwhash )
+
+
+try: # version-proof, constant time comparison
+    compare_digest = hmac.compare_digest
+except AttributeError :
+    def compare_digest( a, b ):
+        if len( a ) != len( b ):
+            return False
+        result = 0
+        for x, y in zip( a, b ):
+            result |= ord( x ) ^ ord( y )
+        return result == 0
+
+#
+# Sessions save the get_nonce round trip of every call:
+# a call authenticated with a server nonce (above) opens a session, the server returns its id.
+# Both sides derive the session key from the user secret, the session id and the client nonce 
+# of that call, so the key never travels.  Each following call carries UserCredentials of
+# ( username, SESSION_PREFIX + session id, counter, MAC of the key over the counter and the method ),
+# the counter increases with every call so the server can refuse replays.
+#
+
+SESSION_PREFIX = 'session:'
+SESSION_FAULT = 4001 # faultCode of a call with a session the server does not know (expired, restarted)
+
+def _text( x ):
+    "str of a str or ascii bytes, the nonces are bytes in python 3"
+    return x if isinstance( x, str ) else x.decode( 'ascii' )
+
+def _hmac( key, *parts ):
+    return hmac.new( key, '\n'.join( parts ).encode( 'utf-8' ), hashlib.sha256 ).hexdigest()
+
+def make_session_id():
+    return _text( base64.urlsafe_b64encode( os.urandom( 18 )))
+
+def get_session_key( username, confdict, session_id, clientnonce ):
+    return _hmac( _read_secret( username, confdict ), 'cog-session', username, session_id, _text( clientnonce ) ).encode( 'ascii' )
+
+def make_session_mac( key, username, session_id, counter, methodname ):
+    return _hmac( key, username, session_id, str( counter ), methodname )
+
+def is_session_credentials( cred ):
+    return _text( cred.servernonce ).startswith( SESSION_PREFIX )
+
+def get_session_id( cred ):
+    return _text( cred.servernonce )[ len( SESSION_PREFIX ): ]
+
+def is_missing_method( fault ):
+    "True for the Fault of a server without the method, the xmlrpc dispatcher has no faultCode of its own for it"
+    return 'is not supported' in str( fault.faultString )
+
+
+class ClientSession( object ):
+    """Client side of a session of a user with one server, thread-safe.
+    get_credentials() opens the session when needed, with the usual nonce authentication,
+    and falls back to nonce authentication if the server does not support sessions."""
+
+    RETRY = 60 # seconds before trying to open a session again after a failure
+    
+    def __init__( self, username, confdict ):
+        self._username = username
+        self._conf = confdict
+        self._lock = threading.Lock()
+        self._id = None
+        self._key = None
+        self._counter = 0
+        self._expires = 0
+        self._retry = 0
+
+    def _next_credentials( self, methodname ):
+        # must hold the lock
+        self._counter += 1
+        mac = make_session_mac( self._key, self._username, self._id, self._counter, methodname )
+        return UserCredentials( self._username, SESSION_PREFIX + self._id, str( self._counter ), mac )
+
+    def get_credentials( self, proxy, methodname ):
+        "returns the credentials tuple for one call of methodname through the proxy"
+        now = time.time()
+        self._lock.acquire()
+        try:
+            if self._id is not None and now < self._expires :
+                return tuple( self._next_credentials( methodname ))
+            opening = now >= self._retry
+            if opening :
+                self._retry = now + self.RETRY # one thread opens, the others use nonces meanwhile
+        finally:
+            self._lock.release()
+            
+        if opening :
+            try:
+                cred = get_user_credentials( self._username, self._conf, proxy.get_nonce() )
+                session_id, lifetime = proxy.open_session( tuple( cred ))
+                key = get_session_key( self._username, self._conf, session_id, cred.clientnonce )
+                self._lock.acquire()
+                try:
+                    self._id, self._key, self._counter = session_id, key, 0
+                    self._expires = now + 0.9 * lifetime # renew before the server forgets it
+                    return tuple( self._next_credentials( methodname ))
+                finally:
+                    self._lock.release()
+            except xmlrpc_lib.Fault as e :
+                if not is_missing_method( e ):
+                    self._lock.acquire()
+                    try:
+                        self._retry = 0 # a real failure, not an older server
+                    finally:
+                        self._lock.release()
+                    raise
+                # no session with an older server, nonces it is
+                
+        return tuple( get_user_credentials( self._username, self._conf, proxy.get_nonce() ))
+
+    def is_open( self ):
+        return self._id is not None
+
+    def reset( self ):
+        "forgets the session, e.g. after the server refused it"
+        self._lock.acquire()
+        try:
+            self._id = None
+            self._key = None
+            self._retry = 0
+        finally:
+            self._lock.release()
+
+
+class _PermissionIndex( object ):
+    "one immutable generation of the method permissions and group memberships, see MethodPermissions"
+    def __init__( self, permissions, grname, members ):
+        self.permissions = permissions # method -> (frozenset of groups, frozenset of users)
+        self.grname = grname # gid -> group name
+        self.members = members # username -> frozenset of secondary group names
+        self.pwall = {} # username -> pwd entry, loaded on demand
+        self.usergroups = {} # username -> frozenset of all group names, computed on demand
 
 
 class MethodPermissions ( object ):
+    """Verifies that users may call server methods, according to the method permissions file.
+    
+    The file and the group memberships are read into an index, rebuilt in the background every 
+    COGSERVER_PERMISSIONS_EXPIRY seconds, so verify() is a few set and dictionary lookups 
+    on the current index, without a lock."""
+    
     def __init__( self, confdict, logger ) :
-        self._authdoc = None
-        self._authlock = threading.Lock()
-        self._authdate = datetime.datetime.now()
-        self._deltatime = datetime.timedelta( seconds=confdict['COGSERVER_PERMISSIONS_EXPIRY'] )
-        
-        self._pwall = {}
-        self._grall = None
-        self._grname = None
-        self._grdate = datetime.datetime.now()
-        
+        self._expiry = confdict['COGSERVER_PERMISSIONS_EXPIRY']
         self._conf = confdict
         self._logger = logger
+        
+        self._index = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread( target=self._refresh_loop )
+        self._thread.daemon = True
+        self._thread.start()
 
     def verify( self, username, methodname ):
-        ret = True
-        self._refresh_permdoc()
-        try:
-            self._authlock.acquire( True )
-            usergroups = self._getgroups( username )
-            if methodname in self._authdoc :
-                ret = False
-                if 'groups' in self._authdoc[ methodname ]:
-                    ret = any( x in self._authdoc[ methodname ]['groups'] for x in usergroups )
-                if not ret and 'users' in self._authdoc[ methodname ]:
-                    ret = username in self._authdoc[ methodname ][ 'users' ]
-                if not ret:
-                    self._logger.error( "Permissions denied to %s, for %s" % (username, methodname))
-        finally:
-            self._authlock.release()
-
-        return ret
+        index = self._get_index()
+        if methodname not in index.permissions :
+            return True # any method not specified in the file is free for anyone to run
+        groups, users = index.permissions[ methodname ]
+        if username in users :
+            return True
+        if groups and not groups.isdisjoint( self._getgroups( index, username )) :
+            return True
+        self._logger.error( "Permissions denied to %s, for %s" % (username, methodname))
+        return False
 
     
-    def _refresh_permdoc( self ):
-        # read document if time has expired, or if there is no document to start
+    def _get_index( self ):
+        self._ready.wait()
+        return self._index
+        
+        
+    def _refresh_loop( self ):
+        while True :
+            self._refresh()
+            self._ready.set()
+            threading.Event().wait( self._expiry ) # sleep, version-proof
+        
+        
+    def _refresh( self ):
         # ideally the document has restrictive permissions or the whole thing is moot.
-        now = datetime.datetime.now()
-        elapsed = now - self._deltatime
-        if ( not self._authdoc ) or ( now - self._authdate > self._deltatime ):
-            self._authlock.acquire( True )
-            self._authdoc = {}
-            try:
-                self._authdoc = read_method_permissions( self._conf )
-            except:
-                self._logger.error( "Fail to read method permissions file (%s)" % _make_method_permission_filename( self._conf ))
-            finally:
-                self._authlock.release()
-            self._authdate = now
+        permissions = None
+        try:
+            authdoc = read_method_permissions( self._conf )
+            permissions = dict(
+                ( method, ( frozenset( rule.get( 'groups', ())), frozenset( rule.get( 'users', ()))))
+                for method, rule in authdoc.items() )
+        except:
+            self._logger.error( "Fail to read method permissions file (%s)" % _make_method_permission_filename( self._conf ))
+            if self._index is not None :
+                permissions = self._index.permissions # keep the last good permissions
+            else:
+                permissions = {}
+                
+        # performance is dependent upon caching group associations.
+        try:
+            grall = grp.getgrall()
+            grname = dict(( x.gr_gid, x.gr_name ) for x in grall)
+            members = {}
+            for group in grall :
+                for username in group.gr_mem :
+                    members.setdefault( username, set() ).add( group.gr_name )
+            members = dict(( k, frozenset( v )) for k, v in members.items() )
+        except:
+            self._logger.error( "Fail to read the groups" )
+            if self._index is not None :
+                grname, members = self._index.grname, self._index.members
+            else:
+                grname, members = {}, {}
+        
+        self._index = _PermissionIndex( permissions, grname, members ) # replaced in one assignment, readers need no lock
 
         
-    def _getgroups( self, username ):
-        # get all the groups this person of which this person is a member
-        # primary group for user:
+    def _getpw( self, index, username ):
+        if username not in index.pwall :
+            index.pwall[ username ] = pwd.getpwnam( username )
+        return index.pwall[ username ]
         
-        # performance is dependent upon caching group associations.  Sad face.
-        now = datetime.datetime.now()
-        if any( not x for x in (self._grname,self._grall,self._pwall)) or ( now - self._grdate > self._deltatime ):
-            self._pwall = {} # each key-value loaded on demand
-            self._grall = grp.getgrall()
-            self._grname = dict(( x.gr_gid, x.gr_name ) for x in self._grall)
-            self._grdate = now
         
-        if username not in self._pwall :
-            self._pwall[ username ] = pwd.getpwnam( username )
-        usergroups = [ self._pwall[ username ].pw_gid ]
-            
-        # secondary groups for user:
-        other_groups = [group.gr_gid for group in self._grall if username in group.gr_mem]
-        usergroups.extend(other_groups)
-            
-        # convert from gid to group names
-        return set(self._grname[x] for x in usergroups)
+    def _getgroups( self, index, username ):
+        # get all the groups of which this person is a member
+        ret = index.usergroups.get( username )
+        if ret is None :
+            # primary group for user, and secondary groups:
+            primary = self._getpw( index, username ).pw_gid
+            ret = index.members.get( username, frozenset() )
+            if primary in index.grname :
+                ret = ret | frozenset( [ index.grname[ primary ] ] )
+            index.usergroups[ username ] = ret
+        return ret
 
 
     def get_ids( self, username ):
         "returns uid and gid for the given user"
-        if username not in self._pwall :
-            self._pwall[ username ] = pwd.getpwnam( username )
-        return( self._pwall[ username ].pw_uid, self._pwall[ username ].pw_gid )
\ No newline at end of file
+        pw = self._getpw( self._get_index(), username )
+        return( pw.pw_uid, pw.pw_gid )
@@ -16,7 +16,7 @@
 # 
 #####################################################################
 
-import objport
+from . import objport
 
 # in cog execution code : as ccx
 
@@ -30,6 +30,9 @@ __default = {}
 __default['COG_SCRIPTPATH'] = os.environ.get( 'COG_SCRIPTPATH', '' )
 __default['COG_AUTHPATH'] = os.environ.get( 'COG_AUTHPATH', None )
 __default['COG_SERVERS'] = [s.strip() for s in os.environ.get( 'COG_SERVERS', "" ).split(',')]
+__default['COG_LOG_FLUSH_SIZE'] = int(os.environ.get( 'COG_LOG_FLUSH_SIZE', 64 * 1024 )) # characters of node output sent to the server at once
+__default['COG_LOG_FLUSH_INTERVAL'] = int(os.environ.get( 'COG_LOG_FLUSH_INTERVAL', 5000 )) # ms, longest delay before node output is sent
+__default['COG_RPC_TIMEOUT'] = float(os.environ.get( 'COG_RPC_TIMEOUT', 60 )) # seconds, longest wait for any one server
 
 
 #######################################
@@ -46,7 +49,24 @@ __default_server[ 'COGSERVER_PERMISSIONS_EXPIRY' ] = int(os.environ.get( 'COGSER
 __default_server[ 'COGSERVER_DATABASE' ] = os.environ.get( 'COGSERVER_DATABASE', '/var/lib/cog/cog.db' )
 __default_server[ 'COGSERVER_BACKUP_INTERVAL' ] = int(os.environ.get( 'COGSERVER_BACKUP_INTERVAL', 60 * 60 * 4 )) # 4 hours
 __default_server[ 'COGSERVER_BACKUPPATH' ] = os.environ.get( 'COGSERVER_BACKUPPATH', '/var/lib/cog/backup/' )
+__default_server[ 'COGSERVER_ARCHIVEPATH' ] = os.environ.get( 'COGSERVER_ARCHIVEPATH', '/var/lib/cog/archive/' ) # finished submissions, one database per month
+__default_server[ 'COGSERVER_BACKUP_COMPRESS' ] = int(os.environ.get( 'COGSERVER_BACKUP_COMPRESS', 1 )) # 1 to gzip the backup
+__default_server[ 'COGSERVER_BACKUP_PAGES' ] = int(os.environ.get( 'COGSERVER_BACKUP_PAGES', 256 )) # pages copied at a time, 0 for all at once
 __default_server[ 'COGSERVER_MAINTENANCE_INTERVAL' ] = int(os.environ.get( 'COGSERVER_MAINTENANCE_INTERVAL', 60 * 60 * 8 )) # 8 hours
+__default_server[ 'COGSERVER_SANDBOX_WORKERS' ] = int(os.environ.get( 'COGSERVER_SANDBOX_WORKERS', 4 )) # concurrent sandbox processes
+__default_server[ 'COGSERVER_SANDBOX_REUSE' ] = int(os.environ.get( 'COGSERVER_SANDBOX_REUSE', 0 )) # 1 to keep worker processes per user
+__default_server[ 'COGSERVER_SANDBOX_MAX_RUNNABLES' ] = int(os.environ.get( 'COGSERVER_SANDBOX_MAX_RUNNABLES', 100 )) # recycle a reused worker after this many runnables
+__default_server[ 'COGSERVER_SANDBOX_MAX_MEMORY' ] = int(os.environ.get( 'COGSERVER_SANDBOX_MAX_MEMORY', 512 )) # MB, recycle a reused worker above this size
+__default_server[ 'COGSERVER_DISPATCH_WORKERS' ] = int(os.environ.get( 'COGSERVER_DISPATCH_WORKERS', 8 )) # submissions scheduled concurrently
+__default_server[ 'COGSERVER_DISPATCH_PER_USER' ] = int(os.environ.get( 'COGSERVER_DISPATCH_PER_USER', 4 )) # per user, 0 is unlimited
+__default_server[ 'COGSERVER_DISPATCH_BATCH' ] = int(os.environ.get( 'COGSERVER_DISPATCH_BATCH', 64 )) # submissions fetched per scheduling pass
+__default_server[ 'COGSERVER_CONTEXT_CACHE_SIZE' ] = int(os.environ.get( 'COGSERVER_CONTEXT_CACHE_SIZE', 256 )) # loaded submission documents kept in memory
+__default_server[ 'COGSERVER_CONTEXT_CACHE_MEMORY' ] = int(os.environ.get( 'COGSERVER_CONTEXT_CACHE_MEMORY', 512 )) # MB, estimated
+__default_server[ 'COGSERVER_LOG_FLUSH_SIZE' ] = int(os.environ.get( 'COGSERVER_LOG_FLUSH_SIZE', 256 )) # log entries written per batch
+__default_server[ 'COGSERVER_LOG_FLUSH_INTERVAL' ] = int(os.environ.get( 'COGSERVER_LOG_FLUSH_INTERVAL', 1000 )) # ms, longest delay of a queued log entry
+__default_server[ 'COGSERVER_LOG_QUEUE_SIZE' ] = int(os.environ.get( 'COGSERVER_LOG_QUEUE_SIZE', 10000 )) # log entries queued before writers wait
+__default_server[ 'COGSERVER_LOG_FLUSH_TIMEOUT' ] = int(os.environ.get( 'COGSERVER_LOG_FLUSH_TIMEOUT', 10000 )) # ms, longest wait of a log query for the queued entries
+__default_server[ 'COGSERVER_LOG_SYNC' ] = int(os.environ.get( 'COGSERVER_LOG_SYNC', 0 )) # 1 to wait for each log entry to be committed
 
 #######################################
 #
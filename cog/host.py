@@ -16,6 +16,8 @@
 # 
 #####################################################################
 
+import socket
+import time
 import traceback
 
 try: # version-proof
@@ -31,19 +33,108 @@ from . import pr
 from .pr import source
 from . import auth
 from . import objport 
+from . import zjson
+from .server import _make_proxy
+
+class LogWriter( object ):
+    """File-like object sending what is written to the log of an execution on the server,
+    once flush_size characters are waiting or flush_interval seconds after the last send.
+    
+    There is no thread involved (a ServerProxy is not thread-safe), the triggers are checked 
+    when something is written.  Text that could not be sent is kept, see get_unsent(), 
+    streaming stops after SEND_FAILURES network errors in a row and the rest goes with the results.
+    It serves as the buffer of a capture.StreamCapture, nothing else keeps a copy of the output."""
+    
+    SEND_FAILURES = 3
+    
+    def __init__( self, proxy, execid, session, flush_size, flush_interval ):
+        self._proxy = proxy
+        self._execid = execid
+        self._session = session # auth.ClientSession
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        self._text = []
+        self._size = 0
+        self._last = time.time()
+        self._supported = True
+        self._sending = False
+        self._failures = 0
+        
+    def write( self, b ) :
+        b = capture.cast( b )
+        self._text.append( b )
+        self._size += len( b )
+        self.flush()
+        
+    def flush( self ) :
+        "sends the text if a trigger is reached"
+        if self._size >= self._flush_size or time.time() - self._last >= self._flush_interval :
+            self.send()
+        
+    def close( self ) :
+        self.send()
+        
+    def send( self ) :
+        "sends the text now, returns True if nothing is left unsent"
+        if self._text and self._supported and not self._sending :
+            count = len( self._text )
+            text = capture.cast('').join( self._text )
+            self._sending = True # anything printed while sending stays in the buffer
+            try:
+                usercred = self._session.get_credentials( self._proxy, 'append_log' )
+                self._proxy.append_log( usercred, self._execid, text ) # authenticated
+                del self._text[:count]
+                self._size -= len( text )
+                self._failures = 0
+            except xmlrpc_lib.Fault :
+                self._supported = False # older server, everything will go with the results
+            except ( socket.error, IOError, xmlrpc_lib.ProtocolError ) :
+                # try again at the next trigger, keep the text meanwhile
+                self._failures += 1
+                if self._failures >= self.SEND_FAILURES :
+                    self._supported = False
+            except:
+                self._supported = False # not a network problem, do not try again
+                raise
+            finally:
+                self._sending = False
+            self._last = time.time()
+        return not self._text
+        
+    def get_unsent( self ) :
+        return capture.cast('').join( self._text )
+        
+    def getvalue( self ) :
+        return self.get_unsent()
+        
 
 # to be run in a sandbox only!
 def run( execid, config=None ):
-    newdoc, log, exc = [], [], None
+    newdoc, exc = [], None
     
     c = config if config else conf.get_default_config()
     
     server, uid = execid.split('#',1)
-    p = xmlrpc_lib.ServerProxy(server, allow_none=True )
+    # a stalled server must not hang the job, every call (append_log included) times out:
+    p = _make_proxy( server, c.get( 'COG_RPC_TIMEOUT', 60 ))
+    
+    # one session authenticates all the calls below, without a nonce round trip each:
+    session = auth.ClientSession( auth.get_username(), c )
+    # documents travel packed if the server can take them:
+    try:
+        packed = zjson.FORMAT in p.get_capabilities().get( 'documents', [] )
+    except xmlrpc_lib.Fault :
+        packed = False
+    if packed :
+        doc, nodes = p.request_work_packed( session.get_credentials( p, 'request_work_packed' ), execid ) # authenticated
+        doc = zjson.unpack( doc )
+    else:
+        doc, nodes = p.request_work( session.get_credentials( p, 'request_work' ), execid ) # authenticated
     
-    servernonce = p.get_nonce() 
-    usercred = auth.get_user_credentials( auth.get_username(), config, servernonce )
-    doc, nodes = p.request_work( tuple(usercred), execid ) # authenticated
+    # node output goes to the server as it is available:
+    logwriter = LogWriter( p, execid, session,
+                           c.get( 'COG_LOG_FLUSH_SIZE', 64 * 1024 ),
+                           c.get( 'COG_LOG_FLUSH_INTERVAL', 5000 ) / 1000.0 )
     
     if doc and nodes :
         ccnctx = ccn.Context( c )
@@ -51,7 +142,7 @@ def run( execid, config=None ):
     
         for nodename in nodes :
             # catch streams:
-            with capture.StreamCapture() as output:
+            with capture.StreamCapture( logwriter ):
                 try :
                     nodeobj = ccnctx.get_obj( 'node', nodename )
                     ccxctx = ccx.Context( nodeobj, ccnctx )
@@ -93,11 +184,9 @@ def run( execid, config=None ):
                     # record resulting exception:
                     exc = traceback.format_exc()
                     break # for each node
-                
-            log.extend( output.getvalue() ) # @@ SHOULD WRITE BACK LOGS AS THEY ARE AVAILABLE.
             
-        servernonce = p.get_nonce() 
-        usercred = auth.get_user_credentials( usercred.username, config, servernonce )
-        p.apply_results( tuple(usercred), execid, newdoc, '\n'.join(log), exc ) # authenticated
+        # whatever could not be streamed goes with the results:
+        logwriter.send()
+        p.apply_results( session.get_credentials( p, 'apply_results' ), execid, zjson.pack( newdoc ) if packed else newdoc, logwriter.get_unsent(), exc ) # authenticated
     return
 
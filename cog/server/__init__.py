@@ -32,10 +32,7 @@ import traceback
 import json
 import itertools
 import zlib
-
-# -------------------------------------------------------------------
-
-# TODO : version 2.0, find a way of executing multiple sandboxes, for long-lived jobs.
+import heapq
 
 # -------------------------------------------------------------------
 
@@ -44,11 +41,6 @@ try: # version-proof
 except ImportError :
     import xmlrpc.client as xmlrpc_lib
 
-try:
-  import Queue as queue
-except ImportError :
-   import queue
-
 # -------------------------------------------------------------------    
 
 from .. import auth # cog authentication
@@ -58,6 +50,7 @@ from ..pr import session
 from .. import ccn
 from .. import ccs
 from .. import insp 
+from .. import zjson
 
 
 # -------------------------------------------------------------------
@@ -65,21 +58,100 @@ from .. import insp
 from .data import database
 from . import sandbox
 from . import sql
+from . import dispatch
+from . import contextcache
+from . import logsink
+from . import noncecache
+from . import sessioncache
 
 # -------------------------------------------------------------------
 
 # things that we probably don't want to expose to configuration:
 
 NONCE_EXPIRY = 60 # seconds
-NONCE_CACHE_LIMIT = 4096
+NONCE_CACHE_LIMIT = 65536 # nonces waiting to be used, a few MB at most
+SESSION_EXPIRY = 60 * 10 # seconds
+SESSION_CACHE_LIMIT = 65536
 
-SCHEDULE_INTERVAL = 2 # seconds
+# the scheduler is woken by submissions and results, 
+# the interval is only a safety net sweep:
+SCHEDULE_INTERVAL = 60 # seconds
 SCHEDULE_BEGIN = 30
 
+# loaded ccn contexts take roughly this many times the size of their compressed document:
+CONTEXT_SIZE_RATIO = 20
+
 BACKUP_BEGIN = 60 * 5
 MAINTENANCE_BEGIN = 60 * 2
+ARCHIVE_BEGIN = 60 * 10
+
+# finished submissions moved to the archives per transaction:
+ARCHIVE_BATCH = 100
+
+# rows per page of get_submission_page, by default and at most:
+SUBMISSION_PAGE_SIZE = 100
+SUBMISSION_PAGE_LIMIT = 1000
+
+# changes per call of get_changes, at most:
+CHANGE_PAGE_LIMIT = 1000
+
+# methods which are variants of another, and share its permissions:
+PERMISSION_ALIASES = { 'request_work_packed' : 'request_work' }
+
+# -------------------------------------------------------------------    
+
+try: # version-proof
+    _getargspec = inspect.getfullargspec
+except AttributeError :
+    _getargspec = inspect.getargspec
+
+def _get_arg_index( fn, argname ):
+    # position of the argument in the *args of a bound call (self excluded)
+    return _getargspec( fn ).args.index( argname ) - 1
+
+# -------------------------------------------------------------------    
+
+class _Plan( object ):
+    "how to marshal calls to a server method, worked out once when the method is decorated"
+    def __init__( self, fn ):
+        self.fn = fn
+        self.name = fn.__name__
+        self.user_index = _get_arg_index( fn, 'user' )
+        args = _getargspec( fn ).args
+        self.submid_index = _get_arg_index( fn, 'submid' ) if 'submid' in args else None
+        self.document_index = _get_arg_index( fn, 'document' ) if 'document' in args else None
+
+# -------------------------------------------------------------------    
+
+# the client keeps one ServerProxy per server and per thread, their transports
+# keep the connection alive between calls (python >= 2.7) and apply a timeout:
+
+class _Transport( xmlrpc_lib.Transport ):
+    def __init__( self, timeout ):
+        xmlrpc_lib.Transport.__init__( self )
+        self._timeout = timeout
+
+    def make_connection( self, host ):
+        conn = xmlrpc_lib.Transport.make_connection( self, host )
+        conn.timeout = self._timeout
+        return conn
+
+class _SafeTransport( xmlrpc_lib.SafeTransport ):
+    def __init__( self, timeout ):
+        xmlrpc_lib.SafeTransport.__init__( self )
+        self._timeout = timeout
+
+    def make_connection( self, host ):
+        conn = xmlrpc_lib.SafeTransport.make_connection( self, host )
+        conn.timeout = self._timeout
+        return conn
 
-# @@ how to purge old submissions from the database?
+def _make_proxy( server, timeout ):
+    if server.lower().startswith( 'https:' ):
+        transport = _SafeTransport( timeout )
+    else:
+        transport = _Transport( timeout )
+    return xmlrpc_lib.ServerProxy( server, transport=transport, allow_none=True )
 
 # -------------------------------------------------------------------    
 #    
@@ -91,6 +163,9 @@ MAINTENANCE_BEGIN = 60 * 2
 # our attempts at simplifying the parameters associated with authentication.
 #
 class ClientBase( object ) :
+
+    _specific = {} # method name -> _Plan, of the methods that can be batched
+    _batch = None # _Plan of the batch method
   
     def __init__( self, confdict, notifier=None ):
         server_list = [x.strip() for x in confdict['COG_SERVERS'].split(',')]
@@ -101,6 +176,30 @@ class ClientBase( object ) :
         self._server_num = random.randint( 0, self._server_bound-1) 
         self._notifier = notifier
         self._conf = confdict
+        self._sessions = {} # (server, username) -> auth.ClientSession
+        self._sessionlock = threading.Lock()
+        self._timeout = confdict.get( 'COG_RPC_TIMEOUT', 60 )
+        self._local = threading.local() # proxies and last errors of the calling thread
+        self._fanout = dispatch.Fanout() # one thread per server, the calls to a server take turns
+        self._capabilities = {} # server -> result of get_capabilities
+
+    # ===========================================
+
+    def close( self ):
+        "stops the threads calling the servers, they start again if the client is used after"
+        self._fanout.shutdown()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def __del__( self ):
+        try:
+            self.close()
+        except:
+            pass # partly built, or interpreter shutdown
 
     # ===========================================
           
@@ -112,6 +211,41 @@ class ClientBase( object ) :
         return ret
     
     # ===========================================
+
+    def _remove_server( self, server ):
+        if self._notifier :
+            self._notifier( server ) # flash the red lights
+        if server in self._server_list :
+            self._server_list.remove( server )
+        self._server_bound = len( self._server_list )
+        self._server_num = 0
+
+    # ===========================================
+
+    def _get_proxy( self, server ):
+        # ServerProxy is not thread-safe, each thread keeps its own
+        proxies = getattr( self._local, 'proxies', None )
+        if proxies is None :
+            proxies = self._local.proxies = {}
+        if server not in proxies :
+            proxies[ server ] = _make_proxy( server, self._timeout )
+        return proxies[ server ]
+
+    # -------------------------------------------
+
+    def _drop_proxy( self, server ):
+        # after a socket error, the next call starts with a fresh connection
+        proxies = getattr( self._local, 'proxies', None )
+        if proxies :
+            proxies.pop( server, None )
+
+    # ===========================================
+
+    def get_last_errors( self ):
+        "returns {server: exception} for the servers that failed the last call to all servers made by this thread"
+        return getattr( self._local, 'errors', {} )
+
+    # ===========================================
     
     def _get_user( self, user_index, args, kwargs ):
         if len( args ) > user_index :
@@ -130,8 +264,7 @@ class ClientBase( object ) :
         newargs = args
         newkw = kwargs
         if len( args ) > user_index :
-            newargs = list( args )
-            newargs[ user_index ] = user
+            newargs = args[:user_index] + (user,) + args[user_index+1:]
         else:
             raise TypeError( 'Unable to attach authentication argument' )
         
@@ -140,78 +273,112 @@ class ClientBase( object ) :
 
     # ===========================================
     
+    def _get_session( self, server, username ):
+        self._sessionlock.acquire()
+        try:
+            key = (server, username)
+            if key not in self._sessions :
+                self._sessions[ key ] = auth.ClientSession( username, self._conf )
+            return self._sessions[ key ]
+        finally:
+            self._sessionlock.release()
+            
+    # ===========================================
+    
+    def _get_capabilities( self, p, server ):
+        if server not in self._capabilities :
+            try:
+                self._capabilities[ server ] = p.get_capabilities()
+            except xmlrpc_lib.Fault :
+                self._capabilities[ server ] = {} # a server from before the capabilities
+        return self._capabilities[ server ]
+
+    # -------------------------------------------
+
+    def _pack_document( self, p, server, plan, args ):
+        # documents go packed to the servers which accept them
+        i = plan.document_index
+        if i is None or len( args ) <= i or zjson.is_packed( args[i] ):
+            return args
+        if zjson.FORMAT not in self._get_capabilities( p, server ).get( 'documents', [] ):
+            return args
+        return args[:i] + (zjson.pack( args[i] ),) + args[i+1:]
+
+    # ===========================================
+    
+    def _call_authenticated( self, p, server, plan, args, kwargs ):
+        # security protocol replaces username with a full user-credential object:
+        session = self._get_session( server, self._get_user( plan.user_index, args, kwargs ))
+        args = self._pack_document( p, server, plan, tuple( args ))
+        while True :
+            opened = session.is_open()
+            user = session.get_credentials( p, plan.name )
+            newargs, newkw = self._set_user( plan.user_index, user, args, kwargs )
+            try:
+                # Be careful here, if you mess this call up, you'll be calling the
+                # local definition of the server method, not the method on the remote server!
+                return p.__getattr__(plan.name)(*newargs, **newkw) # do the function call
+            except xmlrpc_lib.Fault as e :
+                # only a call the server refused for its session did not run, any other fault stands:
+                if not opened or e.faultCode != auth.SESSION_FAULT :
+                    raise
+                session.reset() # the server has forgotten the session (restarted?), try once more with a new one
+    
+    # ===========================================
+    
     # if a server fails, then send email and remove it from the list!
-    def _call_one( self, method, *args, **kwargs ):
+    def _call_one( self, plan, args, kwargs ):
         server = self._pick_one()
         ret = None
         try:
-            p = xmlrpc_lib.ServerProxy(server, allow_none=True )
-            name = method.__name__
-            
-            argspec = inspect.getargspec(method)
-            user_index = argspec.args.index( 'user' ) - 1 
-            
-            # security protocol replaces username with a full user-credential object:
-            servernonce = p.get_nonce()
-            username = self._get_user( user_index, args, kwargs )
-            user = tuple( auth.get_user_credentials( username, self._conf, servernonce ))
-            newargs, newkw = self._set_user( user_index, user, args, kwargs )
-            
-            # Be careful here, if you mess this call up, you'll be calling the
-            # local definition of the server method, not the method on the remote server!
-            ret = p.__getattr__(name)(*newargs, **newkw) # do the function call
+            p = self._get_proxy( server )
+            ret = self._call_authenticated( p, server, plan, args, kwargs )
             
         except socket.error :
-            if self._notifier :
-                self._notifier( server ) # flash the red lights
-            self._server_list.remove( server )
-            self._server_bound = len( self._server_list )
-            self._server_num = 0
+            self._drop_proxy( server )
+            self._remove_server( server )
             if not self._server_list:
                 raise # pass the socket.error on up
-            return self._call_one( method, *args, **kwargs )
+            return self._call_one( plan, args, kwargs )
         return ret
 
     # ===========================================
         
-    def _call_all( self, method, *args, **kwargs ):
-        ret = {}
-        
-        # would be lovely to execute in parallel:
-        for server in self._server_list :
+    def _call_all( self, plan, args, kwargs ):
+        # every server is called at once, each from its own thread (and kept alive connection),
+        # returns the results of the servers that answered, see get_last_errors() for the others:
+        def call( server ):
+            p = self._get_proxy( server )
             try:
-                p = xmlrpc_lib.ServerProxy(server, allow_none=True )
-                name = method.__name__
-                
-                argspec = inspect.getargspec(method)
-                user_index = argspec.args.index( 'user' ) - 1
-                
-                # security protocol replaces username with a full user-credential object:
-                servernonce = p.get_nonce()
-                username = self._get_user( user_index, args, kwargs )
-                user = tuple( auth.get_user_credentials( username, self._conf, servernonce ))
-                newargs, newkw = self._set_user( user_index, user, args, kwargs )
-                
-                # Be careful here, if you mess this call up, you'll be calling the
-                # local definition of the server method, not the method on the remote server!
-                ret[ server ] = p.__getattr__(name)( *newargs, **newkw) # do the function call
-
+                return self._call_authenticated( p, server, plan, args, kwargs )
             except socket.error :
-                if self._notifier :
-                    self._notifier( server ) # flash the red lights
-                self._server_list.remove( server )
-                self._server_bound = len( self._server_list )
-                self._server_num = 0
-                raise # pass the socket.error on up
+                self._drop_proxy( server )
+                raise
 
+        ret = {}
+        errors = {}
+        first = None
+        for server, ok, value in self._fanout.map( call, list( self._server_list )):
+            if ok :
+                ret[ server ] = value
+            else:
+                errors[ server ] = value
+                first = value if first is None else first
+                if isinstance( value, socket.error ) and not isinstance( value, socket.timeout ) :
+                    self._remove_server( server ) # a slow server is reported, not dropped
+        self._local.errors = errors
+
+        if errors and not ret :
+            raise first # every server failed
         return ret
 
     # ===========================================
       
     @classmethod
     def _rpc_one( cls, fn ):
+        plan = _Plan( fn )
         def api( client, *args, **kwargs ):
-            return client._call_one( fn, *args, **kwargs )
+            return client._call_one( plan, args, kwargs )
         
         api.__doc__ = fn.__doc__
         setattr( cls, fn.__name__, api )  
@@ -221,8 +388,9 @@ class ClientBase( object ) :
       
     @classmethod
     def _rpc_all( cls, fn ):
+        plan = _Plan( fn )
         def api( client, *args, **kwargs ):
-            return client._call_all( fn, *args, **kwargs )
+            return client._call_all( plan, args, kwargs )
             
         api.__doc__ = fn.__doc__
         setattr( cls, fn.__name__, api )  
@@ -232,31 +400,81 @@ class ClientBase( object ) :
     
     @classmethod
     def _rpc_specific( cls, fn ):
-        argspec = inspect.getargspec(fn)
-        submid_index = argspec.args.index( 'submid' ) - 1
-        user_index = argspec.args.index( 'user' ) - 1
+        plan = _Plan( fn )
+        cls._specific[ plan.name ] = plan
         
         def api( client, *args, **kwargs ):
-            submid = args[submid_index]
+            submid = args[plan.submid_index]
             server, server_submid = submid.split( '#', 1 )
 
-            p = xmlrpc_lib.ServerProxy(server, allow_none=True )
-            method = p.__getattr__(fn.__name__)                
-                
-            # security protocol replaces username with a full user-credential object:
-            username = client._get_user( user_index, args, kwargs )
-            servernonce = p.get_nonce()
-            user = tuple( auth.get_user_credentials( username, client._conf, servernonce ))
-            newargs, newkw = client._set_user( user_index, user, args, kwargs )
-
-            # Be careful here, if you mess this call up, you'll be calling the
-            # local definition of the server method, not the method on the remote server!    
-            return method(*newargs, **newkw) # do the function call
+            p = client._get_proxy( server )
+            try:
+                return client._call_authenticated( p, server, plan, args, kwargs )
+            except socket.error :
+                client._drop_proxy( server )
+                raise
           
         api.__doc__ = fn.__doc__
         setattr( cls, fn.__name__, api )
         return fn
 
+    # ===========================================
+
+    @classmethod
+    def _rpc_batch( cls, fn ):
+        # the client side is ClientBase.batch:
+        cls._batch = _Plan( fn )
+        return fn
+
+    # -------------------------------------------
+
+    def batch( self, user, calls ):
+        """Calls several submission specific methods (e.g. get_submission) at once.
+        calls is a list of (methodname, args) with args as given to the method after user,
+        returns the results in the order of calls, with an exception in place of the result
+        of a call that failed.  One request is made per server involved, authenticated once."""
+        groups = {} # server -> [position], [[methodname, args]]
+        for i, (name, args) in enumerate( calls ):
+            if name not in self._specific :
+                raise ValueError( '%s cannot be batched' % name )
+            plan = self._specific[ name ]
+            args = list( args )
+            args.insert( plan.user_index, None ) # the server puts the credentials of the batch in there
+            server = args[ plan.submid_index ].split( '#', 1 )[0]
+            positions, servercalls = groups.setdefault( server, ([], []) )
+            positions.append( i )
+            servercalls.append( [name, args] )
+
+        def call( server ):
+            p = self._get_proxy( server )
+            try:
+                return self._call_authenticated( p, server, self._batch, (user, groups[ server ][1]), {} )
+            except socket.error :
+                self._drop_proxy( server )
+                raise
+
+        ret = [ None ] * len( calls )
+        errors = {}
+        first = None
+        for server, ok, value in self._fanout.map( call, sorted( groups.keys() )):
+            positions = groups[ server ][0]
+            if ok :
+                for i, result in zip( positions, value ):
+                    if isinstance( result, dict ) :
+                        ret[ i ] = xmlrpc_lib.Fault( result['faultCode'], result['faultString'] )
+                    else:
+                        ret[ i ] = result[0]
+            else:
+                errors[ server ] = value
+                first = value if first is None else first
+                for i in positions :
+                    ret[ i ] = value
+        self._local.errors = errors
+
+        if errors and len( errors ) == len( groups ) :
+            raise first # every server failed
+        return ret
+
 # -------------------------------------------------------------------
 
 #
@@ -266,12 +484,12 @@ class ClientBase( object ) :
 # requires that the method has a parameter 'user' which is a UserCredentials object
 #
 def _authorized(fn):
-    argspec = inspect.getargspec(fn)
-    user_index = argspec.args.index( 'user' ) - 1
+    name = fn.__name__
+    user_index = _get_arg_index( fn, 'user' )
 
     def wrapper(server, *args, **kwargs):
       user = args[user_index]      
-      if server._auth_user_method( user, fn.__name__ ):
+      if server._auth_user_method( user, name ):
         return fn(server, *args, **kwargs) # do the original function call
       
       return None
@@ -299,6 +517,51 @@ def load_document( ccnctx, document ):
     ccnctx.load_doc( document )
     return ccnctx
 
+# -------------------------------------------------------------------   
+
+# to be executed in a sandbox only!
+def apply_document( ccnctx, document ):
+    # applies more of a document (e.g. set operations) to an already loaded ccn
+    ccnctx.get_validated_view( document )
+    return ccnctx
+
+# -------------------------------------------------------------------   
+
+def _flatten_document( document, out ):
+    # execution documents are appended as nested lists
+    if isinstance( document, list ):
+        for x in document :
+            _flatten_document( x, out )
+    else:
+        out.append( document )
+    return out
+
+def compact_document( document ):
+    """Merges consecutive set operations of a document into one, later values winning.
+    Loading the result is equivalent to loading the original document, but the
+    size no longer grows with the number of executions that have reported results."""
+    ret = []
+    block = None # the set values at the end of ret, if any
+    for x in _flatten_document( document, [] ):
+        if not ( isinstance( x, dict ) and list( x.keys() ) == ['set'] and isinstance( x['set'], dict )) :
+            ret.append( x )
+            block = None
+            continue
+        for k in x['set'] :
+            if block is not None :
+                # setting an attribute overrides earlier settings within it:
+                for j in [ j for j in block if j.startswith( k + '.' ) ] :
+                    del block[ j ]
+                # but a dictionary does not keep order, so a setting within
+                # an attribute that is already set has to come afterwards:
+                if any( k.startswith( j + '.' ) for j in block ) :
+                    block = None
+            if block is None :
+                block = {}
+                ret.append( { 'set' : block } )
+            block[ k ] = x['set'][ k ]
+    return ret
+
 # -------------------------------------------------------------------
 
 # XMLRPC App, launches a sidecar process (sandbox) immediately,
@@ -337,13 +600,20 @@ class ServerApp :
 
         # ---------------------------------------
         
-        # create sandbox before 
-        self._sandbox = sandbox.Sandbox() # separate process(es) for safe running of user code
+        # create sandbox before any threads are started:
+        # separate processes for safe running of user code,
+        # independent runnables execute concurrently.
+        self._sandbox = sandbox.SandboxPool( 
+            self._parm['COGSERVER_SANDBOX_WORKERS'],
+            bool( self._parm['COGSERVER_SANDBOX_REUSE'] ),
+            self._parm['COGSERVER_SANDBOX_MAX_RUNNABLES'],
+            self._parm['COGSERVER_SANDBOX_MAX_MEMORY'] * 1024 * 1024,
+            self._logger )
         
         # ---------------------------------------
         
-        self._noncecache = {}
-        self._noncelock =  threading.Lock()
+        self._noncecache = noncecache.NonceCache( NONCE_EXPIRY, NONCE_CACHE_LIMIT )
+        self._sessions = sessioncache.SessionCache( SESSION_EXPIRY, SESSION_CACHE_LIMIT )
         
         # ---------------------------------------
         
@@ -351,8 +621,8 @@ class ServerApp :
         
         # ---------------------------------------
         
-        database.check_database(self._parm['COGSERVER_DATABASE'], sql.DATABASE_SCHEMA_LIST)
-        self._db = database.Database(self._parm['COGSERVER_DATABASE'], sql.DATABASE_BEGIN)
+        database.check_database(self._parm['COGSERVER_DATABASE'], sql.DATABASE_SCHEMA_LIST + sql.CHANGE_SCHEMA_LIST, self._logger, sql.MIGRATIONS) # builds or upgrades
+        self._db = database.Database(self._parm['COGSERVER_DATABASE'], sql.DATABASE_BEGIN, cache_connection=True) # one connection per thread
         
         # ---------------------------------------
         
@@ -360,13 +630,48 @@ class ServerApp :
         
         # ---------------------------------------
         
-        # set up the task queue and get it going:
-        self._taskq = queue.PriorityQueue() # tuple (datetime, method, parameters)
+        # loaded documents of submissions in progress:
+        self._ctxcache = contextcache.ContextCache(
+            self._parm['COGSERVER_CONTEXT_CACHE_SIZE'],
+            self._parm['COGSERVER_CONTEXT_CACHE_MEMORY'] * 1024 * 1024 )
+        
+        # ---------------------------------------
+        
+        # log entries are written behind the requests, in batches:
+        self._logsink = logsink.LogSink(
+            self._db,
+            sql.INSERT_LOG,
+            self._encode_log,
+            self._parm['COGSERVER_LOG_FLUSH_SIZE'],
+            self._parm['COGSERVER_LOG_FLUSH_INTERVAL'] / 1000.0,
+            self._parm['COGSERVER_LOG_QUEUE_SIZE'],
+            self._parm['COGSERVER_LOG_SYNC'],
+            self._logger )
+        
+        # ---------------------------------------
+        
+        # threads that load, schedule and launch eligible submissions concurrently,
+        # each one finished makes room for more, so wake the scheduler:
+        self._dispatcher = dispatch.Dispatcher( 
+            self._parm['COGSERVER_DISPATCH_WORKERS'],
+            self._parm['COGSERVER_DISPATCH_PER_USER'],
+            self._wake_scheduler,
+            self._logger )
+        
+        # ---------------------------------------
+        
+        # set up the task timer heap and get it going:
+        self._taskheap = [] # tuple (time, unique key, method name, parameters)
+        self._taskpending = {} # (method name, parameters) -> time, the earliest pending call
+        self._taskcond = threading.Condition()
+        self._taskstop = False
+        self._backup_thread = None # the backup in progress, if any
         # queue up the tasks for the first time:
         self._task(BACKUP_BEGIN, "_task_backup", (self._parm['COGSERVER_BACKUP_INTERVAL'],))
         self._task(SCHEDULE_BEGIN, "_task_schedule", (SCHEDULE_INTERVAL,))
         self._task(MAINTENANCE_BEGIN, "_task_maintenance", (self._parm['COGSERVER_MAINTENANCE_INTERVAL'],))
-        # one consumer thread implies that no locks are required.
+        self._task(ARCHIVE_BEGIN, "_task_archive", (self._parm['COGSERVER_CLEANUP_INTERVAL'],))
+        # one consumer thread implies that tasks never run concurrently with each other.
         self._task_consumer = threading.Thread(target=getattr(self,'_consume_tasks'))
         self._task_consumer.daemon = True
         self._task_consumer.start() 
@@ -378,47 +683,75 @@ class ServerApp :
     # below are the private calls to manage periodic processes
     #
     def _task(self, sec_from_now, name, args):
-        # use this to queue work for the consumer thread
-        now = datetime.datetime.now()
-        when = now + datetime.timedelta(seconds=sec_from_now)
-        method = getattr(self,name)
-        unique_key = os.urandom(8)
-        self._taskq.put(((when, now, unique_key), method, args))
+        # use this to queue work for the consumer thread.
+        # identical calls (same method and parameters) are coalesced, the earliest one wins,
+        # which removes redundant calls (which might occur on bulk loading)
+        when = time.time() + sec_from_now
+        key = (name, tuple(args))
+        self._taskcond.acquire()
+        try:
+            pending = self._taskpending.get(key)
+            if pending is None or when < pending :
+                self._taskpending[key] = when
+                heapq.heappush(self._taskheap, (when, os.urandom(8), name, key[1]))
+                self._taskcond.notify()
+        finally:
+            self._taskcond.release()
         return
 
 
+    def _wake_scheduler(self):
+        # pull the next scheduling sweep forward to now
+        self._task(0, '_task_schedule', (SCHEDULE_INTERVAL,))
+
+
+    def _stop_tasks(self):
+        # the consumer thread returns once the task in progress (if any) is done
+        self._taskcond.acquire()
+        try:
+            self._taskstop = True
+            self._taskcond.notify()
+        finally:
+            self._taskcond.release()
+
+
+    def _next_task(self):
+        # blocks until a task is due, does not poll.  Returns None once the tasks are stopped.
+        self._taskcond.acquire()
+        try:
+            while True:
+                if self._taskstop :
+                    return None
+                if not self._taskheap :
+                    self._taskcond.wait()
+                    continue
+                when, unique_key, name, args = self._taskheap[0]
+                if self._taskpending.get((name, args)) != when :
+                    heapq.heappop(self._taskheap) # superseded by an earlier identical call
+                    continue
+                delay = when - time.time()
+                if delay > 0 :
+                    self._taskcond.wait(delay)
+                    continue
+                heapq.heappop(self._taskheap)
+                del self._taskpending[(name, args)]
+                return name, args
+        finally:
+            self._taskcond.release()
+
+
     def _consume_tasks(self):
         # do not call this directly, this is used by the consumer thread.
-        # one thread consuming tasks, implies that no locks are required.
         while True:
-            item = self._taskq.get()
-            self._taskq.task_done()
-            
-            count = 0
-            
-            # remove redundant calls (which might occur on bulk loading)
-            # minimizes some kinds of bottlenecks, esp when failures are occurring
-            if not self._taskq.empty() :
-                do_removals = True
-                while do_removals:
-                    next_item = self._taskq.get()
-                    self._taskq.task_done()
-                    count += 1
-                    if (next_item[1] != item[1]) or (next_item[2] != item[2]) :
-                        self._taskq.put(next_item)
-                        do_removals = False
-                        count -= 1
-            
-            if count > 0 :
-                self._logger.debug('Skip redundant operations (%d)' % count)
-            
-            if item[0][0] > datetime.datetime.now() :
-                self._taskq.put(item)
-                time.sleep(0.5)
-            else:
-                method = item[1]
-                args = item[2]
-                method(*args)
+            task = self._next_task()
+            if task is None :
+                return
+            name, args = task
+            try:
+                getattr(self, name)(*args)
+            except:
+                self._logger.error('Exception in task %s' % name)
+                self._logger.error(traceback.format_exc())
 
     # -------------------------------------------------------------------------
     
@@ -434,6 +767,9 @@ class ServerApp :
             db.sql_update(sql.ANALYZE, [])
             db.sql_end()     
             self._logger.info('End database maintenance')
+            for name, stats in sorted(self._db.get_transaction_stats().items()) :
+                self._logger.info('Transaction %s: %d (%d rolled back), %.3fs average, %.3fs max' % (
+                    name, stats['count'], stats['rollbacks'], stats['time'] / max(1, stats['count']), stats['max_time']))
         except:
             self._logger.error('Exception during database maintenance')
             self._logger.error(traceback.format_exc())
@@ -445,108 +781,236 @@ class ServerApp :
     # -------------------------------------------------------------------------
     
     def _task_backup(self, interval=-1):
+        # only starts the backup: copying the pages takes a while, and the consumer thread
+        # must keep scheduling and archiving meanwhile.  Backups never overlap.
+        try:
+            if self._backup_thread is not None and self._backup_thread.is_alive() :
+                self._logger.warning('Backup still in progress, skipped')
+            else:
+                self._backup_thread = threading.Thread(target=self._backup)
+                self._backup_thread.daemon = True
+                self._backup_thread.start()
+        finally:
+            if interval >= 0 :
+                self._task(interval, '_task_backup', (interval,))  
+        return
+
+    def _backup(self):
+        # runs in the backup thread: an online backup, the server carries on while the pages are copied
         try:
-            self._lock()
-            
             backup_path = self._parm['COGSERVER_BACKUPPATH']    
             datafile = self._parm['COGSERVER_DATABASE']
             filename = os.path.basename( datafile )
             
             if os.path.isfile(datafile):
                 self._logger.info('Backup: %s' % datafile)
-                backup_name = os.path.join(backup_path, '%s.sql.gz' % filename)
-                database.backup(datafile, backup_name)
-                self._logger.info('Backup Successful')
+                reported = [0]
+                def progress( done, total ):
+                    percent = (100 * done) // max( 1, total )
+                    if percent >= reported[0] + 10 or done == total :
+                        reported[0] = percent
+                        self._logger.info('Backup: %d%% of %d pages' % (percent, total))
+                        
+                backup_name = database.backup(
+                    datafile,
+                    os.path.join(backup_path, filename),
+                    self._parm['COGSERVER_BACKUP_COMPRESS'],
+                    self._parm['COGSERVER_BACKUP_PAGES'],
+                    progress )
+                self._logger.info('Backup Successful: %s' % backup_name)
                    
         except:
             self._logger.error('Exception during backup')
             self._logger.error(traceback.format_exc())
+        return
+    
+    # -------------------------------------------------------------------------
+    
+    def _get_archive_name(self, submid):
+        "the archive database of a submission (uid without the server), one per month of submission"
+        born = uid.get_datetime( uid.unpretty_print( submid ))
+        root, ext = os.path.splitext( os.path.basename( self._parm['COGSERVER_DATABASE'] ))
+        return os.path.join( self._parm['COGSERVER_ARCHIVEPATH'], '%s.%04d-%02d%s' % (root, born.year, born.month, ext or '.db'))
+    
+    def _get_archive_db(self, submid):
+        "returns a Database for the archive of the submission, None if there is no such archive"
+        try:
+            filename = self._get_archive_name( submid )
+        except:
+            return None # not a uid
+        if not os.path.isfile( filename ):
+            return None
+        return database.Database( filename, sql.DATABASE_BEGIN )
+    
+    def _task_archive(self, interval=-1):
+        # moves finished submissions older than COGSERVER_ARCHIVE_INTERVAL, with their 
+        # executions and logs, to the monthly archive databases
+        try:
+            limit = datetime.datetime.now() - datetime.timedelta( seconds=self._parm['COGSERVER_ARCHIVE_INTERVAL'] )
+            archived = 0
+            while True :
+                db = self._db.clone()
+                db.sql_begin_read()
+                try:
+                    rows = db.sql_selectall( sql.GET_ARCHIVABLE_SUBM, (limit, ARCHIVE_BATCH )) or []
+                finally:
+                    db.sql_end()
+                if not rows :
+                    break
+                    
+                months = {}
+                for row in rows :
+                    months.setdefault( self._get_archive_name( row[0] ), [] ).append( (row[0],) )
+                    
+                for filename in sorted( months ) :
+                    if not os.path.isdir( os.path.dirname( filename )):
+                        os.makedirs( os.path.dirname( filename ))
+                    database.check_database( filename, sql.DATABASE_SCHEMA_LIST, self._logger, sql.ARCHIVE_MIGRATIONS )
+                    submids = months[ filename ]
+                    with self._db.clone().transaction('archive') as db :
+                        db.sql_attach( filename, 'archive' )
+                        db.sql_updatemany( sql.ARCHIVE_SUBMISSION, submids )
+                        db.sql_updatemany( sql.ARCHIVE_EXECUTIONS, submids )
+                        db.sql_updatemany( sql.ARCHIVE_LOGS, [ (x[0], x[0]) for x in submids ] )
+                        db.sql_updatemany( sql.ARCHIVE_SNAPSHOT, submids )
+                        db.sql_updatemany( sql.PURGE_LOGS, [ (x[0], x[0]) for x in submids ] )
+                        db.sql_updatemany( sql.PURGE_EXECUTIONS, submids )
+                        db.sql_updatemany( sql.PURGE_SNAPSHOT, submids )
+                        db.sql_updatemany( sql.PURGE_SUBMISSION, submids )
+                    for submid in submids :
+                        self._ctxcache.discard( submid[0] )
+                    archived += len( submids )
+                    
+            if archived :
+                self._logger.info('Archived %d submissions' % archived)
+
+            # the change feed is kept as long as the finished submissions:
+            with self._db.clone().transaction('purge_changes') as db :
+                db.sql_update( sql.PURGE_CHANGES, (limit,) )
+        except:
+            self._logger.error('Exception during archival')
+            self._logger.error(traceback.format_exc())
         finally:
-            self._unlock()
             if interval >= 0 :
-                self._task(interval, '_task_backup', (interval,))  
+                self._task(interval, '_task_archive', (interval,)) 
         return
     
     # -------------------------------------------------------------------------
     
     def _task_schedule(self, interval=-1):
-        
+        # hand a batch of eligible submissions (in priority order) to the dispatcher.
+        # Submissions refused because of concurrency limits will be offered again 
+        # when the dispatcher finishes something and wakes the scheduler.
         try:
-            row = self._get_eligible_submission()
+            count = self._parm['COGSERVER_DISPATCH_BATCH'] + self._dispatcher.get_inflight()
+            for row in self._get_eligible_submissions( count ) :
+                if self._dispatcher.is_full() :
+                    break
+                submid = str( row[0] )
+                user = str( row[1] )
+                self._dispatcher.dispatch( submid, user, self._dispatch_submission, submid )
+        except:
+            self._logger.error( "Error in scheduling pass" )
+            self._logger.error( traceback.format_exc() )
+        finally:
+            if interval >= 0 :
+                self._task(interval, '_task_schedule', (interval,))  
+        return
 
-            while row :
-                
-                submid = str(row[0])
-                # @@ born = row[1]
-                # @@ priority = int(row[2])
-                # @@ title = str( row[3] )
-                user = str( row[4] )
-                email = str( row[5] )
-                document = self._decode_doc( row[6] )
-                nodelist = str( row[7] ).split( ',')
-                # @@ state = row[7]
-                
-                userid, groupid = self._auth.get_ids( user )
-                assert( userid != 0 )
-                assert( groupid != 0 )
-                
-                # apply changes from previous executions to this document: 
-                document.extend( self._get_exec_documents( submid ))
-                
-                # load the document in a sandbox because it could contain execute code blocks!
-                ccnctx = ccn.Context( self._parm )
+    # -------------------------------------------------------------------------
+    
+    def _dispatch_submission(self, submid):
+        # runs in a dispatcher thread: loads, schedules and launches the next session of a submission
+        user = ''
+        try:
+            row = self._get_submission_scheddata( submid )
+            if row is None :
+                return # dispatched from a stale scheduling pass, already running or finished
+            user = str( row[0] )
+            email = str( row[1] )
+            nodelist = str( row[3] ).split( ',')
             
-                runnable = sandbox.Runnable( userid, groupid, load_document, (ccnctx, document), {} )
-                result = self._sandbox.submit( runnable )
-                result = sandbox.RunResult( *result )
-                
-                if result.exc or not result.ret :
-                    raise SyntaxError( result.exc )
-                
-                ccnctx = result.ret # returned ccn with loaded document.
-        
-                nodeids = [ccnctx.get_obj( 'node', x ).cogid for x in nodelist ]
-                self._run_session( submid, user, email, ccnctx, nodeids )
-                
-                row = self._get_eligible_submission()
+            userid, groupid = self._auth.get_ids( user )
+            assert( userid != 0 )
+            assert( groupid != 0 )
+            
+            ccnctx = self._load_context( submid, userid, groupid, row[2] )
+    
+            nodeids = [ccnctx.get_obj( 'node', x ).cogid for x in nodelist ]
+            self._run_session( submid, user, email, ccnctx, nodeids )
                 
         except:
-            submid = str(row[0])
-            user = str( row[3] )
-            
             exc = traceback.format_exc()
             self._logger.error( "Error scheduling %s from %s" % (submid,user) )
             self._logger.error( exc )
             
-            db = self._db.clone()
             try:
-                db.sql_begin_write()
-                self._logger.error( 'fail task_schedule' + traceback.format_exc() ) # @@
-                db.sql_insert(sql.INSERT_EXECUTION, (submid,submid,datetime.datetime.now(),'','',sql.EXEC_STATE_NUM['fail'],'',exc))
-                db.sql_insert(sql.INSERT_LOG, (datetime.datetime.now(),submid,self._encode_log("Fail to read submission document")))
-                db.sql_update(sql.SUBMISSION_FAIL, (submid,))
+                with self._db.clone().transaction('fail_submission') as db :
+                    db.sql_insert(sql.INSERT_EXECUTION, (submid,submid,datetime.datetime.now(),'','',sql.EXEC_STATE_NUM['fail'],'',exc))
+                    db.sql_update(sql.SUBMISSION_FAIL, (submid,))
+                self._logsink.write( submid, "Fail to read submission document" )
             except:
                 self._logger.error( traceback.format_exc() )
-            finally:
-                db.sql_end()
 
-        if interval >= 0 :
-            self._task(interval, '_task_schedule', (interval,))  
         return
 
+    # -------------------------------------------------------------------------
+    
+    def _load_context( self, submid, userid, groupid, encoded_document ):
+        "returns the ccn context of the current document of the submission"
+        generation = self._get_snapshot_generation( submid )
+        ccnctx, deltas = self._ctxcache.get( submid, generation )
+        
+        if ccnctx is not None and not deltas :
+            return ccnctx
+        
+        if ccnctx is not None :
+            # only values were set since the context was cached:
+            # (still in a sandbox, set values are documents too)
+            runnable = sandbox.Runnable( userid, groupid, apply_document, (ccnctx, deltas), {} )
+            size = None # the size of a document that only had values set stays about the same
+        else:
+            # apply changes from previous executions to this document: 
+            generation, document, size = self._get_submission_document( submid, self._decode_doc( encoded_document ))
+            
+            # load the document in a sandbox because it could contain execute code blocks!
+            runnable = sandbox.Runnable( userid, groupid, load_document, (ccn.Context( self._parm ), document), {} )
+            
+        result = self._sandbox.submit( runnable )
+        
+        if result.exc or not result.ret :
+            self._ctxcache.discard( submid )
+            raise SyntaxError( result.exc )
+        
+        ccnctx = result.ret # returned ccn with loaded document.
+        self._ctxcache.put( submid, generation, ccnctx, size )
+        return ccnctx
+    
     # ===========================================
     
-    def _get_eligible_submission( self ):
-        row = None                      
+    def _get_eligible_submissions( self, count ):
+        rows = []
         db = self._db.clone() # necessary for threading with sqlite
         try:
             db.sql_begin_read()
-            # get a random row, so that a bad submission does not permanently clog the queue.
-            row = db.sql_selectrow(sql.GET_SCHEDULABLE_SUBM, [])
+            rows = db.sql_selectall(sql.GET_SCHEDULABLE_SUBM, (count,)) or []
         except:
-            self._logger.error( "Error selecting submission to schedule")
+            self._logger.error( "Error selecting submissions to schedule")
             self._logger.error(traceback.format_exc())
-            row = None
+            rows = []
+        finally:
+            db.sql_end()
+        return rows
+    
+    # -------------------------------------------------------------------------
+    
+    def _get_submission_scheddata( self, submid ):
+        row = None
+        db = self._db.clone() # necessary for threading with sqlite
+        try:
+            db.sql_begin_read()
+            if db.sql_selectvalue(sql.IS_SCHEDULABLE_SUBM, (submid,)) :
+                row = db.sql_selectrow(sql.SELECT_SUBMISSION_SCHEDDATA, (submid,))
         finally:
             db.sql_end()
         return row
@@ -563,17 +1027,14 @@ class ServerApp :
         fullexecid = '%s#%s' % (self._url, execid )
         
         # enter execution into database here, esp so it could be killed later if necessary.
-        db = self._db.clone() # necessary for threading with sqlite
-        try:    
-            db.sql_begin_write()
-            db.sql_insert(sql.INSERT_EXECUTION, (execid,submid,sessionobj.cogname,datetime.datetime.now(),'',sql.EXEC_STATE_NUM['run'],'',None))
-            db.sql_update(sql.SUBMISSION_RUN, (submid,))
+        # the execution and the running state go in together, or not at all (the caller fails the submission).
+        try:
+            with self._db.clone().transaction('start_execution') as db :
+                db.sql_insert(sql.INSERT_EXECUTION, (execid,submid,datetime.datetime.now(),sessionobj.cogname,'',sql.EXEC_STATE_NUM['run'],'',None))
+                db.sql_update(sql.SUBMISSION_RUN, (submid,))
         except:
             self._logger.error( "Error launching execution %s for submission %s" % (execid,submid))
-            self._logger.error(traceback.format_exc())
-        finally:
-            db.sql_end()
-            
+            raise
             
         # get argv from session object.
         # must run in a sandbox (only) !!
@@ -581,38 +1042,19 @@ class ServerApp :
         runnable = sandbox.Runnable( userid, groupid, session.get_argv, ( sessionobj, ccsctx ), {} )
         sessionargv, sessionexc, sessionlog = self._sandbox.submit( runnable )
         
-        if sessionexc :
-            # fail the execution
-            # store exception and log to the database:
-            try:    
-                db.sql_begin_write()
-                self._logger.error( "fail in get session argv" ) # @@
-                db.sql_update(sql.EXECUTION_FAIL, ('', sessionexc, execid))
-                db.sql_update(sql.SUBMISSION_FAIL, (submid,))
-            except:
-                self._logger.error( "Error storing failed execution %s" % execid)
-                self._logger.error(traceback.format_exc())
-            finally:
-                db.sql_end()
-        else:
-            # store argv in the database
-            try:    
-                db.sql_begin_write()
-                db.sql_update(sql.EXECUTION_ARGV, (' '.join(sessionargv),execid))
-            except:
-                self._logger.error( "Error storing argv(%s) for execution %s" % (' '.join(sessionargv),execid))
-                self._logger.error(traceback.format_exc())
-            finally:
-                db.sql_end()
-                
-        if sessionlog :
-          try:
-            db.sql_begin_write()
-            db.sql_insert(sql.INSERT_LOG, (datetime.datetime.now(), execid, self._encode_log(sessionlog)))
-          except:
+        # store the argv or the exception, with the log, in a single transaction:
+        try:
+            with self._db.clone().transaction('store_argv') as db :
+                if sessionexc :
+                    self._logger.error( "fail in get session argv" ) # @@
+                    db.sql_update(sql.EXECUTION_FAIL, ('', sessionexc, execid))
+                    db.sql_update(sql.SUBMISSION_FAIL, (submid,))
+                else:
+                    db.sql_update(sql.EXECUTION_ARGV, (' '.join(sessionargv),execid))
+        except:
+            self._logger.error( "Error storing argv of execution %s" % execid)
             self._logger.error(traceback.format_exc())
-          finally:
-            db.sql_end()
+        self._logsink.write( execid, sessionlog )
             
         return sessionargv, sessionexc
     
@@ -626,6 +1068,7 @@ class ServerApp :
         try:    
             db.sql_begin_write()
             db.sql_update(sql.SUBMISSION_DONE, (submid,))
+            self._ctxcache.discard( submid )
             self._logger.info( "Submission %s complete" % submid )
         except:
             self._logger.error( "Error marking submission done, %s" % submid)
@@ -665,37 +1108,10 @@ class ServerApp :
                 
                 self._logger.info( "Submission %s from %s:\n  %s" % (submid, user, ' '.join(sessionargv)) )
                 runnable = sandbox.Runnable( userid, groupid, launch_argv, (sessionargv,), {} )
-                result = self._sandbox.submit( runnable )
-                result = sandbox.RunResult( *result )
-                execlog, execexc, execstdout = result
-
-                if execexc :
-                    # fail the execution
-                    # store exception and log to the database:
-                    db = self._db.clone() # necessary for threading with sqlite
-                    try:    
-                        db.sql_begin_write()
-                        self._logger.error( "Exception in run_session (%s)" % submid )
-                        self._logger.error( str( execexc ) )
-                        db.sql_update(sql.EXECUTION_FAIL, ('', execexc, execid))
-                        db.sql_update(sql.SUBMISSION_FAIL, (submid,))
-                    except:
-                        self._logger.error( "Error storing failed execution %s" % (execid))
-                        self._logger.error(traceback.format_exc())
-                    finally:
-                        db.sql_end()
-                else:
-                    # data will be stored to the database when the results are returned
-                    # by an asynchronous call to apply_results()
-                    pass
-                  
-                if execlog or execstdout :
-                    db = self._db.clone() # necessary for threading with sqlite
-                    try:    
-                        db.sql_begin_write()
-                        db.sql_insert(sql.INSERT_LOG, (datetime.datetime.now(), execid, self._encode_log(execlog+execstdout)))
-                    finally:
-                        db.sql_end()
+                
+                # do not wait for the launch, the scheduler can move on to other submissions:
+                future = self._sandbox.submit_async( runnable )
+                future.add_done_callback( functools.partial( self._finish_launch, submid, execid ))
 
         else:
             # if there are no nodes left to run, let's finish it up!
@@ -703,6 +1119,35 @@ class ServerApp :
             
         return
     
+    # -------------------------------------------------------------------------
+    
+    def _finish_launch( self, submid, execid, future ) :
+        # called from a sandbox pool thread when launch_argv completes
+        try:
+            execlog, execexc, execstdout = future.result()
+        except:
+            execlog, execexc, execstdout = None, traceback.format_exc(), ''
+
+        if execexc :
+            self._logger.error( "Exception in run_session (%s)" % submid )
+            self._logger.error( str( execexc ) )
+            
+            # fail the execution, otherwise the data will be stored to the database 
+            # when the results are returned by an asynchronous call to apply_results()
+            try:
+                with self._db.clone().transaction('finish_launch') as db :
+                    db.sql_update(sql.EXECUTION_FAIL, ('', str(execexc), execid))
+                    db.sql_update(sql.SUBMISSION_FAIL, (submid,))
+            except:
+                self._logger.error( "Error storing failed execution %s" % (execid))
+                self._logger.error(traceback.format_exc())
+          
+        launchlog = execlog or ''
+        if not isinstance( launchlog, str ) :
+            launchlog = launchlog.decode( 'utf-8', 'replace' ) # python 3 pipes return bytes
+        self._logsink.write( execid, launchlog + (execstdout or '') )
+        return
+    
     # ===========================================
     
     def _lock(self):
@@ -722,22 +1167,27 @@ class ServerApp :
     # ===========================================
     
     def _encode_doc( self, doc ):
-        return database.Binary( zlib.compress( json.dumps( doc ) ) )
+        if zjson.is_packed( doc ):
+            return database.Binary( doc.data ) # sent in the form we store, as is
+        return database.Binary( zjson.dumps( doc ) )
 
     # -------------------------------------------
         
     def _decode_doc( self, doc ) :
-        return json.loads( zlib.decompress(doc) )
+        return zjson.loads( doc )
     
     # -------------------------------------------
     
     def _encode_log( self, log ):
+        if not isinstance( log, bytes ):
+            log = log.encode( 'utf-8' ) # text in python 3 (or unicode)
         return database.Binary( zlib.compress( log ) )
     
     # -------------------------------------------
     
     def _decode_log( self, log ) :
-        return zlib.decompress( log )
+        log = zlib.decompress( log )
+        return log if isinstance( log, str ) else log.decode( 'utf-8', 'replace' )
     
     # -------------------------------------------
     
@@ -774,8 +1224,66 @@ class ServerApp :
 
     # -------------------------------------------
     
-    @_authorized
-    def request_work( self, user, execid ):
+    def _get_snapshot( self, db, submid ):
+        "returns (generation, document), or (0, None) without a snapshot; db must be in a transaction"
+        row = db.sql_selectrow( sql.SELECT_SNAPSHOT, (submid,))
+        if row :
+            return int( row[0] ), self._decode_doc( row[1] )
+        return 0, None
+
+    # -------------------------------------------
+    
+    def _get_snapshot_generation( self, submid ):
+        generation = 0
+        db = self._db.clone() # necessary for threading with sqlite
+        try:     
+            db.sql_begin_read()
+            generation = db.sql_selectvalue( sql.SELECT_SNAPSHOT_GENERATION, (submid,)) or 0
+        finally:
+            db.sql_end()
+        return int( generation )
+
+    # -------------------------------------------
+    
+    def _get_submission_document( self, submid, document ):
+        """returns (generation, document, estimated size in memory) for the current document of a submission, 
+        document is the original document as submitted"""
+        generation, snapshot, size = 0, None, 0
+        db = self._db.clone() # necessary for threading with sqlite
+        try:     
+            db.sql_begin_read()
+            row = db.sql_selectrow( sql.SELECT_SNAPSHOT, (submid,))
+            if row :
+                generation, snapshot, size = int( row[0] ), self._decode_doc( row[1] ), len( row[1] )
+        finally:
+            db.sql_end()
+        
+        if snapshot is None :
+            # submitted before snapshots, or no results yet:
+            # apply changes from previous executions to the document
+            snapshot = document + self._get_exec_documents( submid )
+            size = len( self._encode_doc( snapshot ))
+        return generation, snapshot, size * CONTEXT_SIZE_RATIO
+
+    # -------------------------------------------
+    
+    def _update_snapshot( self, db, submid, newdoc ):
+        "merges newdoc into the snapshot of the submission; db must be in a write transaction"
+        generation, snapshot = self._get_snapshot( db, submid )
+        if snapshot is None :
+            # the execution documents already include newdoc:
+            row = db.sql_selectrow( sql.SELECT_SUBMISSION_RUNDATA, (submid,))
+            snapshot = self._decode_doc( row[0] )
+            rows = db.sql_selectall( sql.EXECUTION_RUNDATA, (submid,)) or []
+            snapshot.extend( self._decode_doc(r[0]) for r in rows )
+        else:
+            snapshot.append( newdoc )
+        db.sql_update( sql.UPDATE_SNAPSHOT, (submid, generation + 1, self._encode_doc( compact_document( snapshot ))))
+        return generation + 1
+
+    # -------------------------------------------
+    
+    def _get_work( self, execid ):
         submid = self._get_exec_submid( execid )
         
         document = []
@@ -795,91 +1303,129 @@ class ServerApp :
             db.sql_end()
             
         # apply changes from previous executions:
-        exec_documents = self._get_exec_documents( submid )
-        document.extend( exec_documents )
+        generation, document, size = self._get_submission_document( submid, document )
         
         return document, nodelist
         
+    # -------------------------------------------
+    
+    @_authorized
+    def request_work( self, user, execid ):
+        return self._get_work( execid )
+        
+    # -------------------------------------------
+    
+    @_authorized
+    def request_work_packed( self, user, execid ):
+        "request_work, with the document packed, see get_capabilities"
+        document, nodelist = self._get_work( execid )
+        return zjson.pack( document ), nodelist
+
 
     # -------------------------------------------
     
 
     @_authorized
     def apply_results( self, user, execid, newdoc, log, exc ):
+        # newdoc may be packed, see get_capabilities, it is stored as it came
+        packed = newdoc
+        newdoc = zjson.unpack( newdoc )
         submid = self._get_exec_submid( execid )
         server, uid = execid.split( '#', 1 )
         
         if exc or not submid:
             # fail the execution in the database:
-            db = self._db.clone() # necessary for threading with sqlite
-            db.sql_begin_write()
-            try:    
-                self._logger.error( "Submission %s, Execution %s probably will fail to write exception!!" % (submid, execid) )
-                db.sql_update(sql.EXECUTION_FAIL, (newdoc, exc, uid)) # @@ this seems to be failing to write the exception back to the database
-                self._logger.error( "@@@ %s" % str( (newdoc, exc, uid) ) ) # @@@
-                if log :
-                    db.sql_insert(sql.INSERT_LOG, (datetime.datetime.now(), uid, self._encode_log(log)))
-                    
-                if submid :
-                    db.sql_update(sql.SUBMISSION_FAIL, (submid,))
-                    
+            self._logger.error( "Submission %s, Execution %s failed" % (submid, execid) )
+            if submid :
+                self._ctxcache.discard( submid )
+            try:
+                with self._db.clone().transaction('fail_execution') as db :
+                    # the document is encoded like any other, a raw list cannot be bound to the statement
+                    db.sql_update(sql.EXECUTION_FAIL, (self._encode_doc(packed) if newdoc else '', exc, uid))
+                    if submid :
+                        db.sql_update(sql.SUBMISSION_FAIL, (submid,))
             except:
                 self._logger.error( "Error storing failed execution %s" % (uid))
                 self._logger.error(traceback.format_exc())
-            finally:
-                db.sql_end()
+            self._logsink.write( uid, log )
         else:
             # store log to the database:
-            db = self._db.clone() # necessary for threading with sqlite
-            try:    
-                db.sql_begin_write()
-                db.sql_update(sql.EXECUTION_DONE, (self._encode_doc(newdoc), uid))
-                if log :
-                    db.sql_insert(sql.INSERT_LOG, (datetime.datetime.now(), uid, self._encode_log(log)))
-                db.sql_update(sql.SUBMISSION_WAIT, (submid,))
-                
+            generation = 0
+            try:
+                with self._db.clone().transaction('store_results') as db :
+                    db.sql_update(sql.EXECUTION_DONE, (self._encode_doc(packed), uid))
+                    generation = self._update_snapshot(db, submid, newdoc)
+                    db.sql_update(sql.SUBMISSION_WAIT, (submid,))
             except:
+                generation = 0 # rolled back, the snapshot did not change
                 self._logger.error( "Error storing completed execution %s" % (uid))
                 self._logger.error(traceback.format_exc())
-            finally:
-                db.sql_end()
+            self._logsink.write( uid, log )
+            
+            if generation :
+                self._ctxcache.add_delta( submid, generation, newdoc )
+            else:
+                self._ctxcache.discard( submid )
+            
+            # the next session of the submission can be scheduled right away:
+            self._wake_scheduler()
         
         return True
     
+    # -------------------------------------------
+    
+    @_authorized
+    def append_log( self, user, execid, log ):
+        "appends a chunk of log to an execution in progress, see cog.host.run"
+        submid = self._get_exec_submid( execid )
+        if not submid :
+            return False
+        server, uid = execid.split( '#', 1 )
+        self._logsink.write( uid, log )
+        return True
+    
     # ===========================================
 
+    def get_capabilities( self ):
+        """what this server understands beyond plain XML-RPC, no authentication needed:
+        'documents' lists the encodings of document arguments besides structs, 
+        zjson documents are accepted by submit and apply_results, and returned by request_work_packed"""
+        return { 'documents' : [ zjson.FORMAT ] }
+
+    # -------------------------------------------
+
     def get_nonce( self ):
-        nonce = base64.b64encode(auth.get_nonce()).encode( "utf-8" )
-        now = datetime.datetime.now()
-        
-        self._noncelock.acquire( True )
-        self._noncecache[ nonce ] = now
-        self._noncelock.release()
-        
+        nonce = base64.b64encode(auth.get_nonce())
+        if not isinstance( nonce, str ) :
+            nonce = nonce.decode( "ascii" ) # python 3 encodes to bytes
+        self._noncecache.add( nonce )
         return nonce
 
     # -------------------------------------------
     
-    def _auth_user( self, cred ):
-        # prune if past a limit:
-        if len( self._noncecache ) > NONCE_CACHE_LIMIT :
-            self._noncelock.acquire( True )
-            keys = self._noncecache.keys() 
-            for k in keys:
-                if now - self._noncecache[k] > datetime.timedelta( seconds=NONCE_EXPIRY ) :
-                    del self._noncecache[k]
-            self._noncelock.release()
-        
-        # need to verify the server nonce before we call auth module to verify the credentials:
+    @_authorized
+    def open_session( self, user ):
+        """Opens a session for the authenticated user, returns its id and lifetime in seconds.
+        The following calls can be authenticated without a nonce, see auth.ClientSession"""
+        cred = auth.UserCredentials( *user )
+        if auth.is_session_credentials( cred ):
+            raise SystemError( "Permission Denied" ) # the key derives from a client nonce
+        key_fn = lambda session_id : auth.get_session_key( cred.username, self._parm, session_id, cred.clientnonce )
+        return [ self._sessions.open( cred.username, key_fn ), SESSION_EXPIRY ]
+
+    # -------------------------------------------
+    
+    def _auth_user( self, cred, methodname ):
         ret = False
-        try:
-            self._noncelock.acquire( True )
-            timestamp = self._noncecache[ cred.servernonce ]
-            if datetime.datetime.now() - timestamp < datetime.timedelta( seconds=NONCE_EXPIRY ):
-                del self._noncecache[ cred.servernonce ]
-                ret = auth.verify_user_credentials( cred, self._parm )
-        finally:
-            self._noncelock.release()
+        if auth.is_session_credentials( cred ):
+            if not self._sessions.knows( cred ):
+                # a distinct fault, the client opens a new session and calls again:
+                raise xmlrpc_lib.Fault( auth.SESSION_FAULT, "Unknown Session" )
+            ret = self._sessions.verify( cred, methodname )
+        # need to verify the server nonce before we call auth module to verify the credentials,
+        # a nonce is used up by the attempt, whether it succeeds or not:
+        elif self._noncecache.use( cred.servernonce ):
+            ret = auth.verify_user_credentials( cred, self._parm )
         if not ret:
             raise SystemError( "Permission Denied" )
         return ret
@@ -890,8 +1436,8 @@ class ServerApp :
         # authenticate the user identity first, then whether they can run the method or not
         # encode from generic tuple from the wire to the named tuple we require
         cred = auth.UserCredentials( *user )
-        if self._auth_user( cred ): 
-            if self._auth.verify( cred.username, methodname ):
+        if self._auth_user( cred, methodname ): 
+            if self._auth.verify( cred.username, PERMISSION_ALIASES.get( methodname, methodname )):
                 return True
 
         raise SystemError( "Permission Denied" )
@@ -915,7 +1461,10 @@ class ServerApp :
         "friendly shutdown of the cluster"
         cred = auth.UserCredentials( *user )
         self._logger.warning( "Shutdown call received from %s" % cred.username )
+        self._stop_tasks() # no more backups, scheduling etc.
+        self._dispatcher.shutdown() # let submissions being dispatched finish with the sandbox
         self._sandbox.shutdown() # must be called to shut down sidecar processes
+        self._logsink.shutdown() # writes the logs still queued
         self._lock() # will not release !  # @@ SHOULD PROBABLY WELD THIS TO THE DATABASE MUTEX AND LOCK THAT.
         # @@ ALL database sql_begin_* should take place inside exception block.
         # @@ May be safest to queue the shutdown as a task, so no submissions are in-progress at the time.
@@ -939,28 +1488,27 @@ class ServerApp :
         self._logger.info( "Submission %s arrived from %s" % (submid, usercred.username) )
         
         ret = None
-        db = self._db.clone() # necessary for threading with sqlite
         try:
-            db.sql_begin_write()
-            db.sql_insert(
-                sql.INSERT_SUBMISSION, 
-                (
-                    submid,
-                    datetime.datetime.now(),
-                    int(priority),
-                    str(title),
-                    usercred.username,
-                    str(email),
-                    self._encode_doc(document),
-                    ','.join(nodes)
-                ))
+            with self._db.clone().transaction('submit') as db :
+                db.sql_insert(
+                    sql.INSERT_SUBMISSION, 
+                    (
+                        submid,
+                        datetime.datetime.now(),
+                        int(priority),
+                        str(title),
+                        usercred.username,
+                        str(email),
+                        self._encode_doc(document),
+                        ','.join(nodes)
+                    ))
             ret = '%s#%s' % ( self._url, submid )
         except:
             self._logger.error( "Submission Failure %s, from %s" % (submid, usercred.username))
             self._logger.error(traceback.format_exc())
-        finally:
-            db.sql_end()
         
+        if ret :
+            self._wake_scheduler()
         return ret
 
 
@@ -976,19 +1524,9 @@ class ServerApp :
     # ===========================================
       
     
-    @_authorized
-    @ClientBase._rpc_all  
-    def get_submission_list( self, user ): # @@ OK
+    def _get_submission_dicts( self, rows ):
+        # rows of the Submission table, with column names, as sent to clients
         ret = []
-        rows = None
-        db = self._db.clone() # necessary for threading with sqlite
-        try:
-            db.sql_begin_read()
-            rows = db.sql_selectall(sql.GET_SUBMISSION_LIST, [], column_names=True)
-            
-        finally:
-            db.sql_end()
-        
         if rows :
             header = rows[0]
             for r in rows[1:] :
@@ -1003,16 +1541,151 @@ class ServerApp :
                     d['document'] = self._decode_doc( d['document'] )
                 if 'state' in d:
                     d['state'] = sql.SUBM_STATE_NAME[ d['state'] ]
-                
         return ret
 
+    # ===========================================
+    
+    @_authorized
+    @ClientBase._rpc_all  
+    def get_submission_list( self, user ): # @@ OK
+        rows = None
+        db = self._db.clone() # necessary for threading with sqlite
+        try:
+            db.sql_begin_read()
+            rows = db.sql_selectall(sql.GET_SUBMISSION_LIST, [], column_names=True)
+            
+        finally:
+            db.sql_end()
+        
+        return self._get_submission_dicts( rows )
+
+
+    # ===========================================
+
+    @_authorized
+    @ClientBase._rpc_all
+    def get_changes( self, user, since_seq, limit ):
+        """The submissions and executions created, or whose state changed, after since_seq, in order.
+        since_seq is the 'seq' of the previous call (0 at first), or a dictionary of them by server url.
+        Returns { 'changes' : [ {seq, born, kind ('subm' or 'exec'), uid, submid, state} ], 
+        'seq' : to pass back, 'more' : whether there are more changes, 
+        'reset' : whether changes after since_seq were purged, in which case get_submission_page can catch up }"""
+        if isinstance( since_seq, dict ):
+            since_seq = since_seq.get( self._url )
+        since_seq = int( since_seq or 0 )
+        limit = max( 1, min( int( limit or CHANGE_PAGE_LIMIT ), CHANGE_PAGE_LIMIT ))
+
+        rows = None
+        db = self._db.clone() # necessary for threading with sqlite
+        try:
+            db.sql_begin_read()
+            first = db.sql_selectall( sql.GET_CHANGES_FIRST, [] )[0][0]
+            rows = db.sql_selectall( sql.GET_CHANGES, (since_seq, limit + 1) ) or []
+        finally:
+            db.sql_end()
+
+        more = len( rows ) > limit
+        changes = []
+        for seq, born, kind, changeuid, submuid, state in rows[:limit] :
+            names = sql.SUBM_STATE_NAME if kind == 'subm' else sql.EXEC_STATE_NAME
+            changes.append( {
+                'seq' : seq,
+                'born' : born,
+                'kind' : kind,
+                'uid' : '%s#%s' % ( self._url, changeuid ),
+                'submid' : '%s#%s' % ( self._url, submuid ),
+                'state' : names[ state ] if state is not None else None,
+            } )
+        return {
+            'changes' : changes,
+            'seq' : changes[-1]['seq'] if changes else since_seq,
+            'more' : more,
+            'reset' : since_seq < first - 1,
+        }
+
+    # ===========================================
+
+    def _get_page_datetime( self, x ):
+        # times arrive as xmlrpc DateTime, or as text
+        if isinstance( x, xmlrpc_lib.DateTime ):
+            return datetime.datetime.strptime( x.value, "%Y%m%dT%H:%M:%S" )
+        if isinstance( x, datetime.datetime ):
+            return x
+        for fmt in ( "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d" ):
+            try:
+                return datetime.datetime.strptime( x, fmt )
+            except ValueError :
+                pass
+        raise ValueError( 'Unknown time format %s' % x )
+
+    # -------------------------------------------
+
+    @_authorized
+    @ClientBase._rpc_all
+    def get_submission_page( self, user, query ):
+        """A page of get_submission_list, in uid order, for lists too long to send at once.
+        query is a dictionary, all its entries optional:
+          columns : names of the columns to return, by default those of get_submission_list
+          state, user : lists of accepted state names and user names
+          min_priority, max_priority, born_after, born_before : ranges, born_before excluded
+          limit : number of rows, at most SUBMISSION_PAGE_LIMIT
+          cursor : from the previous page, or a dictionary of them by server url.
+        Returns { 'rows' : [submission dictionaries], 'cursor' : token, 'more' : whether there are more pages }"""
+        query = dict( query or {} )
+        columns = list( query.pop( 'columns', None ) or sql.SUBMISSION_PAGE_COLUMNS )
+        limit = max( 1, min( int( query.pop( 'limit', SUBMISSION_PAGE_SIZE )), SUBMISSION_PAGE_LIMIT ))
+        cursor = query.pop( 'cursor', None )
+        if isinstance( cursor, dict ):
+            cursor = cursor.get( self._url )
+        after = cursor.split( '#', 1 )[-1] if cursor else ''
+
+        for c in columns :
+            if c not in sql.SUBMISSION_COLUMNS :
+                raise ValueError( 'Unknown column %s' % c )
+        if 'uid' not in columns :
+            columns.insert( 0, 'uid' ) # the key of the pages
+
+        filters = []
+        parms = [ after ]
+        for key in sorted( query.keys() ):
+            if key not in sql.SUBMISSION_PAGE_FILTERS :
+                raise ValueError( 'Unknown filter %s' % key )
+            value = query[ key ]
+            if key in ( 'state', 'user' ):
+                values = list( value )
+                if key == 'state' :
+                    values = [ sql.SUBM_STATE_NUM[ v ] for v in values ]
+                filters.append( sql.SUBMISSION_PAGE_FILTERS[ key ] % ','.join( '?' * len( values )))
+                parms.extend( values )
+            else:
+                if key.startswith( 'born' ):
+                    value = self._get_page_datetime( value )
+                filters.append( sql.SUBMISSION_PAGE_FILTERS[ key ] )
+                parms.append( value )
+        parms.append( limit + 1 ) # one more, to know if there is a next page
+
+        rows = None
+        db = self._db.clone() # necessary for threading with sqlite
+        try:
+            db.sql_begin_read()
+            rows = db.sql_selectall( sql.GET_SUBMISSION_PAGE % ( ','.join( columns ), ''.join( filters )), parms, column_names=True )
+        finally:
+            db.sql_end()
+
+        more = bool( rows ) and len( rows ) > limit + 1 # a header and limit + 1 rows
+        if more :
+            rows = rows[:-1]
+        ret = self._get_submission_dicts( rows )
+        if ret :
+            cursor = ret[-1]['uid']
+        return { 'rows' : ret, 'cursor' : cursor, 'more' : more }
+
 
     # ===========================================
       
     @_authorized
     @ClientBase._rpc_specific  
     def get_submission( self, user, submid ): # @@ OK
-        ret = []
         rows = None
         server, subm = submid.split('#',1)
         db = self._db.clone() # necessary for threading with sqlite
@@ -1022,24 +1695,19 @@ class ServerApp :
             
         finally:
             db.sql_end()
+            
+        if not rows or len(rows) < 2 :
+            db = self._get_archive_db( subm ) # finished a while ago?
+            if db is not None :
+                try:
+                    db.sql_begin_read()
+                    rows = db.sql_selectall(sql.GET_SUBMISSION, (subm,), column_names=True)
+                finally:
+                    db.sql_end()
         
-        if rows :
-            header = rows[0]
-            for r in rows[1:] :
-                ret.append( dict(zip( header, r )) )
-                
-            for d in ret :
-                if 'uid' in d :
-                    d['uid'] = '%s#%s' % ( self._url, d['uid'] )
-                if 'nodelist' in d :
-                    d['nodelist'] = [ n.strip() for n in d['nodelist'].split( ',') ]
-                if 'document' in d :
-                    d['document'] = self._decode_doc( d['document'] )
-                if 'state' in d:
-                    d['state'] = sql.SUBM_STATE_NAME[ d['state'] ]
-                    
-            if len(ret) == 1:
-                ret = ret[0]
+        ret = self._get_submission_dicts( rows )
+        if len(ret) == 1:
+            ret = ret[0]
         return ret
 
     # ===========================================
@@ -1051,6 +1719,9 @@ class ServerApp :
         rows = None
         server, subm = submid.split('#',1)
         
+        # the logs queued so far are expected in the answer, but a stuck writer must not hold the request:
+        if not self._logsink.flush( self._parm['COGSERVER_LOG_FLUSH_TIMEOUT'] / 1000.0 ):
+            self._logger.warning( "Logs of %s queried before they were written" % submid )
         db = self._db.clone() # necessary for threading with sqlite
         try:
             db.sql_begin_read()
@@ -1060,6 +1731,15 @@ class ServerApp :
         finally:
             db.sql_end()
             
+        if not rows or len(rows) < 2 :
+            db = self._get_archive_db( subm ) # finished a while ago?
+            if db is not None :
+                try:
+                    db.sql_begin_read()
+                    rows = db.sql_selectall(sql.GET_SUBM_LOGS, (subm,), column_names=True)
+                finally:
+                    db.sql_end()
+            
         if rows :
             header = rows[0]
             for r in rows[1:] :
@@ -1114,6 +1794,31 @@ class ServerApp :
         # TODO @@ # unset hold state on submission
         pass
     
+    # ===========================================
+
+    @_authorized
+    @ClientBase._rpc_batch
+    def batch( self, user, calls ):
+        "runs a list of [methodname, args] of submission specific methods, authenticated once, see ClientBase.batch"
+        # results in the style of system.multicall: [result] or a fault dictionary
+        cred = auth.UserCredentials( *user )
+        ret = []
+        for name, args in calls :
+            try:
+                if name not in ClientBase._specific :
+                    raise ValueError( '%s cannot be batched' % name )
+                if not self._auth.verify( cred.username, name ):
+                    raise SystemError( "Permission Denied" )
+                plan = ClientBase._specific[ name ]
+                args = list( args )
+                args[ plan.user_index ] = user
+                ret.append( [ plan.fn( self, *args ) ] ) # undecorated, the batch is already authenticated
+            except xmlrpc_lib.Fault as e :
+                ret.append( { 'faultCode' : e.faultCode, 'faultString' : e.faultString } )
+            except Exception as e :
+                ret.append( { 'faultCode' : 1, 'faultString' : '%s:%s' % (type( e ).__name__, e) } )
+        return ret
+    
       
 # -------------------------------------------------------------------
 
@@ -0,0 +1,130 @@
+#####################################################################
+#
+# Copyright 2015 SpinVFX 
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+import collections
+import threading
+
+
+def is_set_document( document ):
+    "True if the document (a list, possibly nested) contains nothing but set operations"
+    if isinstance( document, list ):
+        return all( is_set_document( x ) for x in document )
+    return isinstance( document, dict ) and list( document.keys() ) == ['set'] and isinstance( document['set'], dict )
+
+
+class _Entry( object ):
+    def __init__( self, generation, ccnctx, size ):
+        self.generation = generation # generation of the snapshot loaded in ccnctx
+        self.ccnctx = ccnctx # never modified once cached, it is copied into the sandbox
+        self.size = size
+        self.deltas = [] # set documents for the generations after self.generation
+
+
+class ContextCache( object ):
+    """Loaded ccn contexts of submissions, keyed by submission id and the generation
+    of the submission snapshot they were loaded from.
+
+    Least recently used contexts are evicted beyond max_count entries, or beyond
+    max_size, which is measured by the (estimated) size of the loaded documents.
+    Results that only set values are kept as deltas against a cached context,
+    so the caller can apply them instead of loading the whole document again."""
+
+    def __init__( self, max_count, max_size ):
+        self._max_count = max_count
+        self._max_size = max_size
+        self._entries = collections.OrderedDict() # least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+
+    # ===========================================
+
+    def _pop( self, submid ):
+        entry = self._entries.pop( submid, None )
+        if entry is not None :
+            self._size -= entry.size
+        return entry
+
+    # -------------------------------------------
+
+    def _evict( self ):
+        while self._entries and ( len( self._entries ) > self._max_count or self._size > self._max_size ) :
+            self._size -= self._entries.popitem( last=False )[1].size
+
+    # ===========================================
+
+    def get( self, submid, generation ):
+        """returns (ccnctx, deltas) where the list of set documents in deltas must be applied to ccnctx
+        to bring it to the given generation, or (None, None) if nothing useful is cached"""
+        self._lock.acquire()
+        try:
+            entry = self._pop( submid )
+            if entry is None or entry.generation + len( entry.deltas ) != generation :
+                return None, None
+            self._entries[ submid ] = entry
+            self._size += entry.size
+            return entry.ccnctx, list( entry.deltas )
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def put( self, submid, generation, ccnctx, size=None ):
+        "size None keeps the size of the context previously cached for the submission"
+        self._lock.acquire()
+        try:
+            entry = self._pop( submid )
+            if size is None :
+                size = entry.size if entry is not None else 0
+            if self._max_count <= 0 or size > self._max_size :
+                return
+            self._entries[ submid ] = _Entry( generation, ccnctx, size )
+            self._size += size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def add_delta( self, submid, generation, document ):
+        "records the document that produced the given generation of the snapshot"
+        self._lock.acquire()
+        try:
+            entry = self._entries.get( submid )
+            if entry is None :
+                return
+            if entry.generation + len( entry.deltas ) + 1 != generation or not is_set_document( document ):
+                self._pop( submid ) # cannot be brought up to date cheaply
+            else:
+                entry.deltas.append( document )
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def discard( self, submid ):
+        self._lock.acquire()
+        try:
+            self._pop( submid )
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def get_stats( self ):
+        "returns (count, size)"
+        return len( self._entries ), self._size
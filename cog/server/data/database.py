@@ -24,6 +24,8 @@ import os
 
 import gzip
 import shutil
+import threading
+import time
 
 
 #################################################
@@ -56,14 +58,64 @@ class myGzipFile(gzip.GzipFile):
 
 #################################################
 
-def check_database(filename, schema_list, logger=None):
-    "Will check for an existing database on disk, and build it if necessary"
+SCHEMA_VERSION_TABLE = "CREATE TABLE IF NOT EXISTS schema_version ( version INTEGER NOT NULL );"
+
+def _get_schema_version(conn):
+    conn.execute(SCHEMA_VERSION_TABLE, [])
+    row = conn.execute("SELECT max(version) FROM schema_version;", []).fetchone()
+    return row[0] or 0 # a database older than the table is version 0
+    
+def _set_schema_version(conn, version):
+    conn.execute("DELETE FROM schema_version;", [])
+    conn.execute("INSERT INTO schema_version (version) VALUES (?);", [version])
+
+def get_schema_version(filename):
+    conn = dbi.connect(filename)
+    try:
+        return _get_schema_version(conn)
+    finally:
+        conn.close()
+
+def check_database(filename, schema_list, logger=None, migrations=None):
+    """Will check for an existing database on disk, and build it if necessary.
+    
+    migrations is the ordered list of upgrades to the schema, each one a list of statements.
+    A new database is built at the latest version, an existing one gets the migrations
+    it is missing, one transaction each, so a failure leaves it at the last version that worked."""
+    migrations = migrations or []
     
     if not os.path.isfile(filename):
         conn = dbi.connect(filename, isolation_level='EXCLUSIVE')
-        for cmd in schema_list :
-            conn.execute(cmd, [])
-        conn.commit()
+        try:
+            for cmd in schema_list :
+                conn.execute(cmd, [])
+            conn.execute(SCHEMA_VERSION_TABLE, [])
+            _set_schema_version(conn, len(migrations))
+            conn.commit()
+        finally:
+            conn.close()
+        return
+        
+    # explicit transactions, so the DDL statements are not committed on their own:
+    conn = dbi.connect(filename, isolation_level=None)
+    try:
+        version = _get_schema_version(conn)
+        for i in range(version, len(migrations)) :
+            if logger :
+                logger.info('Upgrading database %s to version %d' % (filename, i + 1))
+            conn.execute("BEGIN IMMEDIATE;", [])
+            try:
+                for cmd in migrations[i] :
+                    conn.execute(cmd, [])
+                _set_schema_version(conn, i + 1)
+                conn.execute("COMMIT;", [])
+            except:
+                conn.execute("ROLLBACK;", [])
+                if logger :
+                    logger.error('Failed to upgrade database %s to version %d' % (filename, i + 1))
+                raise
+    finally:
+        conn.close()
    
 
 #################################################
@@ -95,10 +147,126 @@ dbi.register_converter("TIMESTAMP", _convert_timestamp)
 
 #################################################
 
+# compiled statements kept by each pooled connection:
+STATEMENT_CACHE = 256
+
+def _connect(filename, begin_sql, isolation_level='DEFERRED', timeout=30.0, **kwargs):
+    conn = dbi.connect(filename, detect_types=dbi.PARSE_DECLTYPES|dbi.PARSE_COLNAMES, isolation_level=isolation_level, timeout=timeout, **kwargs)
+    conn.execute(begin_sql, [])
+    return conn
+
+#################################################
+
+class ConnectionPool :
+    """Keeps one open connection per thread, shared by the clones of a Database.
+    A thread that needs a second connection at the same time gets a private one."""
+    
+    def __init__( self, filename, begin_sql ) :
+        self._filename = filename
+        self._begin_sql = begin_sql
+        self._local = threading.local()
+        
+    def acquire(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None :
+            # sqlite objects stay in the thread that created them, check_same_thread is just 
+            # relaxed so that connections of finished threads can be closed by the garbage collector.
+            conn = _connect(self._filename, self._begin_sql, check_same_thread=False, cached_statements=STATEMENT_CACHE)
+        else:
+            self._local.conn = None
+        return conn
+        
+    def release(self, conn):
+        if getattr(self._local, 'conn', None) is None :
+            self._local.conn = conn
+        else:
+            conn.close()
+            
+    def discard(self, conn):
+        "for a connection in an unknown state"
+        conn.close()
+
+#################################################
+
+class TransactionStats :
+    """Counts and times the named transactions of a Database and its clones"""
+    
+    def __init__( self ) :
+        self._lock = threading.Lock()
+        self._stats = {}
+        
+    def record(self, name, elapsed, committed):
+        self._lock.acquire()
+        try:
+            entry = self._stats.get(name)
+            if entry is None :
+                entry = {'count':0, 'rollbacks':0, 'time':0.0, 'max_time':0.0}
+                self._stats[name] = entry
+            entry['count'] += 1
+            if not committed :
+                entry['rollbacks'] += 1
+            entry['time'] += elapsed
+            entry['max_time'] = max(entry['max_time'], elapsed)
+        finally:
+            self._lock.release()
+            
+    def get(self):
+        "returns a copy, {name: {'count','rollbacks','time','max_time'}}"
+        self._lock.acquire()
+        try:
+            return dict((k, dict(v)) for k, v in self._stats.items())
+        finally:
+            self._lock.release()
+
+#################################################
+
+class Transaction :
+    """Unit of work returned by Database.transaction(), used in a with statement.
+    
+    The sql_* operations of the database raise inside the block instead of returning None/False,
+    and the whole block commits on success or rolls back when an exception leaves it.
+    The exception is never swallowed."""
+    
+    def __init__( self, db, name, write=True ) :
+        self._db = db
+        self._name = name
+        self._write = write
+        self._start = None
+        
+    def __enter__(self):
+        self._start = time.time()
+        if self._write :
+            self._db.sql_begin_write()
+        else:
+            self._db.sql_begin_read()
+        self._db._strict = True
+        return self._db
+        
+    def __exit__(self, exc_type, exc_value, tb):
+        db = self._db
+        db._strict = False
+        committed = False
+        try:
+            if exc_type is None :
+                db.sql_end()
+                committed = True
+            else:
+                try:
+                    db.sql_rollback()
+                finally:
+                    db.sql_end() # releases the lock and the connection
+        finally:
+            db._stats.record(self._name, time.time() - self._start, committed)
+        return False
+
+#################################################
+
 class Database :
     """Abstracts the sql interface"""
     
-    def __init__( self, filename, begin_sql, cache_connection=False, lock=None ) :
+    def __init__( self, filename, begin_sql, cache_connection=False, lock=None, pool=None, stats=None ) :
+        """cache_connection keeps connections open in a pool, one per thread, 
+        shared with the clones of this object (otherwise each transaction opens and closes one)"""
         # don't accidentally create a file if it doesn't exist
         self._filename = None
         if filename:
@@ -107,17 +275,29 @@ class Database :
         self._begin_sql = begin_sql
         self._cache_connection = cache_connection
         self._conn = None
+        self._pool = pool
+        if cache_connection and pool is None :
+            self._pool = ConnectionPool(self._filename, begin_sql)
         if lock is None:
             self._multilock = multilock.Multilock()
         else:
             self._multilock = lock
         self._lockstate = _NOLOCK
+        self._strict = False
+        self._attached = []
+        if stats is None:
+            self._stats = TransactionStats()
+        else:
+            self._stats = stats
 
         return
         
     def __del__( self ) :
         if self._conn is not None:
-            self._conn.close()
+            if self._pool is not None and _EXCLUSIVELOCK != self._lockstate :
+                self._pool.discard(self._conn) # abandoned mid-transaction
+            else:
+                self._conn.close()
             self._conn = None
         
         
@@ -146,23 +326,40 @@ class Database :
                 
             self._lockstate = _NOLOCK
         
+    def get_lock_stats(self):
+        "contention statistics of the lock shared by this database and its clones"
+        return self._multilock.get_stats()
+        
+    def get_transaction_stats(self):
+        "count, rollbacks and timings of the named transactions of this database and its clones"
+        return self._stats.get()
+        
     def clone(self):
-        return Database(self._filename, self._begin_sql, self._cache_connection,  self._multilock ) # share the lock
+        return Database(self._filename, self._begin_sql, self._cache_connection,  self._multilock, self._pool, self._stats ) # share the lock, connections and statistics
+        
+    def transaction(self, name, write=True):
+        """Unit of work: with db.transaction('name') as db: ...
+        commits when the block completes, rolls back and re-raises otherwise."""
+        return Transaction(self, name, write)
+        
+    def _open(self):
+        if self._conn is None :
+            if self._pool is not None :
+                self._conn = self._pool.acquire()
+            else:
+                self._conn = _connect(self._filename, self._begin_sql)
+        return
         
     def sql_begin_read(self) :
         "Transaction begin"
         self._lock(_READLOCK)
-        if self._conn is None :
-            self._conn = dbi.connect(self._filename, detect_types=dbi.PARSE_DECLTYPES|dbi.PARSE_COLNAMES, isolation_level='DEFERRED', timeout=30.0)
-            self._conn.execute(self._begin_sql, [])
+        self._open()
         return
         
     def sql_begin_write(self) :
         "Transaction begin"
         self._lock(_WRITELOCK)
-        if self._conn is None :
-            self._conn = dbi.connect(self._filename, detect_types=dbi.PARSE_DECLTYPES|dbi.PARSE_COLNAMES, isolation_level='DEFERRED', timeout=30.0)
-            self._conn.execute(self._begin_sql, [])
+        self._open()
         return
         
     def sql_begin_exclusive(self, timeout=2.0) :
@@ -171,22 +368,43 @@ class Database :
         if ret :
             self._conn = None
             try:
-                self._conn = dbi.connect(self._filename, detect_types=dbi.PARSE_DECLTYPES|dbi.PARSE_COLNAMES, isolation_level='EXCLUSIVE', timeout=timeout)
-                self._conn.execute(self._begin_sql, [])
+                self._conn = _connect(self._filename, self._begin_sql, isolation_level='EXCLUSIVE', timeout=timeout)
             except:
                 ret = False
         return ret
 
+    def sql_attach(self, filename, alias):
+        """Attaches another database file as alias until the end of the transaction,
+        must be called before any other statement of the transaction"""
+        self._conn.execute("ATTACH DATABASE ? AS %s;" % alias, [filename])
+        self._attached.append(alias)
+        
+    def _detach(self):
+        while self._attached :
+            self._conn.execute("DETACH DATABASE %s;" % self._attached.pop(), [])
+
     def sql_end(self):
         "Transaction commit"
         if self._conn is not None :
-            self._conn.commit()
+            try:
+                self._conn.commit()
+                self._detach()
+            except:
+                # do not hand a connection with an open transaction to the next user
+                self._conn.close()
+                self._conn = None
+                self._attached = []
+                self._unlock()
+                raise
             if _EXCLUSIVELOCK == self._lockstate :
                 self._conn.close()
                 self._conn = None
             self._unlock()
-        if self._conn is not None and not self._cache_connection :
-            self._conn.close()
+        if self._conn is not None :
+            if self._pool is not None :
+                self._pool.release(self._conn) # keep it open for the next transaction
+            else:
+                self._conn.close()
             self._conn = None
         return
 
@@ -201,7 +419,8 @@ class Database :
                 if len(row) > 0 :
                     ret = row[0]
         except :
-            pass
+            if self._strict :
+                raise
         
         return ret
             
@@ -213,7 +432,8 @@ class Database :
             curs.execute( cmd, args )
             ret = curs.fetchone()
         except :
-            pass
+            if self._strict :
+                raise
         
         return ret
 
@@ -231,7 +451,8 @@ class Database :
                 rows.insert(0, cols)
             ret = rows
         except :
-            pass
+            if self._strict :
+                raise
         return ret
 
     def sql_insert(self, cmd, args):
@@ -242,7 +463,8 @@ class Database :
             curs.execute(cmd, args)
             rowid = curs.lastrowid
         except:
-            pass
+            if self._strict :
+                raise
         return rowid
 
     def sql_update(self, cmd, args) :
@@ -251,6 +473,8 @@ class Database :
             self._conn.execute(cmd, args)
             return True
         except :
+            if self._strict :
+                raise
             return False
             
             
@@ -260,6 +484,8 @@ class Database :
             self._conn.executemany( cmd, args )
             return True
         except :
+            if self._strict :
+                raise
             return False
 
     def sql_rollback(self):
@@ -268,20 +494,148 @@ class Database :
 
 #################################################
 
-def backup(database_name, backup_name):
-    if os.path.isfile(database_name):
-        tmp_name = backup_name + '.in_progress'
-        replacing_name = backup_name + '.replaced'
-        conn = dbi.connect(database_name)
+# online backups copy this many pages at a time, sleeping in between so writers can get in:
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.05
+# restarts of an incremental backup (the source changed under it) before copying in one step:
+BACKUP_RESTARTS = 3
+
+class _BackupRestart(Exception):
+    pass
+
+def _replace_file(tmp_name, final_name):
+    "moves tmp_name onto final_name, the previous final_name is kept until the move succeeds"
+    replacing_name = final_name + '.replaced'
+    if os.path.isfile(final_name):
+        if os.path.isfile(replacing_name):
+            os.remove(replacing_name)
+        shutil.move(final_name, replacing_name)
+    shutil.move(tmp_name, final_name)
+    if os.path.isfile(replacing_name):
+        os.remove(replacing_name)
+
+def _gzip_file(name, gz_name):
+    with open(name, 'rb') as fin:
+        with myGzipFile(gz_name, 'wb', 5) as fout:
+            shutil.copyfileobj(fin, fout)
+
+def _gunzip_file(gz_name, name):
+    with myGzipFile(gz_name, 'rb') as fin:
+        with open(name, 'wb') as fout:
+            shutil.copyfileobj(fin, fout)
+
+def _check_integrity(filename):
+    conn = dbi.connect(filename)
+    try:
+        row = conn.execute("PRAGMA integrity_check;", []).fetchone()
+    finally:
+        conn.close()
+    if row is None or row[0] != 'ok' :
+        raise dbi.DatabaseError('Integrity check failed for %s: %s' % (filename, row and row[0]))
+
+def _backup_pages(database_name, tmp_name, pages, progress):
+    "copies the database with the sqlite backup api, pages at a time (all at once if pages <= 0)"
+    state = {'remaining': None, 'restarts': 0}
+    def step(status, remaining, total):
+        if state['remaining'] is not None and remaining >= state['remaining'] :
+            state['restarts'] += 1 # no progress, the source was written to and the copy started over
+            if state['restarts'] > BACKUP_RESTARTS :
+                raise _BackupRestart()
+        state['remaining'] = remaining
+        if progress :
+            progress(total - remaining, total)
+        time.sleep(BACKUP_SLEEP)
+        
+    src = dbi.connect(database_name)
+    try:
+        for attempt_pages in ((pages, -1) if pages > 0 else (-1,)) :
+            if os.path.isfile(tmp_name):
+                os.remove(tmp_name)
+            dst = dbi.connect(tmp_name)
+            try:
+                src.backup(dst, pages=attempt_pages, progress=step)
+                return
+            except _BackupRestart:
+                state['remaining'] = None # busy database, copy it in a single step instead
+            finally:
+                dst.close()
+    finally:
+        src.close()
+
+def _backup_dump(database_name, tmp_name):
+    "text dump, for pythons without the backup api"
+    conn = dbi.connect(database_name)
+    try:
         # version-proof python 2.6 / 3.2 using the b() function
         sql_lines = (B('%s\n' % x) for x in conn.iterdump()) # generator, does not pull all into RAM
-        with myGzipFile(tmp_name, 'wb', 5) as fout:
+        with open(tmp_name, 'wb') as fout:
             fout.writelines(sql_lines)
-        if os.path.isfile(backup_name):
-            if os.path.isfile(replacing_name):
-                os.remove(replacing_name)
-            shutil.move(backup_name, replacing_name)
-        shutil.move(tmp_name, backup_name)
-        if os.path.isfile(replacing_name):
-            os.remove(replacing_name)
-    return
\ No newline at end of file
+    finally:
+        conn.close()
+
+def backup(database_name, backup_base, compress=True, pages=BACKUP_PAGES, progress=None):
+    """Online backup of a database, returns the name of the backup file (or None if there is no database).
+    
+    The database stays available while it is copied, pages at a time, to a binary snapshot 
+    named backup_base + '.backup', verified, then gzipped (+ '.gz') if compress.
+    progress(done, total) is called with page counts as the copy goes.
+    Pythons without sqlite3.Connection.backup write a text dump (backup_base + '.sql') instead."""
+    if not os.path.isfile(database_name):
+        return None
+        
+    if hasattr(dbi.Connection, 'backup') :
+        backup_name = backup_base + '.backup'
+        tmp_name = backup_name + '.in_progress'
+        _backup_pages(database_name, tmp_name, pages, progress)
+        _check_integrity(tmp_name)
+    else:
+        backup_name = backup_base + '.sql'
+        tmp_name = backup_name + '.in_progress'
+        _backup_dump(database_name, tmp_name)
+        
+    if compress :
+        backup_name += '.gz'
+        gz_name = backup_name + '.in_progress'
+        _gzip_file(tmp_name, gz_name)
+        os.remove(tmp_name)
+        tmp_name = gz_name
+        
+    _replace_file(tmp_name, backup_name)
+    return backup_name
+
+def restore(backup_name, database_name):
+    """Rebuilds database_name from a file written by backup() (which must not be in use), 
+    the database is only replaced once the restored copy passes an integrity check."""
+    tmp_name = database_name + '.restoring'
+    plain_name = tmp_name + '.plain'
+    for name in (tmp_name, plain_name):
+        if os.path.isfile(name):
+            os.remove(name)
+    try:
+        source_name = backup_name
+        if backup_name.endswith('.gz') :
+            _gunzip_file(backup_name, plain_name)
+            source_name = plain_name
+            backup_name = backup_name[:-len('.gz')]
+            
+        if backup_name.endswith('.sql') :
+            conn = dbi.connect(tmp_name)
+            try:
+                with open(source_name, 'rb') as fin:
+                    conn.executescript(fin.read().decode('utf-8'))
+                conn.commit()
+            finally:
+                conn.close()
+        else:
+            shutil.copyfile(source_name, tmp_name)
+            
+        _check_integrity(tmp_name)
+        for suffix in ('-wal', '-shm') : # would be applied to the restored file otherwise
+            if os.path.isfile(database_name + suffix):
+                os.remove(database_name + suffix)
+        _replace_file(tmp_name, database_name)
+    finally:
+        for name in (tmp_name, plain_name):
+            if os.path.isfile(name):
+                os.remove(name)
+    return
@@ -17,70 +17,119 @@
 #####################################################################
 
 import threading
-try: # python version-proof
-    import queue
-except:
-    import Queue as queue
 import time
 
 class Multilock :
     """One writer, unlimited readers, and the option of an exclusive lock
     which will hold off both readers and writers (and will only acquire
-    when neither readers nor writers are active)."""
+    when neither readers nor writers are active).
+    
+    A waiting exclusive lock has preference: new readers and writers wait 
+    behind it, so it cannot be starved by a steady stream of readers.
+    Every acquire takes an optional timeout (seconds) and returns whether
+    it succeeded.  Contention statistics are available from get_stats()."""
+    
+    MODES = ('read', 'write', 'exclusive')
+    
     def __init__(self) :
-        self._write = threading.Lock()
-        self._read = queue.Queue(1)
-        self._read.put(0)
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._exclusive = False
+        self._exclusive_waiting = 0
+        self._stats = dict((m, dict(acquired=0, contended=0, timeouts=0, wait_time=0.0)) for m in self.MODES)
         
-    def acquire_read(self):
-        self._read.put(self._read.get() + 1)
-        self._read.task_done()
+    def _acquire(self, mode, is_free, timeout):
+        # must be called with self._cond held
+        stats = self._stats[mode]
+        if not is_free() :
+            stats['contended'] += 1
+            start = time.time()
+            expiry = None if timeout is None else start + timeout
+            while not is_free() :
+                if expiry is None :
+                    self._cond.wait()
+                else:
+                    remaining = expiry - time.time()
+                    if remaining <= 0 :
+                        stats['timeouts'] += 1
+                        stats['wait_time'] += time.time() - start
+                        return False
+                    self._cond.wait(remaining)
+            stats['wait_time'] += time.time() - start
+        stats['acquired'] += 1
+        return True
+        
+    def acquire_read(self, timeout=None):
+        self._cond.acquire()
+        try:
+            succeed = self._acquire('read', lambda : not self._exclusive and not self._exclusive_waiting, timeout)
+            if succeed :
+                self._readers += 1
+            return succeed
+        finally:
+            self._cond.release()
         
     def release_read(self):
-        self._read.put(self._read.get() - 1)
-        self._read.task_done()
+        self._cond.acquire()
+        try:
+            assert self._readers > 0
+            self._readers -= 1
+            if not self._readers :
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
         
-    def acquire_write(self):
-        return self._write.acquire()
+    def acquire_write(self, timeout=None):
+        self._cond.acquire()
+        try:
+            succeed = self._acquire('write', lambda : not self._writer and not self._exclusive and not self._exclusive_waiting, timeout)
+            if succeed :
+                self._writer = True
+            return succeed
+        finally:
+            self._cond.release()
         
     def release_write(self):
-        self._write.release()
+        self._cond.acquire()
+        try:
+            assert self._writer
+            self._writer = False
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
         
     def acquire_exclusive(self, timeout=None):
-        if timeout is None:
-            expiry = None
-        else:
-            expiry = time.time() + timeout
-            
-        succeed = False
-        i = -1
+        self._cond.acquire()
         try:
-            while not succeed :
-                now = time.time()
-                if expiry is not None:
-                    if now < expiry :
-                        break # exit while
-                    i = self._read.get(timeout=now - expiry)
-                else:
-                    i = self._read.get()
-                self._read.task_done()
-                
-                succeed = (0 == i)
-                if not succeed :
-                   self._read.put(i)
-
-        except:
-            succeed = False
-            
-        if succeed:
-            assert self._read.empty()
-            succeed = self.acquire_write()
-            if not succeed :
-                self._read.put(0)
-        
-        return succeed
+            self._exclusive_waiting += 1
+            try:
+                succeed = self._acquire('exclusive', lambda : not self._readers and not self._writer and not self._exclusive, timeout)
+            finally:
+                self._exclusive_waiting -= 1
+            if succeed :
+                self._exclusive = True
+            else:
+                self._cond.notify_all() # readers and writers may have been waiting behind us
+            return succeed
+        finally:
+            self._cond.release()
 
     def release_exclusive(self):
-        assert self._read.empty()
-        write.release()
-        self._read.put(0)
+        self._cond.acquire()
+        try:
+            assert self._exclusive
+            self._exclusive = False
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+            
+    def get_stats(self):
+        "returns a dictionary of statistics for each mode, and the current holders of the lock"
+        self._cond.acquire()
+        try:
+            ret = dict((m, dict(self._stats[m])) for m in self.MODES)
+            ret['state'] = dict(readers=self._readers, writer=self._writer, exclusive=self._exclusive, exclusive_waiting=self._exclusive_waiting)
+            return ret
+        finally:
+            self._cond.release()
@@ -0,0 +1,205 @@
+#####################################################################
+#
+# Copyright 2015 SpinVFX 
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+import threading
+import traceback
+
+try: # version-proof
+    import Queue as queue
+except ImportError :
+    import queue
+
+
+class Dispatcher( object ):
+    """A bounded pool of threads to dispatch submissions concurrently.
+
+    Each piece of work has a key (e.g. the submission id) and a user.  Work is
+    refused, rather than queued, if the same key is already in flight, if the
+    global limit (the number of threads) is reached, or if the user already has
+    per_user pieces of work in flight (0 is unlimited).  The caller is expected
+    to offer refused work again later, on_done is called after every piece of
+    work to help with that."""
+
+    def __init__( self, workers, per_user=0, on_done=None, logger=None ):
+        self._workers = max( 1, int(workers) )
+        self._per_user = max( 0, int(per_user) )
+        self._on_done = on_done
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        self._inflight = {} # key -> user
+        self._usercount = {} # user -> count of keys in flight
+
+        self._q = queue.Queue()
+        self._threads = []
+        for i in range( self._workers ):
+            t = threading.Thread( target=self._consume )
+            t.daemon = True
+            self._threads.append( t )
+            t.start()
+        return
+
+    # ===========================================
+
+    def _consume( self ):
+        while True:
+            item = self._q.get()
+            if item is None :
+                return # poison pill design pattern to halt the thread
+            key, user, fn, args = item
+            try:
+                fn( *args )
+            except:
+                if self._logger :
+                    self._logger.error( "Error dispatching %s" % key )
+                    self._logger.error( traceback.format_exc() )
+            finally:
+                self._release( key, user )
+
+            if self._on_done :
+                try:
+                    self._on_done()
+                except:
+                    if self._logger :
+                        self._logger.error( traceback.format_exc() )
+
+    # -------------------------------------------
+
+    def _release( self, key, user ):
+        self._lock.acquire()
+        try:
+            del self._inflight[ key ]
+            self._usercount[ user ] -= 1
+            if not self._usercount[ user ] :
+                del self._usercount[ user ]
+        finally:
+            self._lock.release()
+
+    # ===========================================
+
+    def get_inflight( self ):
+        "returns the number of pieces of work queued or running"
+        return len( self._inflight )
+
+    # -------------------------------------------
+
+    def is_full( self ):
+        return len( self._inflight ) >= self._workers
+
+    # -------------------------------------------
+
+    def dispatch( self, key, user, fn, *args ):
+        "returns True if fn(*args) was handed to a thread, False if it was refused"
+        self._lock.acquire()
+        try:
+            if key in self._inflight :
+                return False
+            if len( self._inflight ) >= self._workers :
+                return False
+            count = self._usercount.get( user, 0 )
+            if self._per_user and count >= self._per_user :
+                return False
+            self._inflight[ key ] = user
+            self._usercount[ user ] = count + 1
+        finally:
+            self._lock.release()
+
+        self._q.put( (key, user, fn, args) )
+        return True
+
+    # -------------------------------------------
+
+    def shutdown( self ):
+        "lets work in progress finish, then stops the threads"
+        for t in self._threads :
+            self._q.put( None )
+        for t in self._threads :
+            t.join()
+
+# ===========================================
+
+class Fanout( object ):
+    """Calls a function for several keys at once, each key on its own long lived thread.
+
+    A key always runs on the same thread, so thread-local state (e.g. a kept alive
+    connection to a server) is reused from one call to the next, and a slow key
+    only delays the calls made for it.  The calls for one key are serialized: when several 
+    threads map() at once, their calls for a key wait for each other on its thread.
+    shutdown() stops the threads, a later map() starts them again."""
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self._queues = {} # key -> queue of the thread serving that key
+
+    # ===========================================
+
+    def _consume( self, q ):
+        while True:
+            item = q.get()
+            if item is None :
+                return # poison pill design pattern to halt the thread
+            key, fn, args, results = item
+            try:
+                results.put( (key, True, fn( key, *args )) )
+            except Exception as e :
+                results.put( (key, False, e) )
+            item = fn = args = results = None # do not keep the caller alive while waiting
+
+    # -------------------------------------------
+
+    def _get_queue( self, key ):
+        self._lock.acquire()
+        try:
+            if key not in self._queues :
+                q = queue.Queue()
+                t = threading.Thread( target=self._consume, args=(q,) )
+                t.daemon = True
+                t.start()
+                self._queues[ key ] = q
+            return self._queues[ key ]
+        finally:
+            self._lock.release()
+
+    # ===========================================
+
+    def map( self, fn, keys, *args ):
+        """calls fn(key, *args) for every (distinct) key concurrently and waits for all of them,
+        returns a list of (key, ok, result or exception) in the order of keys"""
+        keys = list( keys )
+        results = queue.Queue()
+        for key in keys :
+            self._get_queue( key ).put( (key, fn, args, results) )
+
+        done = {}
+        for key in keys :
+            k, ok, value = results.get()
+            done[ k ] = (ok, value)
+        return [ (key,) + done[ key ] for key in keys ]
+
+    # -------------------------------------------
+
+    def shutdown( self ):
+        "lets calls in progress finish, then stops the threads"
+        self._lock.acquire()
+        try:
+            queues = list( self._queues.values() )
+            self._queues = {}
+        finally:
+            self._lock.release()
+        for q in queues :
+            q.put( None )
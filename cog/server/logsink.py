@@ -0,0 +1,197 @@
+#####################################################################
+#
+# Copyright 2015 SpinVFX 
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+import datetime
+import threading
+import time
+import traceback
+
+try: # version-proof
+    import Queue as queue
+except ImportError :
+    import queue
+
+
+class LogSink( object ):
+    """Write-behind queue for log entries.
+
+    write() only queues the entry.  A background thread encodes the entries
+    and inserts them in batches (one transaction, one executemany), as soon as
+    flush_size entries are waiting or flush_interval seconds after the first
+    of them arrived, whichever comes first.
+
+    The queue holds at most max_queue entries, write() blocks when it is full,
+    so a flood of logs slows its producers down instead of exhausting memory.
+    With sync, write() also waits for its entry to be committed.
+    flush() waits for everything queued so far to be committed.
+    After shutdown() nothing is queued anymore, write() drops its entry and flush() returns at once."""
+
+    def __init__( self, db, insert_sql, encode, flush_size=256, flush_interval=1.0, max_queue=10000, sync=False, logger=None ):
+        self._db = db
+        self._insert_sql = insert_sql
+        self._encode = encode
+        self._flush_size = max( 1, int(flush_size) )
+        self._flush_interval = max( 0.0, float(flush_interval) )
+        self._sync = sync
+        self._logger = logger
+
+        self._lock = threading.Lock()
+        self._stats = {'written':0, 'batches':0, 'failed':0}
+        self._closed = False
+
+        self._q = queue.Queue( max(0, int(max_queue)) )
+        self._thread = threading.Thread( target=self._drain )
+        self._thread.daemon = True
+        self._thread.start()
+        return
+
+    # ===========================================
+
+    def _drain( self ):
+        running = True
+        while running :
+            batch = []
+            events = []
+            item = self._q.get()
+            deadline = time.time() + self._flush_interval
+            while True :
+                if item is None :
+                    running = False # poison pill, write what we have and stop
+                    break
+                entry, event = item
+                if entry is not None :
+                    batch.append( entry )
+                if event is not None :
+                    events.append( event )
+                    if entry is None :
+                        break # flush marker
+                if len( batch ) >= self._flush_size :
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0.0 :
+                    break
+                try:
+                    item = self._q.get( True, remaining )
+                except queue.Empty :
+                    break
+
+            if batch :
+                self._write( batch )
+            for event in events :
+                event.set()
+
+    # -------------------------------------------
+
+    def _error( self, msg ):
+        if self._logger :
+            self._logger.error( msg )
+            self._logger.error( traceback.format_exc() )
+
+    # -------------------------------------------
+
+    def _write( self, batch ):
+        # an entry which cannot be encoded or inserted is lost on its own, not with its batch
+        rows = []
+        for born, execid, log in batch :
+            try:
+                rows.append( (born, execid, self._encode( log )) )
+            except:
+                self._error( "Error encoding a log entry of %s" % execid )
+
+        written = 0
+        if rows :
+            try:
+                with self._db.clone().transaction( 'write_logs' ) as db :
+                    db.sql_updatemany( self._insert_sql, rows )
+                written = len( rows )
+            except:
+                self._error( "Error writing %d log entries, retrying them one by one" % len( rows ))
+                for row in rows :
+                    try:
+                        with self._db.clone().transaction( 'write_log' ) as db :
+                            db.sql_update( self._insert_sql, row )
+                        written += 1
+                    except:
+                        self._error( "Error writing a log entry of %s" % row[1] )
+
+        self._lock.acquire()
+        try:
+            self._stats['written'] += written
+            if written :
+                self._stats['batches'] += 1
+            self._stats['failed'] += len( batch ) - written
+        finally:
+            self._lock.release()
+
+    # ===========================================
+
+    def write( self, execid, log, born=None ):
+        "queues a log entry for the given execution (or submission) id"
+        if not log :
+            return
+        if self._closed :
+            self._lock.acquire()
+            try:
+                self._stats['failed'] += 1
+            finally:
+                self._lock.release()
+            if self._logger :
+                self._logger.error( "Log entry of %s after shutdown, dropped" % execid )
+            return
+        if born is None :
+            born = datetime.datetime.now()
+        event = None
+        if self._sync :
+            event = threading.Event()
+        self._q.put( ((born, execid, log), event) )
+        if event is not None :
+            event.wait()
+
+    # -------------------------------------------
+
+    def flush( self, timeout=None ):
+        "waits for the entries queued so far to be written, returns False on timeout or after shutdown"
+        if self._closed :
+            return False
+        event = threading.Event()
+        try:
+            self._q.put( (None, event), True, timeout )
+        except queue.Full :
+            return False
+        event.wait( timeout )
+        return event.is_set()
+
+    # -------------------------------------------
+
+    def get_stats( self ):
+        "returns a dictionary: queued, written, batches, failed (entries lost to errors)"
+        self._lock.acquire()
+        try:
+            ret = dict( self._stats )
+        finally:
+            self._lock.release()
+        ret['queued'] = self._q.qsize()
+        return ret
+
+    # -------------------------------------------
+
+    def shutdown( self ):
+        "writes what is queued, then stops the thread"
+        self._closed = True
+        self._q.put( None )
+        self._thread.join()
@@ -0,0 +1,76 @@
+#####################################################################
+#
+# Copyright 2015 SpinVFX 
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+import collections
+import threading
+import time
+
+
+class NonceCache( object ):
+    """Server nonces handed out and not used yet, each one is good once, for expiry seconds.
+
+    Nonces are kept in the order they were issued, which is also the order they expire,
+    so expired nonces are popped from the front in amortized constant time.  At most
+    max_count nonces are kept, beyond that the oldest are dropped as if expired."""
+
+    def __init__( self, expiry, max_count ):
+        self._expiry = expiry
+        self._max_count = max( 1, int(max_count) )
+        self._nonces = collections.OrderedDict() # nonce -> time issued, oldest first
+        self._lock = threading.Lock()
+
+    # ===========================================
+
+    def _prune( self, now ):
+        # must hold the lock
+        nonces = self._nonces
+        while nonces :
+            if len( nonces ) <= self._max_count :
+                oldest = nonces[ next( iter( nonces )) ]
+                if now - oldest < self._expiry :
+                    break
+            nonces.popitem( last=False )
+
+    # ===========================================
+
+    def add( self, nonce ):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            self._nonces[ nonce ] = now
+            self._prune( now )
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def use( self, nonce ):
+        "True if the nonce was issued and has not expired, either way it cannot be used again"
+        now = time.time()
+        self._lock.acquire()
+        try:
+            issued = self._nonces.pop( nonce, None )
+            self._prune( now )
+        finally:
+            self._lock.release()
+        return issued is not None and now - issued < self._expiry
+
+    # -------------------------------------------
+
+    def __len__( self ):
+        return len( self._nonces )
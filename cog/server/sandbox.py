@@ -17,6 +17,7 @@
 #####################################################################
 
 
+import atexit
 import collections
 import os
 import multiprocessing
@@ -24,14 +25,66 @@ import threading
 import sys
 import pickle
 import signal
+import time
+import weakref
+
+try: # unix only, used to measure the memory of reusable workers
+    import resource
+except ImportError :
+    resource = None
+
+try: # version-proof
+    import Queue as queue
+except ImportError :
+    import queue
 
 from .. import capture
 
+try: # version-proof, python 3 requires a context for multiprocessing.queues.SimpleQueue
+    _SimpleQueue = multiprocessing.SimpleQueue
+except AttributeError :
+    import multiprocessing.queues
+    _SimpleQueue = multiprocessing.queues.SimpleQueue
+
 Runnable = collections.namedtuple( "Runnable", ['uid','gid','callable','args', 'kwargs'])
 RunResult = collections.namedtuple( "RunResult", ['ret','exc', 'stdout'] )
 
+# reusable workers are idle processes already running as a given user,
+# keep at most this many of them alive in each sandbox:
+MAX_IDLE_WORKERS = 16
+
+# how often a sandbox checks that a busy reusable worker is still alive:
+WORKER_POLL_INTERVAL = 0.1 # seconds
+
+# how often an idle sidecar checks that the process which started it is still alive:
+PARENT_POLL_INTERVAL = 1.0 # seconds
+
+# the sidecars not shut down when the server exits are shut down then, 
+# those of a server killed outright notice that it is gone and exit on their own:
+_live_sandboxes = weakref.WeakSet()
+
+def _shutdown_sandboxes():
+    for sb in list( _live_sandboxes ):
+        sb.shutdown()
+
+_atexit_registered = []
 
-def _do_callable( runnable ):
+def _watch_sandbox( sb ):
+    # registered once the first sidecar has started, so that it runs before the exit handler
+    # of multiprocessing (handlers run last in first out), which would wait for the sidecars for ever:
+    if not _atexit_registered :
+        atexit.register( _shutdown_sandboxes )
+        _atexit_registered.append( True )
+    _live_sandboxes.add( sb )
+
+
+def _set_ids( uid, gid ):
+    # group first, a process that has given up root cannot change its group:
+    os.setresgid( gid,gid,gid )
+    os.setresuid( uid,uid,uid )
+
+
+def _do_callable( runnable, change_ids=True ):
     "changes the user and group id of the process"
     ret = None
     exc = None
@@ -40,8 +93,8 @@ def _do_callable( runnable ):
     try:
         # catch streams:
         with capture.StreamCapture() as output:
-            os.setresuid( runnable.uid,runnable.uid,runnable.uid )
-            os.setresgid( runnable.gid,runnable.gid,runnable.gid )
+            if change_ids :
+                _set_ids( runnable.uid, runnable.gid )
             ret = runnable.callable( *(runnable.args), **(runnable.kwargs) )        
 
         stdout = '\n'.join( output.getvalue() )
@@ -60,7 +113,7 @@ def _run_callable_from_q( q ):
 
 
 def _spawn_runnable( runnable, qpid ):
-    q = multiprocessing.queues.SimpleQueue()
+    q = _SimpleQueue()
     q.put( runnable)
 
     p = multiprocessing.Process(target=_run_callable_from_q, args=(q,))
@@ -70,7 +123,7 @@ def _spawn_runnable( runnable, qpid ):
     p.join()
     try:
         qpid.get(block=False)
-    except multiprocessing.Queue.Empty :
+    except queue.Empty :
         pass
     
     if q.empty() :
@@ -80,15 +133,123 @@ def _spawn_runnable( runnable, qpid ):
     return ret
 
 
+def _get_maxrss():
+    "peak resident memory of this process, in bytes"
+    if resource is None :
+        return 0
+    maxrss = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024 # linux reports kilobytes
+
+
+def _run_worker( conn, uid, gid, max_runnables, max_memory ):
+    os.setsid() # process session leader, so the worker and its children can be killed together.
+    try:
+        _set_ids( uid, gid )
+    except:
+        # never run user code with elevated privileges, report the failure and quit:
+        exc = sys.exc_info()[1]
+        if conn.recv() :
+            conn.send( (tuple( RunResult( None, exc, '' )), True) )
+        return
+
+    count = 0
+    while True:
+        runnable = conn.recv()
+        if not runnable :
+            return # poison pill design pattern to halt the process
+        ret = _do_callable( runnable, change_ids=False )
+        count += 1
+        recycle = bool( max_runnables and count >= max_runnables )
+        recycle = recycle or bool( max_memory and _get_maxrss() > max_memory )
+        conn.send( (tuple(ret), recycle) )
+        if recycle :
+            return
+
+
+class _Worker( object ):
+    "a long-lived child process of the sandbox, running runnables for one (uid, gid)"
+    def __init__( self, uid, gid, max_runnables, max_memory ):
+        self._conn, child_conn = multiprocessing.Pipe()
+        self._p = multiprocessing.Process(target=_run_worker, args=(child_conn, uid, gid, max_runnables, max_memory))
+        self._p.start()
+        child_conn.close()
+
+    def is_alive( self ):
+        return self._p.is_alive()
+
+    def run( self, runnable, qpid ):
+        "returns (result tuple, whether the worker is finished)"
+        qpid.put( self._p.pid )
+        try:
+            self._conn.send( runnable )
+            # children of the runnable may hold the pipe open, so also watch the worker itself:
+            while not self._conn.poll( WORKER_POLL_INTERVAL ) :
+                if not self._p.is_alive() and not self._conn.poll() :
+                    raise EOFError( "Sandbox worker exited" )
+            ret, finished = self._conn.recv()
+        except (EOFError, IOError, OSError) :
+            ret, finished = tuple([None, None, '']), True # can happen on a crash, abort, sys.exit(), os._exit(), etc etc
+        try:
+            qpid.get(block=False)
+        except queue.Empty :
+            pass
+        return ret, finished
+
+    def stop( self ):
+        try:
+            self._conn.send( None ) # poison pill design pattern to halt the process
+        except (IOError, OSError) :
+            pass
+        self._p.join( 1.0 )
+        if self._p.is_alive() :
+            self._p.terminate()
+            self._p.join()
+        self._conn.close()
+
+
+class _WorkerCache( object ):
+    "reusable workers keyed by (uid, gid), only used from within the sandbox sidecar process"
+    def __init__( self, max_runnables, max_memory ):
+        self._workers = collections.OrderedDict() # least recently used first
+        self._max_runnables = max_runnables
+        self._max_memory = max_memory
+
+    def run( self, runnable, qpid ):
+        key = ( runnable.uid, runnable.gid )
+        worker = self._workers.pop( key, None )
+        if worker is None or not worker.is_alive() :
+            worker = _Worker( runnable.uid, runnable.gid, self._max_runnables, self._max_memory )
+        ret, finished = worker.run( runnable, qpid )
+        if finished :
+            worker.stop()
+        else:
+            self._workers[ key ] = worker
+            while len( self._workers ) > MAX_IDLE_WORKERS :
+                self._workers.popitem( last=False )[1].stop()
+        return ret
+
+    def stop( self ):
+        while self._workers :
+            self._workers.popitem()[1].stop()
+
+
 class Sandbox( object ):
-    def __init__(self):
+    def __init__(self, reuse_workers=False, max_runnables=0, max_memory=0):
+        """reuse_workers keeps a process per (uid, gid) alive across runnables,
+        instead of forking for every runnable.  Such a worker is replaced after it has
+        run max_runnables, or once its memory exceeds max_memory bytes (0 is unlimited)."""
+        self._reuse_workers = reuse_workers
+        self._max_runnables = max_runnables
+        self._max_memory = max_memory
         self._q_out = multiprocessing.Queue()
         self._q_in = multiprocessing.Queue()
         self._q_pid = multiprocessing.Queue()
         self._threadlock = threading.Lock()
         
         self._p = None
+        self._parent = os.getpid()
         self._startup() 
+        _watch_sandbox( self )
         return
         
     def _startup( self ) :
@@ -101,12 +262,23 @@ class Sandbox( object ):
                 self._threadlock.release()
             
     def _consume_q( self, qsub, qret, qpid ):
+        workers = _WorkerCache( self._max_runnables, self._max_memory ) if self._reuse_workers else None
         while True:
           try:
-            runnable = qsub.get()
+            try:
+                runnable = qsub.get( True, PARENT_POLL_INTERVAL )
+            except queue.Empty :
+                if os.getppid() == self._parent :
+                    continue
+                runnable = None # orphaned, nobody will ever shut us down
             if not runnable :
+                if workers :
+                    workers.stop()
                 return # poison pill design pattern to halt the process
-            qret.put( _spawn_runnable( runnable, qpid ) )
+            if workers :
+                qret.put( workers.run( runnable, qpid ) )
+            else:
+                qret.put( _spawn_runnable( runnable, qpid ) )
           except:
             import traceback
             print( traceback.format_exc() ) # @@ is this the best way to do this?
@@ -114,10 +286,11 @@ class Sandbox( object ):
         
     def shutdown( self ):
         "must be called to shutdown sidecar processes"
+        _live_sandboxes.discard( self )
         self._threadlock.acquire()
         try:
-            self._q_out.put( None ) # poison pill design pattern to halt the process
-            if self._p :
+            if self._p and self._p.is_alive() :
+                self._q_out.put( None ) # poison pill design pattern to halt the process
                 self._p.join()
         finally:
             self._threadlock.release()
@@ -150,5 +323,118 @@ class Sandbox( object ):
             pid = self._q_pid.get(block=False)
             if pid not in (0,1):
                 os.killpg( pid, signal.SIGKILL ) # more aggressive than TERM, will not allow graceful shutdown
-        except multiprocessing.Queue.Empty :
+        except queue.Empty :
             pass
+
+
+class RunFuture( object ):
+    "result of a runnable submitted to a SandboxPool, available once the runnable has finished"
+    def __init__( self, logger=None ):
+        self._logger = logger
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc = None
+        self._callbacks = []
+
+    def done( self ):
+        return self._event.is_set()
+
+    def result( self, timeout=None ):
+        "blocks until the runnable has finished, returns a RunResult or raises the submission error"
+        if not self._event.wait( timeout ) and not self._event.is_set() : # python 2.6 wait() returns None
+            raise RuntimeError( "Timeout waiting for sandbox result" )
+        if self._exc is not None :
+            raise self._exc
+        return self._result
+
+    def add_done_callback( self, fn ):
+        "fn( future ) is called from the pool thread when the runnable finishes (or immediately if it has)"
+        self._lock.acquire()
+        try:
+            if not self._event.is_set() :
+                self._callbacks.append( fn )
+                return
+        finally:
+            self._lock.release()
+        fn( self )
+
+    def _finish( self, result, exc ):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._exc = exc
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks :
+            try:
+                fn( self )
+            except: # callbacks must not take down the pool thread
+                if self._logger :
+                    import traceback
+                    self._logger.error( "Error in a sandbox result callback" )
+                    self._logger.error( traceback.format_exc() )
+
+
+class SandboxPool( object ):
+    """A fixed number of Sandbox sidecar processes, each fed by its own thread,
+    so that independent runnables do not wait on each other.
+
+    All of the sidecar processes are forked in the constructor, before any of the
+    feeding threads are started."""
+    def __init__( self, size=1, reuse_workers=False, max_runnables=0, max_memory=0, logger=None ):
+        "reuse_workers, max_runnables and max_memory are passed to each Sandbox"
+        self._size = max( 1, int(size) )
+        self._logger = logger
+        self._q = queue.Queue()
+        self._sandboxes = [ Sandbox( reuse_workers, max_runnables, max_memory ) for i in range( self._size ) ]
+        self._threads = []
+        for sb in self._sandboxes :
+            t = threading.Thread( target=self._consume, args=(sb,) )
+            t.daemon = True
+            self._threads.append( t )
+        for t in self._threads :
+            t.start()
+        return
+
+    def _consume( self, sb ):
+        while True:
+            item = self._q.get()
+            if item is None :
+                return # poison pill design pattern to halt the thread
+            runnable, future = item
+            result, exc = None, None
+            try:
+                result = RunResult( *sb.submit( runnable ) )
+            except Exception as e :
+                exc = e
+            future._finish( result, exc )
+
+    def get_size( self ):
+        return self._size
+
+    def submit_async( self, runnable ):
+        "returns a RunFuture immediately; the runnable runs in the next free sandbox"
+        future = RunFuture( self._logger )
+        self._q.put( (runnable, future) )
+        return future
+
+    def submit( self, runnable ):
+        "blocks until the runnable has finished, other threads may submit concurrently"
+        return self.submit_async( runnable ).result()
+
+    def shutdown( self ):
+        "must be called to shutdown sidecar processes"
+        for t in self._threads :
+            self._q.put( None )
+        for t in self._threads :
+            t.join()
+        for sb in self._sandboxes :
+            sb.shutdown()
+
+    def kill( self ):
+        "kills the runnables currently executing in every sandbox"
+        for sb in self._sandboxes :
+            sb.kill()
@@ -0,0 +1,122 @@
+#####################################################################
+#
+# Copyright 2015 SpinVFX 
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+import collections
+import threading
+import time
+
+from .. import auth
+
+
+class _Session( object ):
+    def __init__( self, username, key, expires ):
+        self.username = username
+        self.key = key
+        self.expires = expires
+        self.last = 0 # highest counter seen
+        self.seen = set() # counters seen within the window below self.last
+
+
+class SessionCache( object ):
+    """Server side of the sessions of cog.auth, each one valid for expiry seconds.
+
+    Counters may arrive a little out of order (concurrent calls of a client), so any
+    counter not seen before is accepted within window of the highest one seen.
+    Sessions are kept in the order they were opened, which is the order they expire,
+    at most max_count of them."""
+
+    def __init__( self, expiry, max_count, window=64 ):
+        self._expiry = expiry
+        self._max_count = max( 1, int(max_count) )
+        self._window = window
+        self._sessions = collections.OrderedDict() # id -> _Session, oldest first
+        self._lock = threading.Lock()
+
+    # ===========================================
+
+    def _prune( self, now ):
+        # must hold the lock
+        sessions = self._sessions
+        while sessions :
+            if len( sessions ) <= self._max_count :
+                if now < sessions[ next( iter( sessions )) ].expires :
+                    break
+            sessions.popitem( last=False )
+
+    # ===========================================
+
+    def open( self, username, key_fn ):
+        "returns the id of a new session of the user, key_fn(session_id) gives its key"
+        session_id = auth.make_session_id()
+        session = _Session( username, key_fn( session_id ), time.time() + self._expiry )
+        self._lock.acquire()
+        try:
+            self._sessions[ session_id ] = session
+            self._prune( time.time() )
+        finally:
+            self._lock.release()
+        return session_id
+
+    # -------------------------------------------
+
+    def knows( self, cred ):
+        "True if the session of cred (session credentials) is open, as opposed to expired or unknown"
+        self._lock.acquire()
+        try:
+            self._prune( time.time() )
+            session = self._sessions.get( auth.get_session_id( cred ))
+            return session is not None and session.username == cred.username
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def verify( self, cred, methodname ):
+        "True if cred (session credentials) authenticates a call of methodname, only once"
+        try:
+            counter = int( cred.clientnonce )
+        except (TypeError, ValueError) :
+            return False
+        session_id = auth.get_session_id( cred )
+        now = time.time()
+
+        self._lock.acquire()
+        try:
+            self._prune( now )
+            session = self._sessions.get( session_id )
+            if session is None or session.username != cred.username :
+                return False
+            if counter <= session.last - self._window or counter in session.seen :
+                return False # replayed, or too old to tell
+            mac = auth.make_session_mac( session.key, cred.username, session_id, counter, methodname )
+            if not auth.compare_digest( mac, cred.pwhash ):
+                return False
+
+            session.seen.add( counter )
+            if counter > session.last :
+                session.last = counter
+                floor = counter - self._window
+                session.seen = set( x for x in session.seen if x > floor )
+            return True
+        finally:
+            self._lock.release()
+
+    # -------------------------------------------
+
+    def __len__( self ):
+        return len( self._sessions )
@@ -68,6 +68,12 @@ DATABASE_SCHEMA_LIST = [
  PRIMARY KEY( born, execuid )
 );""",
 
+"""CREATE TABLE Snapshot (
+ submuid        TEXT PRIMARY KEY,
+ generation     INTEGER NOT NULL,
+ document       BLOB
+);""",
+
 """CREATE TABLE Submstate (
    id INTEGER PRIMARY KEY,
    name CHARACTER(4) NOT NULL
@@ -78,13 +84,85 @@ DATABASE_SCHEMA_LIST = [
    name CHARACTER(4) NOT NULL
 );""",
 
-"CREATE INDEX ind_Execution_submid ON Execution( submuid );"
+# covering indexes for the scheduler and the log queries:
+"CREATE INDEX ind_Submission_state ON Submission( state, priority, uid );",
+"CREATE INDEX ind_Execution_submid_state ON Execution( submuid, state );",
+"CREATE INDEX ind_Log_execuid ON Log( execuid, born );",
+
+# for the filters of the submission pages, which are walked in uid order:
+"CREATE INDEX ind_Submission_user ON Submission( user, uid );",
+"CREATE INDEX ind_Submission_born ON Submission( born );",
 
 ]
 
 DATABASE_SCHEMA_LIST.extend( ['INSERT INTO Submstate (name,id) VALUES ("%s",%d);' % x for x in SUBM_STATE_NUM.items() ])
 DATABASE_SCHEMA_LIST.extend( ['INSERT INTO Execstate (name,id) VALUES ("%s",%d);' % x for x in EXEC_STATE_NUM.items() ])
 
+# The change feed: every new submission or execution, and every change of their state, 
+# is numbered by the triggers in the transaction that made it (see ServerApp.get_changes).
+# Only the live database has it, the archives are built from DATABASE_SCHEMA_LIST alone.
+# TIMESTAMP columns hold seconds since 2017-01-01 (see database._adapt_timestamp):
+_NOW = "(julianday('now','localtime') - julianday('2017-01-01')) * 86400.0"
+_CHANGE_TRIGGER = """CREATE TRIGGER IF NOT EXISTS %s AFTER %s ON %s %s
+BEGIN
+  INSERT INTO Change (born,kind,uid,submuid,state) VALUES (%s,'%s',NEW.uid,NEW.%s,NEW.state);
+END;"""
+
+CHANGE_SCHEMA_LIST = [
+"""CREATE TABLE IF NOT EXISTS Change (
+ seq            INTEGER PRIMARY KEY AUTOINCREMENT,
+ born TIMESTAMP NOT NULL,
+ kind           TEXT,
+ uid            TEXT,
+ submuid        TEXT,
+ state          INTEGER
+);""",
+"CREATE INDEX IF NOT EXISTS ind_Change_born ON Change( born );",
+_CHANGE_TRIGGER % ( 'trg_Submission_insert', 'INSERT', 'Submission', '', _NOW, 'subm', 'uid' ),
+_CHANGE_TRIGGER % ( 'trg_Submission_state', 'UPDATE OF state', 'Submission', 'WHEN OLD.state IS NOT NEW.state', _NOW, 'subm', 'uid' ),
+_CHANGE_TRIGGER % ( 'trg_Execution_insert', 'INSERT', 'Execution', '', _NOW, 'exec', 'submuid' ),
+_CHANGE_TRIGGER % ( 'trg_Execution_state', 'UPDATE OF state', 'Execution', 'WHEN OLD.state IS NOT NEW.state', _NOW, 'exec', 'submuid' ),
+]
+
+# Ordered schema migrations, append only: the position of a migration is the version it upgrades to.
+# DATABASE_SCHEMA_LIST builds the latest version, older databases get the migrations they are missing 
+# at startup (see database.check_database).  Databases from before the versioning are version 0, 
+# whichever of these statements they already had, hence IF (NOT) EXISTS.
+MIGRATIONS = [
+
+# 1: document snapshots
+[
+"""CREATE TABLE IF NOT EXISTS Snapshot (
+ submuid        TEXT PRIMARY KEY,
+ generation     INTEGER NOT NULL,
+ document       BLOB
+);""",
+],
+
+# 2: covering indexes for the scheduler and the logs
+[
+"CREATE INDEX IF NOT EXISTS ind_Submission_state ON Submission( state, priority, uid );",
+"CREATE INDEX IF NOT EXISTS ind_Execution_submid_state ON Execution( submuid, state );",
+"DROP INDEX IF EXISTS ind_Execution_submid;", # a prefix of ind_Execution_submid_state
+"CREATE INDEX IF NOT EXISTS ind_Log_execuid ON Log( execuid, born );",
+],
+
+# 3: indexes for the filters of the submission pages
+[
+"CREATE INDEX IF NOT EXISTS ind_Submission_user ON Submission( user, uid );",
+"CREATE INDEX IF NOT EXISTS ind_Submission_born ON Submission( born );",
+],
+
+# 4: the change feed
+CHANGE_SCHEMA_LIST,
+
+]
+
+SCHEMA_VERSION = len( MIGRATIONS )
+
+# the archives have no change feed, they skip its migration but keep the version numbers in step:
+ARCHIVE_MIGRATIONS = [ [] if m is CHANGE_SCHEMA_LIST else m for m in MIGRATIONS ]
+
 #####################################################################
 
 
@@ -96,9 +174,26 @@ SUBMISSION_WAIT = "UPDATE Submission SET state=%d WHERE uid=?;" % SUBM_STATE_NUM
 SUBMISSION_FAIL = "UPDATE Submission SET state=%d WHERE uid=?;" % SUBM_STATE_NUM['fail'] # (submid,)
 
 SELECT_SUBMISSION_RUNDATA = "SELECT document,nodelist FROM Submission WHERE uid=?;" # (submid,)
+SELECT_SUBMISSION_SCHEDDATA = "SELECT user,email,document,nodelist FROM Submission WHERE uid=?;" # (submid,)
 
 GET_SUBMISSION_LIST="SELECT uid,born,priority,title,user,state FROM Submission ORDER BY uid;"
 GET_SUBMISSION = "SELECT * FROM Submission WHERE uid=?;" # (uid,)
+
+# one page of submissions, keyset paginated by uid.  The columns and the filters are
+# filled in from the lists below, the parameters are (after uid, filter values, limit).
+# Unfiltered, the page walks the primary key; filtered by user, ind_Submission_user
+# keeps the uid order; by state, ind_Submission_state; by time, ind_Submission_born.
+GET_SUBMISSION_PAGE = "SELECT %s FROM Submission WHERE uid>?%s ORDER BY uid LIMIT ?;" # (columns, filters)
+SUBMISSION_COLUMNS = ( 'uid', 'born', 'priority', 'title', 'user', 'email', 'document', 'nodelist', 'state' )
+SUBMISSION_PAGE_COLUMNS = ( 'uid', 'born', 'priority', 'title', 'user', 'state' ) # the columns of GET_SUBMISSION_LIST
+SUBMISSION_PAGE_FILTERS = {
+  'state' : " AND state IN (%s)",  # list of states
+  'user' : " AND user IN (%s)",    # list of user names
+  'min_priority' : " AND priority>=?",
+  'max_priority' : " AND priority<=?",
+  'born_after' : " AND born>=?",
+  'born_before' : " AND born<?",
+}
  
 #########
   
@@ -113,6 +208,20 @@ EXECUTION_RUNDATA = "SELECT document FROM Execution WHERE submuid=? AND NOT( sta
 
 EXECUTION_ARGV="UPDATE Execution SET argv=? WHERE uid=?;" # (argv,uid)
 
+#########
+
+# the submission document merged with the results of all its completed executions:
+SELECT_SNAPSHOT = "SELECT generation,document FROM Snapshot WHERE submuid=?;" # (submid,)
+SELECT_SNAPSHOT_GENERATION = "SELECT generation FROM Snapshot WHERE submuid=?;" # (submid,)
+UPDATE_SNAPSHOT = "INSERT OR REPLACE INTO Snapshot (submuid,generation,document) VALUES (?,?,?);" # (submid,generation,document)
+
+#########
+
+GET_CHANGES = "SELECT seq,born,kind,uid,submuid,state FROM Change WHERE seq>? ORDER BY seq LIMIT ?;" # (since seq,limit)
+# the first seq still in the feed, older ones were purged:
+GET_CHANGES_FIRST = "SELECT coalesce( (SELECT min(seq) FROM Change), (SELECT seq+1 FROM sqlite_sequence WHERE name='Change'), 1 );"
+PURGE_CHANGES = "DELETE FROM Change WHERE born<?;" # (datetime,)
+
 #########
   
 INSERT_LOG = "INSERT INTO Log (born,execuid,body) VALUES (?,?,?);" # (date,execid,body)
@@ -124,11 +233,38 @@ GET_SUBM_EXCEPTS = "SELECT born, exception AS body FROM Execution WHERE Executio
 #########
   
 # get submissions to run (in priority order):
+# the state test is an index range of ind_Submission_state, the subquery a seek in ind_Execution_submid_state.
 GET_SCHEDULABLE_SUBM = """
-  SELECT * FROM Submission WHERE 
-    NOT EXISTS ( SELECT 1 FROM Execution WHERE Execution.submuid = Submission.uid AND Execution.state = %d )
-    AND ( state=%d OR state=%d )
-    ORDER BY priority, uid LIMIT 1;""" % ( EXEC_STATE_NUM['run'], SUBM_STATE_NUM['wait'], SUBM_STATE_NUM['subm'] )
+  SELECT uid,user FROM Submission WHERE 
+    state IN ( %d, %d )
+    AND NOT EXISTS ( SELECT 1 FROM Execution WHERE Execution.submuid = Submission.uid AND Execution.state = %d )
+    ORDER BY priority, uid LIMIT ?;""" % ( SUBM_STATE_NUM['wait'], SUBM_STATE_NUM['subm'], EXEC_STATE_NUM['run'] ) # (count,)
+
+# is a given submission (still) eligible to run:
+IS_SCHEDULABLE_SUBM = """
+  SELECT 1 FROM Submission WHERE uid=?
+    AND NOT EXISTS ( SELECT 1 FROM Execution WHERE Execution.submuid = Submission.uid AND Execution.state = %d )
+    AND ( state=%d OR state=%d );""" % ( EXEC_STATE_NUM['run'], SUBM_STATE_NUM['wait'], SUBM_STATE_NUM['subm'] ) # (submid,)
 
 #########
-  
+
+# finished submissions, moved with their executions and logs to an archive database attached as 'archive'.
+# A WAL commit is not atomic across attached databases: the copies replace, so that a move interrupted 
+# between the two databases is simply repeated.
+
+ARCHIVE_STATES = ( SUBM_STATE_NUM['done'], SUBM_STATE_NUM['fail'], SUBM_STATE_NUM['kill'] )
+
+GET_ARCHIVABLE_SUBM = "SELECT uid FROM Submission WHERE state IN ( %d, %d, %d ) AND born < ? ORDER BY uid LIMIT ?;" % ARCHIVE_STATES # (datetime,count)
+
+# logs are keyed by execution, or by submission for failures to schedule:
+_SUBM_LOG_FILTER = "execuid IN ( SELECT uid FROM main.Execution WHERE submuid=? ) OR execuid=?"
+
+ARCHIVE_SUBMISSION = "INSERT OR REPLACE INTO archive.Submission (uid,born,priority,title,user,email,document,nodelist,state) SELECT uid,born,priority,title,user,email,document,nodelist,state FROM main.Submission WHERE uid=?;" # (submid,)
+ARCHIVE_EXECUTIONS = "INSERT OR REPLACE INTO archive.Execution (uid,born,submuid,session,argv,document,exception,state) SELECT uid,born,submuid,session,argv,document,exception,state FROM main.Execution WHERE submuid=?;" # (submid,)
+ARCHIVE_LOGS = "INSERT OR REPLACE INTO archive.Log (born,execuid,body) SELECT born,execuid,body FROM main.Log WHERE %s;" % _SUBM_LOG_FILTER # (submid,submid)
+ARCHIVE_SNAPSHOT = "INSERT OR REPLACE INTO archive.Snapshot (submuid,generation,document) SELECT submuid,generation,document FROM main.Snapshot WHERE submuid=?;" # (submid,)
+
+PURGE_LOGS = "DELETE FROM main.Log WHERE %s;" % _SUBM_LOG_FILTER # (submid,submid)
+PURGE_EXECUTIONS = "DELETE FROM main.Execution WHERE submuid=?;" # (submid,)
+PURGE_SNAPSHOT = "DELETE FROM main.Snapshot WHERE submuid=?;" # (submid,)
+PURGE_SUBMISSION = "DELETE FROM main.Submission WHERE uid=?;" # (submid,)
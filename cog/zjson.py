@@ -0,0 +1,64 @@
+#####################################################################
+#
+# Copyright 2015 SpinVFX 
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+
+# Documents travel between clients and servers as XML-RPC structs, which are verbose
+# and slow to parse.  Both sides can instead send them as a binary argument holding 
+# zlib compressed JSON ("zjson"), the servers store documents in that form already.
+
+import json
+import zlib
+
+try: # version-proof
+    import xmlrpclib as xmlrpc_lib
+except ImportError :
+    import xmlrpc.client as xmlrpc_lib
+
+FORMAT = 'zjson'
+
+# -------------------------------------------------------------------
+
+def dumps( doc ):
+    "document to zjson bytes"
+    text = json.dumps( doc, separators=(',',':') )
+    if not isinstance( text, bytes ):
+        text = text.encode( 'utf-8' ) # python 3 dumps to str
+    return zlib.compress( text )
+
+# -------------------------------------------------------------------
+
+def loads( data ):
+    "zjson bytes (or buffer) to document"
+    return json.loads( zlib.decompress( data ).decode( 'utf-8' ))
+
+# -------------------------------------------------------------------
+
+def pack( doc ):
+    "document to an XML-RPC argument"
+    return xmlrpc_lib.Binary( dumps( doc ))
+
+# -------------------------------------------------------------------
+
+def is_packed( x ):
+    return isinstance( x, xmlrpc_lib.Binary )
+
+# -------------------------------------------------------------------
+
+def unpack( x ):
+    "document from an XML-RPC argument, packed or not"
+    return loads( x.data ) if is_packed( x ) else x
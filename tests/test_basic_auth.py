@@ -0,0 +1,192 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import base64
+import json
+import os
+import shutil
+import tempfile
+
+# ==========================================
+
+import cog.auth as auth
+import cog.server.noncecache as noncecache
+import cog.server.sessioncache as sessioncache
+import tests.util as util
+
+# ==========================================
+
+class FakeServer(object):
+  "the authentication of a server, without the xmlrpc"
+  def __init__(self, conf):
+    self.conf = conf
+    self.nonces = noncecache.NonceCache( 60.0, 100 )
+    self.sessions = sessioncache.SessionCache( 600.0, 100, window=4 )
+    self.nonce_count = 0
+  def get_nonce(self):
+    self.nonce_count += 1
+    nonce = base64.b64encode( auth.get_nonce() ).decode( 'ascii' )
+    self.nonces.add( nonce )
+    return nonce
+  def open_session(self, user):
+    cred = auth.UserCredentials( *user )
+    assert self.nonces.use( cred.servernonce ) and auth.verify_user_credentials( cred, self.conf )
+    key_fn = lambda session_id : auth.get_session_key( cred.username, self.conf, session_id, cred.clientnonce )
+    return [ self.sessions.open( cred.username, key_fn ), 600 ]
+  def verify(self, user, methodname):
+    cred = auth.UserCredentials( *user )
+    if auth.is_session_credentials( cred ):
+      return self.sessions.verify( cred, methodname )
+    return self.nonces.use( cred.servernonce ) and auth.verify_user_credentials( cred, self.conf )
+
+# ==========================================
+
+class BasicSession(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.conf = { 'COG_AUTHPATH' : self.tmpdir }
+    self.server = FakeServer( self.conf )
+    self.session = auth.ClientSession( auth.get_username(), self.conf )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_calls(self):
+    for i in range(10) :
+      self.assertTrue( self.server.verify( self.session.get_credentials( self.server, 'method' ), 'method' ))
+    self.assertTrue( self.session.is_open() )
+    self.assertEqual( self.server.nonce_count, 1 )
+
+  def test_replay(self):
+    cred = self.session.get_credentials( self.server, 'method' )
+    self.assertTrue( self.server.verify( cred, 'method' ))
+    self.assertFalse( self.server.verify( cred, 'method' ))
+
+  def test_method(self):
+    cred = self.session.get_credentials( self.server, 'method' )
+    self.assertFalse( self.server.verify( cred, 'other_method' ))
+
+  def test_window(self):
+    creds = [ self.session.get_credentials( self.server, 'method' ) for i in range(8) ]
+    self.assertTrue( self.server.verify( creds[2], 'method' ))
+    self.assertTrue( self.server.verify( creds[1], 'method' )) # out of order, within the window
+    self.assertTrue( self.server.verify( creds[7], 'method' ))
+    self.assertFalse( self.server.verify( creds[3], 'method' )) # too old
+
+  def test_session_path(self):
+    cred = self.session.get_credentials( self.server, 'method' )
+    self.assertTrue( auth.is_session_credentials( auth.UserCredentials( *cred )))
+    self.assertEqual( self.server.nonce_count, 1 ) # for open_session only
+    self.server.get_nonce = None # calls with the session do not ask for nonces
+    for i in range(3) :
+      self.assertTrue( self.server.verify( self.session.get_credentials( self.server, 'method' ), 'method' ))
+
+  def test_unsupported(self):
+    def fail(user):
+      raise auth.xmlrpc_lib.Fault( 1, "<class 'Exception'>:method \"open_session\" is not supported" )
+    self.server.open_session = fail
+    cred = self.session.get_credentials( self.server, 'method' )
+    self.assertFalse( auth.is_session_credentials( auth.UserCredentials( *cred )))
+    self.assertTrue( self.server.verify( cred, 'method' ))
+
+  def test_refused(self):
+    def fail(user):
+      raise auth.xmlrpc_lib.Fault( 1, "<class 'SystemError'>:Permission Denied" )
+    self.server.open_session = fail
+    self.assertRaises( auth.xmlrpc_lib.Fault, self.session.get_credentials, self.server, 'method' )
+    del self.server.open_session # the next call tries to open a session again
+    cred = self.session.get_credentials( self.server, 'method' )
+    self.assertTrue( auth.is_session_credentials( auth.UserCredentials( *cred )))
+
+  def test_knows(self):
+    cred = auth.UserCredentials( *self.session.get_credentials( self.server, 'method' ))
+    self.assertTrue( self.server.sessions.knows( cred ))
+    self.assertFalse( self.server.sessions.knows( cred._replace( username='other' )))
+    restarted = sessioncache.SessionCache( 600.0, 100 )
+    self.assertFalse( restarted.knows( cred ))
+
+# ==========================================
+
+class BasicSecretCache(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join( self.tmpdir, 'user.bin' )
+    self.write( b'first' )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def write(self, secret):
+    with open( self.filename, 'wb' ) as f :
+      f.write( secret )
+
+  def test_changed(self):
+    cache = auth._SecretCache( 10, 0.0 )
+    self.assertEqual( cache.get( self.filename ), b'first' )
+    os.remove( self.filename )
+    self.write( b'second!' )
+    self.assertEqual( cache.get( self.filename ), b'second!' )
+
+  def test_interval(self):
+    cache = auth._SecretCache( 10, 3600.0 )
+    self.assertEqual( cache.get( self.filename ), b'first' )
+    self.write( b'second!' )
+    self.assertEqual( cache.get( self.filename ), b'first' ) # not checked again yet
+
+  def test_bound(self):
+    cache = auth._SecretCache( 2, 3600.0 )
+    for i in range(5) :
+      filename = os.path.join( self.tmpdir, '%d.bin' % i )
+      with open( filename, 'wb' ) as f :
+        f.write( b'x' )
+      cache.get( filename )
+    self.assertEqual( len( cache._entries ), 2 )
+
+# ==========================================
+
+class BasicPermissions(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.conf = { 'COG_AUTHPATH' : self.tmpdir, 'COGSERVER_PERMISSIONS_EXPIRY' : 3600 }
+    self.username = auth.get_username()
+    self.group = auth.grp.getgrgid( auth.pwd.getpwnam( self.username ).pw_gid ).gr_name
+    with open( os.path.join( self.tmpdir, '_methods.json' ), 'w' ) as f :
+      json.dump( {
+        'by_user' : { 'users' : [ self.username ] },
+        'by_group' : { 'groups' : [ self.group ] },
+        'nobody' : { 'users' : [], 'groups' : [] },
+        }, f )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_verify(self):
+    logger = util.ListLogger()
+    perms = auth.MethodPermissions( self.conf, logger )
+    self.assertTrue( perms.verify( self.username, 'by_user' ))
+    self.assertTrue( perms.verify( self.username, 'by_group' ))
+    self.assertTrue( perms.verify( self.username, 'anything_else' ))
+    self.assertFalse( perms.verify( self.username, 'nobody' ))
+    self.assertEqual( len( logger.errors ), 1 )
+    self.assertEqual( perms.get_ids( self.username ), ( os.getuid(), os.getgid() ))
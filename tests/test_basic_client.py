@@ -0,0 +1,239 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import gc
+import os
+import threading
+import timeit
+
+# ==========================================
+
+import cog.auth
+import cog.conf
+import cog.server
+import cog.zjson as zjson
+
+# ==========================================
+
+class FakeProxy( object ):
+  def __init__( self, documents=() ):
+    self.calls = []
+    self.failing = False
+    self.faults = [] # faultCodes of the next calls, which do not run
+    self.documents = list( documents )
+  def __getattr__( self, name ):
+    def method( *args ):
+      if name == 'get_capabilities' :
+        return { 'documents' : self.documents }
+      if self.failing :
+        raise cog.server.xmlrpc_lib.Fault( 1, 'failing' )
+      if self.faults :
+        raise cog.server.xmlrpc_lib.Fault( self.faults.pop( 0 ), 'refused' )
+      self.calls.append( (name,) + args )
+      if name == 'batch' :
+        # answers with the names of the methods, fails kill_submission
+        return [ {'faultCode':1, 'faultString':'no'} if c[0] == 'kill_submission' else [c[0]] for c in args[1] ]
+      return args
+    return method
+
+class FakeSession( object ):
+  def __init__( self ):
+    self.opened = False
+  def is_open( self ):
+    return self.opened
+  def reset( self ):
+    self.opened = False
+  def get_credentials( self, proxy, methodname ):
+    self.opened = True
+    return ('cred', methodname)
+
+# ==========================================
+
+def make_client( servers, documents=() ):
+  c = cog.conf.get_default_config()
+  c['COG_SERVERS'] = servers
+  client = cog.server.ClientBase( c )
+  proxies = {}
+  client._get_proxy = lambda server : proxies.setdefault( server, FakeProxy( documents ))
+  client._get_session = lambda server, username : FakeSession()
+  return client, proxies
+
+# ==========================================
+
+class BasicStubs(unittest.TestCase):
+
+  def test_one(self):
+    client, proxies = make_client( 'http://a:1' )
+    ret = client.submit( 'nobody', 'title', 'doc', '', '', 1 )
+    self.assertEqual( ret, (('cred','submit'), 'title', 'doc', '', '', 1) )
+
+  def test_packed(self):
+    client, proxies = make_client( 'http://a:1', documents=[zjson.FORMAT] )
+    doc = [ {'node n1': 'op1'} ]
+    ret = client.submit( 'nobody', 'title', doc, '', '', 1 )
+    self.assertTrue( zjson.is_packed( ret[2] ))
+    self.assertEqual( zjson.unpack( ret[2] ), doc )
+    self.assertEqual( ret[3:], ('', '', 1) )
+
+  def test_all(self):
+    client, proxies = make_client( 'http://a:1,http://b:1' )
+    ret = client.get_submission_list( 'nobody' )
+    self.assertEqual( sorted( ret.keys() ), ['http://a:1','http://b:1'] )
+    self.assertEqual( ret['http://b:1'], (('cred','get_submission_list'),) )
+    self.assertEqual( client.get_last_errors(), {} )
+
+  def test_specific(self):
+    client, proxies = make_client( 'http://a:1,http://b:1' )
+    client.get_submission( 'nobody', 'http://b:1#x' )
+    self.assertEqual( list( proxies.keys() ), ['http://b:1'] )
+    self.assertEqual( proxies['http://b:1'].calls, [('get_submission', ('cred','get_submission'), 'http://b:1#x')] )
+
+  def test_partial(self):
+    client, proxies = make_client( 'http://a:1,http://b:1' )
+    client._get_proxy( 'http://a:1' ).failing = True
+    ret = client.get_server_list( 'nobody' )
+    self.assertEqual( list( ret.keys() ), ['http://b:1'] )
+    self.assertEqual( list( client.get_last_errors().keys() ), ['http://a:1'] )
+    client._get_proxy( 'http://b:1' ).failing = True
+    self.assertRaises( cog.server.xmlrpc_lib.Fault, client.get_server_list, 'nobody' )
+
+  def test_batch(self):
+    client, proxies = make_client( 'http://a:1,http://b:1' )
+    calls = [ ('get_submission', ('http://a:1#x',)), ('get_submission_log', ('http://b:1#y',)),
+              ('kill_submission', ('http://a:1#z',)), ('get_submission', ('http://b:1#w',)) ]
+    ret = client.batch( 'nobody', calls )
+    self.assertEqual( ret[0:2], ['get_submission', 'get_submission_log'] )
+    self.assertTrue( isinstance( ret[2], cog.server.xmlrpc_lib.Fault ))
+    self.assertEqual( ret[3], 'get_submission' )
+    self.assertEqual( len( proxies['http://a:1'].calls ), 1 ) # one request per server
+    name, user, servercalls = proxies['http://b:1'].calls[0]
+    self.assertEqual( (name, user), ('batch', ('cred','batch')) )
+    self.assertEqual( servercalls, [['get_submission_log', [None, 'http://b:1#y']], ['get_submission', [None, 'http://b:1#w']]] )
+    self.assertRaises( ValueError, client.batch, 'nobody', [('submit', ())] )
+
+  def test_session_refused(self):
+    client, proxies = make_client( 'http://a:1' )
+    session = FakeSession()
+    client._get_session = lambda server, username : session
+    client.submit( 'nobody', 'title', 'doc', '', '', 1 ) # opens the session
+    client._get_proxy( 'http://a:1' ).faults = [ cog.auth.SESSION_FAULT ]
+    client.submit( 'nobody', 'title', 'doc', '', '', 1 ) # runs once, with a new session
+    self.assertEqual( len( proxies['http://a:1'].calls ), 2 )
+    client._get_proxy( 'http://a:1' ).faults = [ cog.auth.SESSION_FAULT, cog.auth.SESSION_FAULT ]
+    self.assertRaises( cog.server.xmlrpc_lib.Fault, client.submit, 'nobody', 'title', 'doc', '', '', 1 )
+
+  def test_fault_not_retried(self):
+    client, proxies = make_client( 'http://a:1' )
+    session = FakeSession()
+    client._get_session = lambda server, username : session
+    client.submit( 'nobody', 'title', 'doc', '', '', 1 ) # opens the session
+    client._get_proxy( 'http://a:1' ).faults = [ 1, 1 ]
+    self.assertRaises( cog.server.xmlrpc_lib.Fault, client.submit, 'nobody', 'title', 'doc', '', '', 1 )
+    self.assertEqual( client._get_proxy( 'http://a:1' ).faults, [ 1 ] ) # called once
+
+# ==========================================
+
+def get_threads( client ):
+  "the threads that call the servers"
+  return [ v for k,ok,v in client._fanout.map( lambda key : threading.current_thread(), client._server_list ) ]
+
+class BasicClose(unittest.TestCase):
+
+  def test_close(self):
+    with make_client( 'http://a:1,http://b:1' )[0] as client :
+      self.assertEqual( len( client.get_server_list( 'nobody' )), 2 )
+      threads = get_threads( client )
+    for t in threads :
+      t.join( 2.0 )
+      self.assertFalse( t.is_alive() )
+    self.assertEqual( len( client.get_server_list( 'nobody' )), 2 ) # usable after
+    client.close()
+
+  def test_del(self):
+    before = set( threading.enumerate() )
+    client = make_client( 'http://a:1,http://b:1' )[0]
+    client.get_server_list( 'nobody' ) # the last call of the threads, they must not keep the client
+    threads = set( threading.enumerate() ) - before
+    self.assertEqual( len( threads ), 2 )
+    del client
+    gc.collect()
+    for t in threads :
+      t.join( 2.0 )
+      self.assertFalse( t.is_alive() )
+
+# ==========================================
+
+@unittest.skipUnless( os.environ.get( 'COG_BENCHMARK' ), 'set COG_BENCHMARK=1 to time the client stubs' )
+class BenchStubs(unittest.TestCase):
+  "per call overhead of the client stubs, with a no-op proxy and session"
+
+  def test_overhead(self):
+    class Client( cog.server.ClientBase ):
+      pass
+    def submit( self, user, title, document, email, nodes, priority ):
+      pass
+    Client._rpc_one( submit )
+    client = Client( make_client( 'http://a:1' )[0]._conf )
+    proxy = FakeProxy()
+    client._get_proxy = lambda server : proxy
+    client._get_session = lambda server, username : FakeSession()
+    args = ( 'nobody', 'title', 'doc', '', '', 1 )
+    # before: the stubs inspected the signature of the method at every call
+    before = lambda : client._call_one( cog.server._Plan( submit ), args, {} )
+    after = lambda : client.submit( *args )
+    count = 20000
+    times = {}
+    for name, fn in ( ('before', before), ('after', after) ):
+      times[ name ] = min( timeit.Timer( fn ).repeat( 5, count )) / count * 1e6
+      del proxy.calls[:]
+    print( '\n_rpc_one stub: %.1f us before, %.1f us after' % ( times['before'], times['after'] ))
+    self.assertTrue( times['after'] < times['before'] )
+
+# ==========================================
+
+class BasicAuthorized(unittest.TestCase):
+
+  def test_wrapper(self):
+    class Server( object ):
+      def __init__( self ):
+        self.checked = []
+      def _auth_user_method( self, user, methodname ):
+        self.checked.append( (user, methodname) )
+        return user == 'good'
+      @cog.server._authorized
+      def method( self, user, x ):
+        "doc"
+        return x
+    s = Server()
+    self.assertEqual( s.method( 'good', 1 ), 1 )
+    self.assertEqual( s.method( 'bad', 1 ), None )
+    self.assertEqual( s.checked, [('good','method'),('bad','method')] )
+    self.assertEqual( Server.method.__doc__, 'doc' )
+
+# ==========================================
+
+class BasicZJson(unittest.TestCase):
+
+  def test_roundtrip(self):
+    doc = [ {'session s1': {'code': 'x = 1'}}, {'node n1': 'op1'}, {'set': {'node.n1.inputs.a.value': [1, 2.5, 'text']}} ]
+    self.assertEqual( zjson.loads( zjson.dumps( doc )), doc )
+    self.assertEqual( zjson.unpack( zjson.pack( doc )), doc )
+    self.assertTrue( zjson.unpack( doc ) is doc ) # not packed
@@ -0,0 +1,47 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+
+# ==========================================
+
+import cog.server
+
+# ==========================================
+
+class BasicCompact(unittest.TestCase):
+
+  def test_merge(self):
+    doc = [ {'node n1' : 'op1'}, [ {'set' : {'node.n1.outputs.o.value' : 1}} ], [ {'set' : {'node.n1.outputs.o.value' : 2, 'node.n2.inputs.i.value' : 2}} ] ]
+    self.assertEqual( cog.server.compact_document( doc ), [ {'node n1' : 'op1'}, {'set' : {'node.n1.outputs.o.value' : 2, 'node.n2.inputs.i.value' : 2}} ] )
+
+  def test_order(self):
+    # sets cannot move across other objects:
+    doc = [ {'set' : {'a.b.c' : 1}}, {'node n1' : 'op1'}, {'set' : {'a.b.c' : 2}} ]
+    self.assertEqual( cog.server.compact_document( doc ), doc )
+
+  def test_parent(self):
+    # setting a parent replaces the children:
+    doc = [ {'set' : {'node.n1.inputs.x.value' : 1}}, {'set' : {'node.n1.inputs' : []}} ]
+    self.assertEqual( cog.server.compact_document( doc ), [ {'set' : {'node.n1.inputs' : []}} ] )
+    # setting a child after its parent must stay afterwards:
+    doc = [ {'set' : {'node.n1.inputs' : []}}, {'set' : {'node.n1.inputs.x' : 1}} ]
+    self.assertEqual( cog.server.compact_document( doc ), doc )
+
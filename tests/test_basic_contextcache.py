@@ -0,0 +1,60 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+
+# ==========================================
+
+import cog.server.contextcache as contextcache
+
+# ==========================================
+
+class BasicContextCache(unittest.TestCase):
+
+  def test_generation(self):
+    cache = contextcache.ContextCache( 4, 1000 )
+    cache.put( 'a', 1, 'ctx', 10 )
+    self.assertEqual( cache.get( 'a', 1 ), ('ctx', []) )
+    self.assertEqual( cache.get( 'a', 2 ), (None, None) )
+    self.assertEqual( cache.get( 'b', 1 ), (None, None) )
+
+  def test_deltas(self):
+    cache = contextcache.ContextCache( 4, 1000 )
+    cache.put( 'a', 1, 'ctx', 10 )
+    cache.add_delta( 'a', 2, [{'set' : {'node.n.outputs.o.value' : 1}}] )
+    cache.add_delta( 'a', 3, [{'set' : {'node.n.outputs.o.value' : 2}}] )
+    ctx, deltas = cache.get( 'a', 3 )
+    self.assertEqual( ctx, 'ctx' )
+    self.assertEqual( len(deltas), 2 )
+    # anything other than set operations needs a full load:
+    cache.add_delta( 'a', 4, [{'node n2' : 'op'}] )
+    self.assertEqual( cache.get( 'a', 4 ), (None, None) )
+
+  def test_evict(self):
+    cache = contextcache.ContextCache( 2, 25 )
+    cache.put( 'a', 1, 'A', 10 )
+    cache.put( 'b', 1, 'B', 10 )
+    cache.get( 'a', 1 )
+    cache.put( 'c', 1, 'C', 10 ) # over both limits, evicts the least recently used
+    self.assertEqual( cache.get( 'b', 1 ), (None, None) )
+    self.assertEqual( cache.get_stats(), (2, 20) )
+    cache.put( 'd', 1, 'D', 100 ) # too big to cache at all
+    self.assertEqual( cache.get( 'd', 1 ), (None, None) )
+
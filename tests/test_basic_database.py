@@ -0,0 +1,276 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+# ==========================================
+
+import cog.server.data.database as database
+import cog.server.data.multilock as multilock
+
+# ==========================================
+
+SCHEMA = [
+  "PRAGMA journal_mode=WAL;",
+  "CREATE TABLE Thing ( uid INTEGER PRIMARY KEY, name TEXT );",
+]
+
+BEGIN = "PRAGMA synchronous=NORMAL;"
+
+# ==========================================
+
+class BasicDatabase(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join( self.tmpdir, 'test.db' )
+    database.check_database( self.filename, SCHEMA )
+    self.db = database.Database( self.filename, BEGIN, cache_connection=True )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def test_pool_reuse(self):
+    db = self.db.clone()
+    db.sql_begin_write()
+    db.sql_insert( "INSERT INTO Thing (name) VALUES (?);", ('a',) )
+    conn = db._conn
+    db.sql_end()
+    db = self.db.clone()
+    db.sql_begin_read()
+    self.assertTrue( db._conn is conn )
+    self.assertEqual( db.sql_selectvalue( "SELECT name FROM Thing;", [] ), 'a' )
+    db.sql_end()
+
+  def test_pool_nested(self):
+    outer = self.db.clone()
+    inner = self.db.clone()
+    outer.sql_begin_read()
+    inner.sql_begin_read()
+    self.assertFalse( outer._conn is inner._conn )
+    inner.sql_end()
+    outer.sql_end()
+
+  def test_pool_threads(self):
+    conns = []
+    def work():
+      db = self.db.clone()
+      db.sql_begin_read()
+      conns.append( db._conn )
+      db.sql_end()
+    threads = [ threading.Thread( target=work ) for i in range(2) ]
+    for t in threads :
+      t.start()
+    for t in threads :
+      t.join()
+    self.assertFalse( conns[0] is conns[1] )
+
+  def test_transaction_commit(self):
+    with self.db.clone().transaction( 'insert' ) as db :
+      db.sql_insert( "INSERT INTO Thing (name) VALUES (?);", ('a',) )
+      db.sql_insert( "INSERT INTO Thing (name) VALUES (?);", ('b',) )
+    db = self.db.clone()
+    db.sql_begin_read()
+    self.assertEqual( db.sql_selectvalue( "SELECT count(*) FROM Thing;", [] ), 2 )
+    db.sql_end()
+    stats = self.db.get_transaction_stats()
+    self.assertEqual( stats['insert']['count'], 1 )
+    self.assertEqual( stats['insert']['rollbacks'], 0 )
+
+  def test_transaction_rollback(self):
+    def work():
+      with self.db.clone().transaction( 'insert' ) as db :
+        db.sql_insert( "INSERT INTO Thing (name) VALUES (?);", ('a',) )
+        db.sql_insert( "INSERT INTO Nothing (name) VALUES (?);", ('b',) )
+    self.assertRaises( Exception, work )
+    db = self.db.clone()
+    db.sql_begin_read()
+    self.assertEqual( db.sql_selectvalue( "SELECT count(*) FROM Thing;", [] ), 0 )
+    # outside of a transaction block, errors are still swallowed:
+    self.assertEqual( db.sql_selectvalue( "SELECT count(*) FROM Nothing;", [] ), None )
+    db.sql_end()
+    self.assertEqual( self.db.get_transaction_stats()['insert']['rollbacks'], 1 )
+    self.assertEqual( self.db.get_lock_stats()['state']['writer'], False )
+
+  def test_attach(self):
+    other = os.path.join( self.tmpdir, 'other.db' )
+    database.check_database( other, SCHEMA )
+    with self.db.clone().transaction( 'move' ) as db :
+      db.sql_attach( other, 'other' )
+      db.sql_insert( "INSERT INTO other.Thing (name) VALUES (?);", ('a',) )
+    # detached at the end of the transaction, the pooled connection is clean:
+    db = self.db.clone()
+    db.sql_begin_read()
+    self.assertEqual( db.sql_selectall( "PRAGMA database_list;", [] )[-1][1], 'main' )
+    db.sql_end()
+    db = database.Database( other, BEGIN )
+    db.sql_begin_read()
+    self.assertEqual( db.sql_selectvalue( "SELECT name FROM Thing;", [] ), 'a' )
+    db.sql_end()
+
+# ==========================================
+
+class BasicMigrations(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join( self.tmpdir, 'test.db' )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def columns(self):
+    db = database.Database( self.filename, BEGIN )
+    db.sql_begin_read()
+    ret = [ x[1] for x in db.sql_selectall( "PRAGMA table_info(Thing);", [] ) ]
+    db.sql_end()
+    return ret
+
+  def test_new(self):
+    database.check_database( self.filename, SCHEMA, migrations=[ ["SELECT 1;"], ["SELECT 2;"] ] )
+    self.assertEqual( database.get_schema_version( self.filename ), 2 )
+
+  def test_upgrade(self):
+    database.check_database( self.filename, SCHEMA ) # version 0
+    migrations = [ ["ALTER TABLE Thing ADD COLUMN size INTEGER;"] ]
+    database.check_database( self.filename, SCHEMA, migrations=migrations )
+    self.assertEqual( database.get_schema_version( self.filename ), 1 )
+    self.assertEqual( self.columns(), ['uid', 'name', 'size'] )
+    # already applied, not repeated:
+    database.check_database( self.filename, SCHEMA, migrations=migrations )
+    self.assertEqual( self.columns(), ['uid', 'name', 'size'] )
+
+  def test_rollback(self):
+    database.check_database( self.filename, SCHEMA )
+    migrations = [
+      ["ALTER TABLE Thing ADD COLUMN size INTEGER;"],
+      ["ALTER TABLE Thing ADD COLUMN color TEXT;", "ALTER TABLE Nothing ADD COLUMN color TEXT;"],
+      ]
+    self.assertRaises( Exception, database.check_database, self.filename, SCHEMA, None, migrations )
+    self.assertEqual( database.get_schema_version( self.filename ), 1 )
+    self.assertEqual( self.columns(), ['uid', 'name', 'size'] )
+
+# ==========================================
+
+class BasicBackup(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.filename = os.path.join( self.tmpdir, 'test.db' )
+    database.check_database( self.filename, SCHEMA )
+    self.db = database.Database( self.filename, BEGIN )
+    self.db.sql_begin_write()
+    self.db.sql_updatemany( "INSERT INTO Thing (name) VALUES (?);", [ ('x' * 1000,) for i in range(100) ] )
+    self.db.sql_end()
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def restore_count(self, backup_name):
+    restored = os.path.join( self.tmpdir, 'restored.db' )
+    database.restore( backup_name, restored )
+    db = database.Database( restored, BEGIN )
+    db.sql_begin_read()
+    ret = db.sql_selectvalue( "SELECT count(*) FROM Thing;", [] )
+    db.sql_end()
+    return ret
+
+  def test_backup(self):
+    steps = []
+    backup_name = database.backup( self.filename, os.path.join( self.tmpdir, 'bk' ), compress=False, pages=4, progress=lambda done, total : steps.append( (done, total) ) )
+    self.assertEqual( backup_name, os.path.join( self.tmpdir, 'bk.backup' ) )
+    self.assertTrue( len( steps ) > 1 )
+    self.assertEqual( steps[-1][0], steps[-1][1] )
+    self.assertEqual( self.restore_count( backup_name ), 100 )
+
+  def test_backup_compressed(self):
+    backup_name = database.backup( self.filename, os.path.join( self.tmpdir, 'bk' ) )
+    self.assertTrue( backup_name.endswith( '.gz' ) )
+    self.assertEqual( self.restore_count( backup_name ), 100 )
+
+  def test_dump(self):
+    # the format of pythons without the backup api:
+    backup_name = os.path.join( self.tmpdir, 'bk.sql' )
+    database._backup_dump( self.filename, backup_name )
+    self.assertEqual( self.restore_count( backup_name ), 100 )
+
+  def test_restore_corrupt(self):
+    backup_name = os.path.join( self.tmpdir, 'bk.backup' )
+    with open( backup_name, 'wb' ) as f :
+      f.write( b'not a database' * 100 )
+    restored = os.path.join( self.tmpdir, 'restored.db' )
+    self.assertRaises( Exception, database.restore, backup_name, restored )
+    self.assertFalse( os.path.isfile( restored ) )
+
+# ==========================================
+
+class BasicMultilock(unittest.TestCase):
+
+  def test_readers_and_writer(self):
+    lock = multilock.Multilock()
+    self.assertTrue( lock.acquire_read() )
+    self.assertTrue( lock.acquire_read() )
+    self.assertTrue( lock.acquire_write() )
+    self.assertFalse( lock.acquire_write( 0.05 ) ) # one writer
+    self.assertFalse( lock.acquire_exclusive( 0.05 ) )
+    lock.release_write()
+    lock.release_read()
+    lock.release_read()
+    self.assertTrue( lock.acquire_exclusive( 0.05 ) )
+    self.assertFalse( lock.acquire_read( 0.05 ) )
+    lock.release_exclusive()
+    stats = lock.get_stats()
+    self.assertEqual( stats['read']['acquired'], 2 )
+    self.assertEqual( stats['read']['timeouts'], 1 )
+    self.assertEqual( stats['exclusive']['contended'], 1 )
+    self.assertEqual( stats['state']['readers'], 0 )
+
+  def test_exclusive_preference(self):
+    lock = multilock.Multilock()
+    lock.acquire_read()
+    got = []
+    t = threading.Thread( target=lambda : got.append( lock.acquire_exclusive( 5.0 )))
+    t.start()
+    while not lock.get_stats()['state']['exclusive_waiting'] :
+      time.sleep( 0.01 )
+    self.assertFalse( lock.acquire_read( 0.05 ) ) # new readers wait behind the exclusive lock
+    lock.release_read()
+    t.join()
+    self.assertEqual( got, [True] )
+    lock.release_exclusive()
+    self.assertTrue( lock.acquire_read( 0.05 ) )
+
+  def test_database_stats(self):
+    tmpdir = tempfile.mkdtemp()
+    try:
+      filename = os.path.join( tmpdir, 'test.db' )
+      database.check_database( filename, SCHEMA )
+      db = database.Database( filename, BEGIN )
+      db.sql_begin_read()
+      db.sql_end()
+      self.assertEqual( db.clone().get_lock_stats()['read']['acquired'], 1 )
+    finally:
+      shutil.rmtree( tmpdir )
+
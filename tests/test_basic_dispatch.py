@@ -0,0 +1,126 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import threading
+import time
+
+# ==========================================
+
+import cog.server.dispatch as dispatch
+import tests.util as util
+
+# ==========================================
+
+class BasicDispatcher(unittest.TestCase):
+
+  def setUp(self):
+    self.release = threading.Event()
+    self.done = []
+    self.logger = util.ListLogger()
+
+  def tearDown(self):
+    self.release.set()
+
+  def block( self, key ):
+    self.release.wait( 5.0 )
+    if key == 'bad' :
+      raise ValueError( key )
+
+  def make( self, workers, per_user=0 ):
+    return dispatch.Dispatcher( workers, per_user, lambda : self.done.append( 1 ), self.logger )
+
+  def test_same_key(self):
+    d = self.make( 4 )
+    self.assertTrue( d.dispatch( 'a', 'u1', self.block, 'a' ))
+    self.assertFalse( d.dispatch( 'a', 'u2', self.block, 'a' )) # already in flight
+    self.assertTrue( d.dispatch( 'b', 'u1', self.block, 'b' ))
+    self.assertEqual( d.get_inflight(), 2 )
+    self.release.set()
+    d.shutdown()
+    self.assertEqual( d.get_inflight(), 0 )
+
+  def test_global_limit(self):
+    d = self.make( 2 )
+    self.assertTrue( d.dispatch( 'a', 'u1', self.block, 'a' ))
+    self.assertTrue( d.dispatch( 'b', 'u2', self.block, 'b' ))
+    self.assertTrue( d.is_full() )
+    self.assertFalse( d.dispatch( 'c', 'u3', self.block, 'c' ))
+    self.release.set()
+    d.shutdown()
+
+  def test_per_user_limit(self):
+    d = self.make( 4, per_user=1 )
+    self.assertTrue( d.dispatch( 'a', 'u1', self.block, 'a' ))
+    self.assertFalse( d.dispatch( 'b', 'u1', self.block, 'b' ))
+    self.assertTrue( d.dispatch( 'c', 'u2', self.block, 'c' ))
+    self.release.set()
+    d.shutdown()
+
+  def test_on_done(self):
+    d = self.make( 2 )
+    self.release.set()
+    self.assertTrue( d.dispatch( 'good', 'u1', self.block, 'good' ))
+    self.assertTrue( d.dispatch( 'bad', 'u1', self.block, 'bad' ))
+    d.shutdown()
+    self.assertEqual( len( self.done ), 2 ) # after success and after the exception
+    self.assertEqual( d.get_inflight(), 0 )
+    self.assertTrue( any( 'ValueError' in e for e in self.logger.errors ))
+
+# ==========================================
+
+class BasicFanout(unittest.TestCase):
+
+  def test_map(self):
+    fanout = dispatch.Fanout()
+    def fn( key, x ):
+      if key == 'b' :
+        raise ValueError( key )
+      return key * x
+    ret = fanout.map( fn, ['a','b','c'], 2 )
+    self.assertEqual( [ (k,ok) for k,ok,v in ret ], [('a',True),('b',False),('c',True)] )
+    self.assertEqual( ret[0][2], 'aa' )
+    self.assertTrue( isinstance( ret[1][2], ValueError ))
+    fanout.shutdown()
+
+  def test_parallel(self):
+    fanout = dispatch.Fanout()
+    start = time.time()
+    fanout.map( lambda key : time.sleep( 0.2 ), range(5) )
+    self.assertTrue( time.time() - start < 0.8 )
+    fanout.shutdown()
+
+  def test_same_thread(self):
+    fanout = dispatch.Fanout()
+    first = dict( (k,v) for k,ok,v in fanout.map( lambda key : threading.current_thread(), ['a','b'] ))
+    second = dict( (k,v) for k,ok,v in fanout.map( lambda key : threading.current_thread(), ['a','b'] ))
+    self.assertEqual( first, second )
+    self.assertNotEqual( first['a'], first['b'] )
+    fanout.shutdown()
+
+  def test_shutdown(self):
+    fanout = dispatch.Fanout()
+    threads = [ v for k,ok,v in fanout.map( lambda key : threading.current_thread(), ['a','b'] ) ]
+    fanout.shutdown()
+    for t in threads :
+      t.join( 2.0 )
+      self.assertFalse( t.is_alive() )
+    self.assertEqual( [ v for k,ok,v in fanout.map( lambda key : key, ['a'] ) ], ['a'] ) # starts again
+    fanout.shutdown()
@@ -0,0 +1,118 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import base64
+import shutil
+import socket
+import sys
+import tempfile
+
+# ==========================================
+
+import cog.auth as auth
+import cog.capture as capture
+import cog.host as host
+
+# ==========================================
+
+class FakeProxy(object):
+  "stands in for the xmlrpc server proxy"
+  def __init__(self):
+    self.chunks = []
+  def get_nonce(self):
+    return base64.b64encode( auth.get_nonce() )
+  def open_session(self, user):
+    # no sessions, the calls authenticate with nonces
+    raise host.xmlrpc_lib.Fault( 1, "<class 'Exception'>:method \"open_session\" is not supported" )
+  def append_log(self, user, execid, log):
+    self.chunks.append( log )
+    return True
+
+# ==========================================
+
+class BasicLogWriter(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.conf = { 'COG_AUTHPATH' : self.tmpdir }
+    self.proxy = FakeProxy()
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def make_writer(self, size, interval):
+    session = auth.ClientSession( auth.get_username(), self.conf )
+    return host.LogWriter( self.proxy, 'http://localhost#1', session, size, interval )
+
+  def test_size(self):
+    writer = self.make_writer( 10, 3600.0 )
+    writer.write( 'abcd' )
+    self.assertEqual( self.proxy.chunks, [] )
+    writer.write( 'efghijk' )
+    self.assertEqual( self.proxy.chunks, ['abcdefghijk'] )
+    writer.write( 'lmn' )
+    self.assertEqual( writer.get_unsent(), 'lmn' ) # only what was not sent is kept
+    self.assertTrue( writer.send() )
+    self.assertEqual( self.proxy.chunks, ['abcdefghijk', 'lmn'] )
+
+  def test_capture(self):
+    writer = self.make_writer( 10, 3600.0 )
+    with capture.StreamCapture( writer ) as output:
+      sys.stdout.write( 'abcdefghijk' )
+      sys.stderr.write( 'lmn' )
+    self.assertEqual( self.proxy.chunks[0], 'abcdefghijk' )
+    self.assertTrue( output.getvalue()[-1].endswith( 'lmn' )) # the buffer is the writer
+
+  def test_interval(self):
+    writer = self.make_writer( 1000, 0.0 )
+    writer.write( 'a' )
+    writer.write( 'b' )
+    self.assertEqual( self.proxy.chunks, ['a', 'b'] )
+    self.assertEqual( writer.get_unsent(), '' )
+
+  def test_unsupported(self):
+    def fail(*args):
+      raise host.xmlrpc_lib.Fault( 1, 'method "append_log" is not supported' )
+    self.proxy.append_log = fail
+    writer = self.make_writer( 1, 0.0 )
+    writer.write( 'a' )
+    writer.write( 'b' )
+    self.assertFalse( writer.send() )
+    self.assertEqual( writer.get_unsent(), 'ab' )
+
+  def test_network_errors(self):
+    def fail(*args):
+      raise socket.error( 'down' )
+    self.proxy.append_log = fail
+    writer = self.make_writer( 1, 0.0 )
+    for c in 'abcd' :
+      writer.write( c ) # gives up streaming after SEND_FAILURES errors
+    self.assertFalse( writer.send() )
+    self.assertEqual( writer.get_unsent(), 'abcd' )
+
+  def test_other_errors(self):
+    def fail(*args):
+      raise TypeError( 'cannot marshal' )
+    self.proxy.append_log = fail
+    writer = self.make_writer( 1, 0.0 )
+    self.assertRaises( TypeError, writer.write, 'a' )
+    writer.write( 'b' ) # streaming has stopped, the text is kept for the results
+    self.assertEqual( writer.get_unsent(), 'ab' )
@@ -0,0 +1,130 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import os
+import datetime
+import shutil
+import tempfile
+import threading
+
+# ==========================================
+
+import cog.server.data.database as database
+import cog.server.logsink as logsink
+
+# ==========================================
+
+SCHEMA = [
+  "CREATE TABLE Log ( born TIMESTAMP, execuid TEXT, body TEXT, PRIMARY KEY( born, execuid ) );",
+]
+
+BEGIN = "PRAGMA synchronous=NORMAL;"
+
+INSERT = "INSERT INTO Log (born, execuid, body) VALUES (?,?,?);"
+
+# ==========================================
+
+class BasicLogSink(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    filename = os.path.join( self.tmpdir, 'test.db' )
+    database.check_database( filename, SCHEMA )
+    self.db = database.Database( filename, BEGIN, cache_connection=True )
+
+  def tearDown(self):
+    shutil.rmtree( self.tmpdir )
+
+  def count(self):
+    db = self.db.clone()
+    db.sql_begin_read()
+    ret = db.sql_selectvalue( "SELECT count(*) FROM Log;", [] )
+    db.sql_end()
+    return ret
+
+  def test_batches(self):
+    sink = logsink.LogSink( self.db, INSERT, lambda x : x.upper(), flush_size=10, flush_interval=60.0 )
+    for i in range(25) :
+      sink.write( 'e%d' % (i % 3), 'line %d' % i )
+    self.assertTrue( sink.flush( 10.0 ) )
+    self.assertEqual( self.count(), 25 )
+    stats = sink.get_stats()
+    self.assertEqual( stats['written'], 25 )
+    self.assertEqual( stats['batches'], 3 )
+    sink.shutdown()
+
+  def test_interval(self):
+    sink = logsink.LogSink( self.db, INSERT, str, flush_size=100, flush_interval=0.05, sync=True )
+    sink.write( 'e', 'line' ) # returns once committed, well before the batch is full
+    sink.write( 'e', '' ) # empty logs are not written
+    self.assertEqual( self.count(), 1 )
+    sink.shutdown()
+
+  def test_failure(self):
+    sink = logsink.LogSink( self.db, "INSERT INTO Nothing VALUES (?,?,?);", str, flush_interval=0.0 )
+    sink.write( 'e', 'line' )
+    sink.shutdown()
+    self.assertEqual( sink.get_stats()['failed'], 1 )
+    self.assertEqual( self.count(), 0 )
+
+  def test_bad_entry(self):
+    def encode( log ):
+      if log == 'bad' :
+        raise ValueError( log )
+      return log
+    sink = logsink.LogSink( self.db, INSERT, encode, flush_size=10, flush_interval=60.0 )
+    for log in ( 'a', 'bad', 'b' ) :
+      sink.write( 'e', log )
+    self.assertTrue( sink.flush( 10.0 ) )
+    self.assertEqual( self.count(), 2 ) # the rest of the batch is written
+    self.assertEqual( sink.get_stats()['failed'], 1 )
+    sink.shutdown()
+
+  def test_bad_row(self):
+    sink = logsink.LogSink( self.db, INSERT, str, flush_size=10, flush_interval=60.0 )
+    born = datetime.datetime.now()
+    for execid in ( 'e1', 'e2', 'e2', 'e3' ) :
+      sink.write( execid, 'line', born ) # the second e2 breaks the primary key, and the batch
+    self.assertTrue( sink.flush( 10.0 ) )
+    self.assertEqual( self.count(), 3 ) # retried one by one
+    stats = sink.get_stats()
+    self.assertEqual( (stats['written'], stats['failed']), (3, 1) )
+    sink.shutdown()
+
+  def test_stuck(self):
+    sink = logsink.LogSink( self.db, INSERT, str, flush_size=1, flush_interval=60.0 )
+    release = threading.Event()
+    write = sink._write
+    sink._write = lambda batch : ( release.wait( 5.0 ), write( batch ))
+    sink.write( 'e', 'line' )
+    self.assertFalse( sink.flush( 0.1 )) # does not wait for ever
+    release.set()
+    self.assertTrue( sink.flush( 10.0 ))
+    sink.shutdown()
+
+  def test_closed(self):
+    sink = logsink.LogSink( self.db, INSERT, str, flush_size=1, flush_interval=60.0, sync=True )
+    sink.write( 'e', 'line' )
+    sink.shutdown()
+    self.assertFalse( sink.flush() ) # returns at once, nobody writes anymore
+    sink.write( 'e', 'too late' ) # dropped, does not wait for ever either
+    self.assertEqual( self.count(), 1 )
+    self.assertEqual( sink.get_stats()['failed'], 1 )
@@ -0,0 +1,53 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import time
+
+# ==========================================
+
+import cog.server.noncecache as noncecache
+
+# ==========================================
+
+class BasicNonceCache(unittest.TestCase):
+
+  def test_once(self):
+    cache = noncecache.NonceCache( 60.0, 10 )
+    cache.add( 'a' )
+    self.assertTrue( cache.use( 'a' ))
+    self.assertFalse( cache.use( 'a' ))
+    self.assertFalse( cache.use( 'b' ))
+
+  def test_expiry(self):
+    cache = noncecache.NonceCache( 0.05, 10 )
+    cache.add( 'a' )
+    time.sleep( 0.1 )
+    self.assertFalse( cache.use( 'a' ))
+    cache.add( 'b' ) # prunes 'a'
+    self.assertEqual( len( cache ), 1 )
+
+  def test_bound(self):
+    cache = noncecache.NonceCache( 60.0, 10 )
+    for i in range(100) :
+      cache.add( i )
+    self.assertEqual( len( cache ), 10 )
+    self.assertFalse( cache.use( 0 ))
+    self.assertTrue( cache.use( 99 ))
@@ -0,0 +1,165 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import os
+import subprocess
+import sys
+import time
+
+# ==========================================
+
+import cog.server.sandbox as sandbox
+import tests.util as util
+
+# ==========================================
+
+# sandboxes change user, so these tests need root and an unprivileged account:
+NOBODY = 65534
+
+def get_ids( seconds ):
+    time.sleep( seconds )
+    print( "ids" )
+    return ( os.getuid(), os.getgid() )
+
+def get_pid():
+    return os.getpid()
+
+def crash():
+    os._exit( 1 )
+
+# ==========================================
+
+class BasicRunFuture(unittest.TestCase):
+
+  def test_callback_error(self):
+    logger = util.ListLogger()
+    future = sandbox.RunFuture( logger )
+    done = []
+    future.add_done_callback( lambda f : 1 / 0 )
+    future.add_done_callback( lambda f : done.append( f.result() ))
+    future._finish( 'result', None )
+    self.assertEqual( done, ['result'] ) # the failing callback does not stop the others
+    self.assertTrue( 'ZeroDivisionError' in logger.errors[-1] )
+
+# ==========================================
+
+@unittest.skipUnless( hasattr( os, 'getuid' ) and os.getuid() == 0, "sandbox tests must run as root" )
+class BasicSandboxPool(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.pool = sandbox.SandboxPool( 3 )
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.pool.shutdown()
+
+  def test_submit(self):
+    result = self.pool.submit( sandbox.Runnable( NOBODY, NOBODY, get_ids, (0,), {} ))
+    self.assertEqual( result.exc, None )
+    self.assertEqual( tuple(result.ret), (NOBODY, NOBODY) )
+    self.assertEqual( result.stdout, 'ids' )
+
+  def test_concurrent(self):
+    start = time.time()
+    futures = [ self.pool.submit_async( sandbox.Runnable( NOBODY, NOBODY, get_ids, (1,), {} )) for i in range(3) ]
+    results = [ f.result() for f in futures ]
+    self.assertTrue( all( r.exc is None for r in results ))
+    self.assertTrue( time.time() - start < 2.5 )
+
+  def test_callback(self):
+    done = []
+    future = self.pool.submit_async( sandbox.Runnable( NOBODY, NOBODY, get_ids, (0,), {} ))
+    future.result()
+    future.add_done_callback( lambda f : done.append( f.result().ret ))
+    self.assertEqual( len(done), 1 )
+
+  def test_root_denied(self):
+    self.assertRaises( SystemError, self.pool.submit, sandbox.Runnable( 0, 0, get_ids, (0,), {} ))
+
+# ==========================================
+
+@unittest.skipUnless( hasattr( os, 'getuid' ) and os.getuid() == 0, "sandbox tests must run as root" )
+class BasicSandboxReuse(unittest.TestCase):
+
+  def setUp(self):
+    self.pool = sandbox.SandboxPool( 1, reuse_workers=True, max_runnables=3 )
+
+  def tearDown(self):
+    self.pool.shutdown()
+
+  def test_reuse(self):
+    pids = [ self.pool.submit( sandbox.Runnable( NOBODY, NOBODY, get_pid, (), {} )).ret for i in range(6) ]
+    self.assertEqual( len(set(pids)), 2 ) # recycled after 3 runnables
+    result = self.pool.submit( sandbox.Runnable( NOBODY, NOBODY, get_ids, (0,), {} ))
+    self.assertEqual( tuple(result.ret), (NOBODY, NOBODY) )
+
+  def test_crash(self):
+    result = self.pool.submit( sandbox.Runnable( NOBODY, NOBODY, crash, (), {} ))
+    self.assertEqual( tuple(result), (None, None, '') )
+    result = self.pool.submit( sandbox.Runnable( NOBODY, NOBODY, get_ids, (0,), {} ))
+    self.assertEqual( result.exc, None )
+
+# ==========================================
+
+# a server with a pool of sidecars, which exits in the way given:
+SERVER = """
+import os, sys
+import cog.server.sandbox as sandbox
+pool = sandbox.SandboxPool( 2 )
+print( ' '.join( str( sb._p.pid ) for sb in pool._sandboxes ))
+sys.stdout.flush()
+%s
+"""
+
+def is_running( pid ):
+  try:
+    with open( '/proc/%d/status' % pid ) as f :
+      return '\tZ' not in [ line for line in f if line.startswith( 'State:' ) ][0] # a zombie has exited
+  except IOError :
+    return False
+
+def wait_until( fn, seconds ):
+  deadline = time.time() + seconds
+  while not fn() and time.time() < deadline :
+    time.sleep( 0.05 )
+  return fn()
+
+@unittest.skipUnless( os.path.isdir( '/proc' ), "needs /proc to watch the sidecars" )
+class BasicSidecarExit(unittest.TestCase):
+
+  def start(self, ending):
+    root = os.path.dirname( os.path.dirname( os.path.abspath( __file__ )))
+    server = subprocess.Popen( [ sys.executable, '-c', SERVER % ending ], cwd=root, stdout=subprocess.PIPE )
+    pids = [ int( x ) for x in server.stdout.readline().split() ]
+    server.stdout.close()
+    self.assertEqual( len( pids ), 2 )
+    return server, pids
+
+  def test_exit(self):
+    server, pids = self.start( 'pass' ) # no shutdown(), the sidecars are shut down at exit
+    self.assertTrue( wait_until( lambda : server.poll() is not None, 10.0 ))
+    self.assertTrue( wait_until( lambda : not any( is_running( pid ) for pid in pids ), 5.0 ))
+
+  def test_killed(self):
+    server, pids = self.start( 'os._exit( 1 )' ) # no atexit either
+    server.wait()
+    self.assertTrue( wait_until( lambda : not any( is_running( pid ) for pid in pids ), 5.0 ))
@@ -0,0 +1,347 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import os
+import datetime
+import logging
+import shutil
+import tempfile
+
+# ==========================================
+
+import cog.conf
+import cog.server
+import cog.server.data.database as database
+import cog.server.sql as sql
+import cog.uid as uid
+import cog.zjson as zjson
+
+# ==========================================
+
+URL = 'http://localhost:1'
+USER = ('nobody', '', '', '')
+
+def make_app( tmpdir, **parms ):
+  "a ServerApp over a scratch database, which lets everyone call everything"
+  c = cog.conf.get_default_server_config()
+  c['COG_AUTHPATH'] = tmpdir
+  c['COGSERVER_DATABASE'] = os.path.join( tmpdir, 'cog.db' )
+  c['COGSERVER_BACKUPPATH'] = tmpdir
+  c['COGSERVER_ARCHIVEPATH'] = os.path.join( tmpdir, 'archive' )
+  c['COGSERVER_SANDBOX_WORKERS'] = 1
+  c.update( parms )
+  app = cog.server.ServerApp( URL, c, logging.CRITICAL )
+  app._auth_user_method = lambda user, methodname : True
+  return app
+
+def close_app( app ):
+  app._stop_tasks()
+  app._dispatcher.shutdown()
+  app._logsink.shutdown()
+  app._sandbox.shutdown()
+
+def add_submission( app, born, state='subm', user='nobody', priority=1 ):
+  "inserts a submission directly, out of reach of the scheduler, returns its uid"
+  subm = uid.pretty_print( uid.create_uid( born ))
+  with app._db.clone().transaction( 'test' ) as db :
+    db.sql_insert( sql.INSERT_SUBMISSION, (subm, born, priority, 'title', user, '', app._encode_doc( [] ), 'n1') )
+    db.sql_update( "UPDATE Submission SET state=? WHERE uid=?;", (sql.SUBM_STATE_NUM[ state ], subm) )
+  return subm
+
+def add_execution( app, subm, born, state='run' ):
+  execuid = uid.pretty_print( uid.create_uid( born ))
+  with app._db.clone().transaction( 'test' ) as db :
+    db.sql_insert( sql.INSERT_EXECUTION, (execuid, subm, born, '', '', sql.EXEC_STATE_NUM[ state ], '', '') )
+  return execuid
+
+# ==========================================
+
+class BasicServerApp(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.app = make_app( self.tmpdir )
+
+  def tearDown(self):
+    close_app( self.app )
+    shutil.rmtree( self.tmpdir )
+
+  def test_text_log(self):
+    now = datetime.datetime.now()
+    subm = add_submission( self.app, now )
+    execuid = add_execution( self.app, subm, now )
+    self.app.append_log( USER, '%s#%s' % (URL, execuid), u'line one\nd\u00e9j\u00e0 vu\n' )
+    logs = self.app.get_submission_log( USER, '%s#%s' % (URL, subm) )
+    self.assertEqual( [ d['body'] for d in logs ], [ u'line one\nd\u00e9j\u00e0 vu\n' ] )
+    self.assertEqual( self.app._logsink.get_stats()['failed'], 0 )
+
+  def test_batch_faults(self):
+    now = datetime.datetime.now()
+    subm = '%s#%s' % (URL, add_submission( self.app, now, state='done' ))
+    ret = self.app.batch( USER, [ ['get_submission', [None, subm]], ['get_submission', [None, 'nohash']], ['submit', []] ] )
+    self.assertEqual( ret[0][0]['uid'], subm )
+    self.assertEqual( ret[1]['faultCode'], 1 )
+    self.assertTrue( ret[1]['faultString'].startswith( 'ValueError:' )) # the name of the type, not its repr
+    self.assertEqual( ret[2], { 'faultCode' : 1, 'faultString' : 'ValueError:submit cannot be batched' } )
+    class Refusing( object ):
+      def verify( self, username, methodname ):
+        raise cog.server.xmlrpc_lib.Fault( 4002, 'refused' )
+    self.app._auth = Refusing()
+    self.assertEqual( self.app.batch( USER, [ ['get_submission', [None, subm]] ] ), [ { 'faultCode' : 4002, 'faultString' : 'refused' } ] )
+
+  def test_backup(self):
+    self.app._task_backup()
+    self.app._backup_thread.join( 30.0 )
+    self.assertTrue( any( name.startswith( 'cog.db.backup' ) for name in os.listdir( self.tmpdir )))
+
+# ==========================================
+
+class BasicSubmissionPage(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.app = make_app( self.tmpdir )
+    start = datetime.datetime( 2020, 1, 1 )
+    self.subms = []
+    for i in range( 7 ):
+      born = start + datetime.timedelta( days=i )
+      state = ( 'done', 'fail', 'kill' )[ i % 3 ]
+      user = 'nobody' if i < 4 else 'somebody'
+      self.subms.append( '%s#%s' % (URL, add_submission( self.app, born, state=state, user=user, priority=i )))
+
+  def tearDown(self):
+    close_app( self.app )
+    shutil.rmtree( self.tmpdir )
+
+  def get_uids(self, query):
+    return [ d['uid'] for d in self.app.get_submission_page( USER, query )['rows'] ]
+
+  def test_pages(self):
+    uids = []
+    cursor = None
+    while True :
+      page = self.app.get_submission_page( USER, { 'limit' : 3, 'cursor' : cursor } )
+      self.assertTrue( len( page['rows'] ) <= 3 )
+      uids.extend( d['uid'] for d in page['rows'] )
+      cursor = page['cursor']
+      if not page['more'] :
+        break
+    self.assertEqual( uids, sorted( self.subms ))
+    self.assertEqual( self.app.get_submission_page( USER, { 'cursor' : cursor } )['rows'], [] )
+
+  def test_limit(self):
+    self.assertEqual( len( self.get_uids( { 'limit' : 0 } )), 1 )
+    self.assertEqual( len( self.get_uids( { 'limit' : -5 } )), 1 )
+    self.assertEqual( len( self.get_uids( { 'limit' : 10 ** 9 } )), 7 )
+
+  def test_filters(self):
+    self.assertEqual( self.get_uids( { 'state' : ['done'] } ), sorted( self.subms[0::3] ))
+    self.assertEqual( self.get_uids( { 'state' : ['fail','kill'], 'user' : ['somebody'] } ), sorted( self.subms[4:6] ))
+    self.assertEqual( self.get_uids( { 'min_priority' : 2, 'max_priority' : 3 } ), sorted( self.subms[2:4] ))
+    self.assertEqual( self.get_uids( { 'born_after' : '2020-01-03', 'born_before' : '2020-01-05' } ), sorted( self.subms[2:4] ))
+    self.assertEqual( self.get_uids( { 'born_after' : cog.server.xmlrpc_lib.DateTime( datetime.datetime( 2020, 1, 7 )) } ), self.subms[6:] )
+
+  def test_columns(self):
+    rows = self.app.get_submission_page( USER, { 'columns' : ['title','state'] } )['rows']
+    self.assertEqual( sorted( rows[0].keys() ), ['state','title','uid'] ) # the uid comes anyway
+    self.assertEqual( rows[0]['state'], 'done' )
+    rows = self.app.get_submission_page( USER, {} )['rows']
+    self.assertEqual( sorted( rows[0].keys() ), sorted( sql.SUBMISSION_PAGE_COLUMNS ))
+
+  def test_unknown(self):
+    self.assertRaises( ValueError, self.app.get_submission_page, USER, { 'columns' : ['uid; DROP TABLE Submission'] } )
+    self.assertRaises( ValueError, self.app.get_submission_page, USER, { 'colour' : 'red' } )
+
+  def test_cursors(self):
+    first = self.app.get_submission_page( USER, { 'limit' : 2 } )
+    cursors = { URL : first['cursor'], 'http://elsewhere:1' : 'http://elsewhere:1#zzz' }
+    page = self.app.get_submission_page( USER, { 'limit' : 2, 'cursor' : cursors } )
+    self.assertEqual( [ d['uid'] for d in page['rows'] ], sorted( self.subms )[2:4] )
+    page = self.app.get_submission_page( USER, { 'cursor' : { 'http://elsewhere:1' : 'zzz' } } )
+    self.assertEqual( len( page['rows'] ), 7 ) # no cursor of this server, from the start
+
+# ==========================================
+
+def count_rows( filename, table, column, value ):
+  with database.Database( filename, sql.DATABASE_BEGIN ).transaction( 'test', write=False ) as db :
+    return db.sql_selectall( "SELECT count(*) FROM %s WHERE %s=?;" % (table, column), (value,) )[0][0]
+
+class BasicArchive(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.app = make_app( self.tmpdir )
+    self.filename = os.path.join( self.tmpdir, 'cog.db' )
+    old = datetime.datetime.now() - datetime.timedelta( days=60 )
+    self.done = add_submission( self.app, old, state='done' )
+    self.execuid = add_execution( self.app, self.done, old, state='done' )
+    self.app.append_log( USER, '%s#%s' % (URL, self.execuid), 'finished\n' )
+    self.app._logsink.flush()
+    with self.app._db.clone().transaction( 'test' ) as db :
+      db.sql_update( sql.UPDATE_SNAPSHOT, (self.done, 3, self.app._encode_doc( [] )) )
+    self.running = add_submission( self.app, old + datetime.timedelta( seconds=1 ), state='run' )
+    self.running_exec = add_execution( self.app, self.running, old )
+    self.recent = add_submission( self.app, datetime.datetime.now(), state='done' )
+    self.app._task_archive()
+
+  def tearDown(self):
+    close_app( self.app )
+    shutil.rmtree( self.tmpdir )
+
+  def test_moved(self):
+    archivename = self.app._get_archive_name( self.done )
+    self.assertTrue( os.path.isfile( archivename ))
+    for table, column, value in ( ('Submission', 'uid', self.done), ('Execution', 'submuid', self.done),
+                                  ('Log', 'execuid', self.execuid), ('Snapshot', 'submuid', self.done) ):
+      self.assertEqual( count_rows( self.filename, table, column, value ), 0 )
+      self.assertEqual( count_rows( archivename, table, column, value ), 1 )
+
+  def test_kept(self):
+    self.assertEqual( count_rows( self.filename, 'Submission', 'uid', self.running ), 1 ) # not finished
+    self.assertEqual( count_rows( self.filename, 'Execution', 'submuid', self.running ), 1 )
+    self.assertEqual( count_rows( self.filename, 'Submission', 'uid', self.recent ), 1 ) # not old enough
+    self.assertEqual( self.app.get_submission( USER, '%s#%s' % (URL, self.running) )['state'], 'run' )
+
+  def test_fallback(self):
+    ret = self.app.get_submission( USER, '%s#%s' % (URL, self.done) )
+    self.assertEqual( (ret['uid'], ret['state'], ret['document']), ('%s#%s' % (URL, self.done), 'done', []) )
+    logs = self.app.get_submission_log( USER, '%s#%s' % (URL, self.done) )
+    self.assertEqual( [ d['body'] for d in logs ], [ 'finished\n' ] )
+
+  def test_again(self):
+    self.app._task_archive() # nothing left to move, nothing lost
+    self.assertEqual( count_rows( self.app._get_archive_name( self.done ), 'Submission', 'uid', self.done ), 1 )
+    self.assertEqual( count_rows( self.filename, 'Submission', 'uid', self.running ), 1 )
+
+# ==========================================
+
+def set_state( app, table, rowuid, state ):
+  with app._db.clone().transaction( 'test' ) as db :
+    db.sql_update( "UPDATE %s SET state=? WHERE uid=?;" % table, (state, rowuid) )
+
+class BasicChanges(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.app = make_app( self.tmpdir )
+
+  def tearDown(self):
+    close_app( self.app )
+    shutil.rmtree( self.tmpdir )
+
+  def get_changes(self, since_seq, limit=0):
+    return self.app.get_changes( USER, since_seq, limit )
+
+  def test_triggers(self):
+    now = datetime.datetime.now()
+    subm = add_submission( self.app, now, state='run' )
+    execuid = add_execution( self.app, subm, now )
+    set_state( self.app, 'Execution', execuid, sql.EXEC_STATE_NUM['done'] )
+    set_state( self.app, 'Execution', execuid, sql.EXEC_STATE_NUM['done'] ) # no change, not recorded
+    set_state( self.app, 'Submission', subm, sql.SUBM_STATE_NUM['done'] )
+    ret = self.get_changes( 0 )
+    self.assertEqual( [ (d['kind'], d['uid'], d['state']) for d in ret['changes'] ], [
+      ('subm', '%s#%s' % (URL, subm), 'subm'),
+      ('subm', '%s#%s' % (URL, subm), 'run'),
+      ('exec', '%s#%s' % (URL, execuid), 'run'),
+      ('exec', '%s#%s' % (URL, execuid), 'done'),
+      ('subm', '%s#%s' % (URL, subm), 'done') ] )
+    self.assertEqual( set( d['submid'] for d in ret['changes'] ), set([ '%s#%s' % (URL, subm) ]) )
+    self.assertTrue( all( abs( d['born'] - now ) < datetime.timedelta( minutes=1 ) for d in ret['changes'] ))
+    self.assertEqual( (ret['seq'], ret['more'], ret['reset']), (ret['changes'][-1]['seq'], False, False) )
+
+  def test_pages(self):
+    for i in range( 5 ):
+      add_submission( self.app, datetime.datetime.now(), state='done' )
+    seqs = []
+    seq = 0
+    while True :
+      ret = self.get_changes( { URL : seq, 'http://elsewhere:1' : 1000 }, 3 )
+      self.assertTrue( len( ret['changes'] ) <= 3 )
+      seqs.extend( d['seq'] for d in ret['changes'] )
+      seq = ret['seq']
+      if not ret['more'] :
+        break
+    self.assertEqual( seqs, list( range( 1, 11 )))
+    ret = self.get_changes( seq )
+    self.assertEqual( (ret['changes'], ret['seq'], ret['more']), ([], seq, False) )
+
+  def test_reset(self):
+    for i in range( 3 ):
+      add_submission( self.app, datetime.datetime.now(), state='done' )
+    last = self.get_changes( 0 )['seq']
+    with self.app._db.clone().transaction( 'test' ) as db :
+      db.sql_update( sql.PURGE_CHANGES, (datetime.datetime.now() + datetime.timedelta( days=1 ),) )
+    self.assertTrue( self.get_changes( 0 )['reset'] ) # changes after 0 are gone
+    self.assertFalse( self.get_changes( last )['reset'] ) # nothing missed
+    add_submission( self.app, datetime.datetime.now(), state='done' )
+    ret = self.get_changes( last )
+    self.assertEqual( [ d['seq'] for d in ret['changes'] ], [ last + 1, last + 2 ] ) # numbers are not reused
+    self.assertFalse( ret['reset'] )
+
+# ==========================================
+
+def make_version3( filename, rows ):
+  "a database as it was before the change feed, with rows of (uid, born, state)"
+  database.check_database( filename, sql.DATABASE_SCHEMA_LIST, None, sql.MIGRATIONS[:3] )
+  with database.Database( filename, sql.DATABASE_BEGIN ).transaction( 'test' ) as db :
+    for subm, born, state in rows :
+      db.sql_insert( sql.INSERT_SUBMISSION, (subm, born, 1, 'title', 'nobody', '', database.Binary( zjson.dumps( [] )), 'n1') )
+      db.sql_update( "UPDATE Submission SET state=? WHERE uid=?;", (sql.SUBM_STATE_NUM[ state ], subm) )
+
+def get_tables( filename ):
+  with database.Database( filename, sql.DATABASE_BEGIN ).transaction( 'test', write=False ) as db :
+    rows = db.sql_selectall( "SELECT name FROM sqlite_master WHERE type IN ('table','trigger');", [] )
+  return set( r[0] for r in rows )
+
+class BasicMigration(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.app = None
+
+  def tearDown(self):
+    if self.app is not None :
+      close_app( self.app )
+    shutil.rmtree( self.tmpdir )
+
+  def test_version3(self):
+    old = uid.pretty_print( uid.create_uid( datetime.datetime( 2020, 1, 1 )))
+    archived = uid.pretty_print( uid.create_uid( datetime.datetime( 2020, 1, 2 )))
+    filename = os.path.join( self.tmpdir, 'cog.db' )
+    make_version3( filename, [ (old, datetime.datetime( 2020, 1, 1 ), 'done') ] )
+    os.makedirs( os.path.join( self.tmpdir, 'archive' ))
+    archivename = os.path.join( self.tmpdir, 'archive', 'cog.2020-01.db' )
+    make_version3( archivename, [ (archived, datetime.datetime( 2020, 1, 2 ), 'done') ] )
+
+    self.app = make_app( self.tmpdir ) # upgrades the database
+    self.assertEqual( database.get_schema_version( filename ), sql.SCHEMA_VERSION )
+    self.assertTrue( set([ 'Change', 'trg_Submission_insert', 'trg_Execution_state' ]) <= get_tables( filename ))
+    self.assertEqual( self.app.get_changes( USER, 0, 0 )['changes'], [] ) # nothing happened yet
+    subm = add_submission( self.app, datetime.datetime.now(), state='done' )
+    self.assertEqual( [ d['uid'] for d in self.app.get_changes( USER, 0, 0 )['changes'] ], [ '%s#%s' % (URL, subm) ] * 2 )
+
+    self.app._task_archive() # upgrades the archive
+    self.assertEqual( self.app._get_archive_name( old ), archivename )
+    self.assertEqual( database.get_schema_version( archivename ), sql.SCHEMA_VERSION )
+    self.assertFalse( 'Change' in get_tables( archivename )) # no change feed in the archives
+    for x in ( old, archived ):
+      self.assertEqual( self.app.get_submission( USER, '%s#%s' % (URL, x) )['state'], 'done' )
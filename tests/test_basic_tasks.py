@@ -0,0 +1,110 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# ==========================================
+
+import unittest
+import threading
+import time
+
+# ==========================================
+
+import cog.server
+import tests.util as util
+
+# ==========================================
+
+def make_app():
+  # only the timer heap of a ServerApp, without its database, sandboxes etc.
+  app = cog.server.ServerApp.__new__( cog.server.ServerApp )
+  app._taskheap = []
+  app._taskpending = {}
+  app._taskcond = threading.Condition()
+  app._taskstop = False
+  app._backup_thread = None
+  app._logger = util.ListLogger()
+  return app
+
+# ==========================================
+
+class BasicTasks(unittest.TestCase):
+
+  def test_deadline_order(self):
+    app = make_app()
+    app._task( 0.15, '_task_a', () )
+    app._task( 0.05, '_task_b', () )
+    app._task( 0.10, '_task_c', (1,) )
+    start = time.time()
+    names = [ app._next_task()[0] for i in range(3) ]
+    self.assertEqual( names, ['_task_b', '_task_c', '_task_a'] )
+    self.assertTrue( time.time() - start >= 0.14 )
+
+  def test_earliest_wins(self):
+    app = make_app()
+    app._task( 60, '_task_a', (1,) )
+    app._task( 0, '_task_a', (1,) )
+    self.assertEqual( app._next_task(), ('_task_a', (1,)) )
+    app._stop_tasks()
+    self.assertEqual( app._next_task(), None ) # the superseded call is gone
+
+  def test_wakes_coalesce(self):
+    app = make_app()
+    calls = []
+    app._task_schedule = lambda interval : calls.append( interval )
+    for i in range(10) :
+      app._wake_scheduler()
+    consumer = threading.Thread( target=app._consume_tasks )
+    consumer.daemon = True
+    consumer.start()
+    time.sleep( 0.2 )
+    self.assertEqual( calls, [ cog.server.SCHEDULE_INTERVAL ] )
+    app._stop_tasks()
+    consumer.join( 2.0 )
+    self.assertFalse( consumer.is_alive() )
+
+  def test_task_error(self):
+    app = make_app()
+    def fail() :
+      raise ValueError( 'task' )
+    app._task_fail = fail
+    app._task( 0, '_task_fail', () )
+    consumer = threading.Thread( target=app._consume_tasks )
+    consumer.daemon = True
+    consumer.start()
+    time.sleep( 0.1 )
+    app._stop_tasks()
+    consumer.join( 2.0 )
+    self.assertFalse( consumer.is_alive() ) # survived the exception until stopped
+    self.assertTrue( 'ValueError' in app._logger.errors[-1] )
+
+  def test_backup_thread(self):
+    app = make_app()
+    started = threading.Event()
+    release = threading.Event()
+    def backup() :
+      started.set()
+      release.wait( 5.0 )
+    app._backup = backup
+    app._task_backup( 60 ) # returns at once, the backup goes on in its thread
+    self.assertTrue( started.wait( 2.0 ))
+    app._task_backup( -1 ) # no second backup while the first one runs
+    self.assertEqual( len( app._logger.warnings ), 1 )
+    self.assertEqual( [ name for when, key, name, args in app._taskheap ], ['_task_backup'] )
+    release.set()
+    app._backup_thread.join( 2.0 )
+    self.assertFalse( app._backup_thread.is_alive() )
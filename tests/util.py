@@ -0,0 +1,34 @@
+#####################################################################
+#
+# Copyright 2016 Mayur Patel
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+# 
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License. 
+# 
+#####################################################################
+
+# helpers shared by the tests, not a test module itself
+
+# ==========================================
+
+class ListLogger( object ):
+  "stands in for a logging.Logger, keeps the messages for the tests to look at"
+  def __init__( self ):
+    self.errors = []
+    self.warnings = []
+    self.infos = []
+  def error( self, msg ):
+    self.errors.append( msg )
+  def warning( self, msg ):
+    self.warnings.append( msg )
+  def info( self, msg ):
+    self.infos.append( msg )